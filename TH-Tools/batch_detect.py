@@ -0,0 +1,122 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import argparse
+import multiprocessing
+from functools import lru_cache
+import numpy as np
+import candle_detection
+import grid_registration
+import profiling
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Function to load the reference photo once per process, however many images are registered onto it.
+@lru_cache(maxsize=1)
+def load_reference(reference_file):
+    return candle_detection.load_image(reference_file)
+
+# Function to detect the candles in one image and write its matrices.
+def process_image(job):
+    """Detect candles in one image and save the grid next to the other per-distance matrices.
+
+    Returns (output file, candle grid, None), or (image path, None, reason) when the layout could not be
+    registered onto the image, so one bad photo does not stop the rest of the batch.
+    """
+    image_path, grid_points, grid_rows, grid_cols, output_dir, save_npy, reference_file = job
+    rgb_image = candle_detection.load_image(image_path)
+
+    # Name the outputs after the photo, e.g. T1P1-3FOOT.jpg -> T1P1-3FOOT.xlsx
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+
+    # Carry the layout over from the reference photo, saving it so it can be checked in the grid candle counter
+    if reference_file:
+        try:
+            grid_points, _ = grid_registration.auto_layout(rgb_image, grid_rows, grid_cols,
+                                                           load_reference(reference_file), grid_points)
+        except ValueError as error:
+            return image_path, None, str(error)
+        np.save(os.path.join(output_dir, f"{stem}-layout.npy"), grid_points)
+        grid_points = grid_points.tolist()
+
+    candle_grid, occupancy, flame_area = candle_detection.measure_candles(rgb_image, grid_points, grid_rows, grid_cols)
+    output_file = os.path.join(output_dir, f"{stem}.xlsx")
+    candle_detection.save_candle_grid(candle_grid, output_file)
+    if save_npy:
+        np.savez(os.path.join(output_dir, f"{stem}.npz"),
+                 candle_grid=candle_grid, occupancy=occupancy, flame_area=flame_area)
+    return output_file, candle_grid, None
+
+# Functions run in the pool workers, which send their profiling spans back with each result.
+def _init_worker(profile_origin=None):
+    profiling.start_worker(profile_origin)
+
+def _detect_job(job):
+    return process_image(job), profiling.take_events()
+
+# Function to run candle detection on every image in a directory with a saved grid layout.
+def batch_detect(image_dir, layout_file, output_dir, grid_rows=candle_detection.GRID_ROWS,
+                 grid_cols=candle_detection.GRID_COLS, n_jobs=1, save_npy=False, reference_file=None):
+    """Detect candles in every image; with reference_file the layout belongs to that photo and is registered onto each image."""
+    # Load the grid layout written by GridAdjuster.save_grid_layout
+    grid_points = np.load(layout_file).tolist()
+    if len(grid_points) != grid_rows * grid_cols:
+        raise ValueError(f"Grid layout has {len(grid_points)} points, expected {grid_rows} x {grid_cols}.")
+
+    # Ensure output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    image_files = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    jobs = [(os.path.join(image_dir, f), grid_points, grid_rows, grid_cols, output_dir, save_npy, reference_file)
+            for f in image_files]
+
+    # Detect the candles, over a process pool when more than one job is requested
+    if n_jobs > 1 and len(jobs) > 1:
+        results = []
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(profiling.worker_origin(),)) as pool:
+            for result, events in pool.imap(_detect_job, jobs):
+                profiling.merge(events)
+                results.append(result)
+    else:
+        results = [process_image(job) for job in jobs]
+
+    for output_file, candle_grid, error in results:
+        if error is None:
+            print(f"Candle grid saved to {output_file} ({int(candle_grid.sum())} lit)")
+        else:
+            print(f"Skipped {output_file}: {error}")
+    return results
+
+# Function to add the detection options to an argument parser, shared with the thunderhead entry point.
+def add_arguments(parser):
+    parser.add_argument('image_dir', type=str, help='Directory containing the candle photos.')
+    parser.add_argument('layout_file', type=str, help='Grid layout (.npy) saved from the grid candle counter.')
+    parser.add_argument('output_dir', type=str, help='Directory to save the candle grids, e.g. TH-Data/T1P1/Data/Dist.')
+    parser.add_argument('--rows', type=int, default=candle_detection.GRID_ROWS, help='Number of grid point rows in the layout.')
+    parser.add_argument('--cols', type=int, default=candle_detection.GRID_COLS, help='Number of grid point columns in the layout.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used for detection.')
+    parser.add_argument('--register', type=str, default=None, metavar='REFERENCE_IMAGE', help='Photo the layout was made on; the layout is registered onto each image.')
+    parser.add_argument('--npy', action='store_true', help='Also save each candle grid with its occupancy and flame area matrices as a binary .npz file.')
+    profiling.add_argument(parser)
+
+# Function to detect the candles from parsed arguments.
+def run(args, parser):
+    if args.profile:
+        profiling.start("batch_detect")
+
+    # Detect the candles
+    batch_detect(args.image_dir, args.layout_file, args.output_dir, args.rows, args.cols, args.jobs, args.npy, args.register)
+    if args.profile:
+        profiling.finish(args.profile)
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Detect candles in every image of a directory using a saved grid layout.')
+    add_arguments(parser)
+
+    # Parse the arguments
+    args = parser.parse_args()
+    run(args, parser)
@@ -0,0 +1,186 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+import numpy as np
+import cv2
+import candle_detection
+import catalog
+import trial_cube
+
+# The real campaigns cover 1FOOT through 10.5FOOT in half-foot steps
+DEFAULT_DISTANCE_COUNT = 20
+
+# Function to name the distance sheets of a synthetic campaign.
+def make_distances(count):
+    """Return count sheet names starting at 1FOOT in half-foot steps."""
+    return [f"{1 + 0.5 * i:g}FOOT" for i in range(count)]
+
+# Function to generate one synthetic candle matrix, with more candles lit further away.
+def synthetic_matrix(rng, distance, rows, cols):
+    """Return a 0/1 candle matrix whose lit fraction grows with distance."""
+    lit_fraction = min(0.95, 0.1 + distance / 12)
+    return (rng.random((rows, cols)) < lit_fraction).astype(int)
+
+# Function to draw a synthetic candle photo with orange flame blobs in the lit cells.
+def synthetic_photo(rng, candle_grid, width, height):
+    """Return (rgb image, grid points) for a candle grid drawn on a dark background."""
+    rows, cols = candle_grid.shape
+    image = np.full((height, width, 3), 40, dtype=np.uint8)
+    image += rng.integers(0, 20, image.shape, dtype=np.uint8)
+    cell_width, cell_height = width / cols, height / rows
+    radius = max(2, int(min(cell_width, cell_height) / 6))
+    for r, c in zip(*np.nonzero(candle_grid)):
+        center = (int((c + 0.5) * cell_width), int((r + 0.5) * cell_height))
+        cv2.circle(image, center, radius, (255, 140, 0), -1)
+    grid_points = [(c * cell_width, r * cell_height) for r in range(rows + 1) for c in range(cols + 1)]
+    return image, grid_points
+
+# Function to write a synthetic campaign laid out like TH-Data and TH-Media.
+def generate_campaign(root, trials, prototypes, distances, rows, cols, image_size, seed=0):
+    """Create T{n}P{m}/Data/Dist workbooks and T{n}P{m}Images photos under root."""
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    layout_file = os.path.join(root, "layout.npy")
+    for t in range(1, trials + 1):
+        for p in range(1, prototypes + 1):
+            name = f"T{t}P{p}"
+            dist_dir = os.path.join(root, "TH-Data", name, "Data", "Dist")
+            image_dir = os.path.join(root, "TH-Media", f"{name}Images")
+            os.makedirs(dist_dir)
+            os.makedirs(image_dir)
+            for distance in distances:
+                candle_grid = synthetic_matrix(rng, catalog.parse_distance(distance), rows, cols)
+                candle_detection.save_candle_grid(candle_grid, os.path.join(dist_dir, f"{name}-{distance}.xlsx"))
+                image, grid_points = synthetic_photo(rng, candle_grid, width, height)
+                cv2.imwrite(os.path.join(image_dir, f"{name}-{distance}.jpg"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    np.save(layout_file, grid_points)
+    return layout_file
+
+# Function to time a stage, returning the min and median of several repeats.
+def time_stage(function, repeats):
+    """Run function repeats times with its output silenced and return timing statistics in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeats": repeats}
+
+# Function to run every pipeline stage on a synthetic campaign.
+def run_benchmarks(trials, prototypes, distances, rows, cols, image_size, repeats, n_jobs, stages):
+    # The plotting and compile modules are imported here so the generator works without them
+    import compile_excel
+    import plot_single
+    import plot_average
+    import batch_detect
+
+    root = tempfile.mkdtemp(prefix="th-bench-")
+    try:
+        layout_file = generate_campaign(root, trials, prototypes, distances, rows, cols, image_size)
+        names = [f"T{t}P{p}" for t in range(1, trials + 1) for p in range(1, prototypes + 1)]
+
+        def data_dir(name):
+            return os.path.join(root, "TH-Data", name, "Data")
+
+        def compiled(name):
+            return os.path.join(data_dir(name), f"{name}.xlsx")
+
+        def compile_all():
+            for name in names:
+                compile_excel.compile_excel_files(os.path.join(data_dir(name), "Dist"), compiled(name))
+
+        def plot_all():
+            for name in names:
+                plot_single.plot_heatmaps(compiled(name), os.path.join(root, "TH-Data", name, "Plots"), n_jobs=n_jobs)
+
+        def average_all():
+            for p in range(1, prototypes + 1):
+                files = [compiled(f"T{t}P{p}") for t in range(1, trials + 1)]
+                plot_average.plot_average_heatmaps(files, os.path.join(root, "TH-Data", f"P{p}AveragedPlots"),
+                                                   n_jobs=n_jobs)
+
+        def detect_all():
+            for name in names:
+                batch_detect.batch_detect(os.path.join(root, "TH-Media", f"{name}Images"), layout_file,
+                                          os.path.join(root, "detected", name), rows + 1, cols + 1, n_jobs)
+
+        # Compile has to run first since the plotting stages read its output
+        available = {"compile": compile_all, "plot_single": plot_all, "plot_average": average_all, "detect": detect_all}
+        results = {}
+        for stage in ["compile", "plot_single", "plot_average", "detect"]:
+            if stage in stages or (stage == "compile" and stages & {"plot_single", "plot_average"}):
+                timing = time_stage(available[stage], repeats)
+                if stage in stages:
+                    results[stage] = timing
+                    print(f"{stage:>14}: {timing['min']:.3f}s min, {timing['median']:.3f}s median")
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+# Function to compare results against a stored baseline.
+def compare_results(results, baseline, threshold):
+    """Return the stages whose minimum time is more than threshold (a fraction) slower than the baseline."""
+    regressions = []
+    for stage, timing in results["stages"].items():
+        reference = baseline.get("stages", {}).get(stage)
+        if reference is None:
+            continue
+        change = timing["min"] / reference["min"] - 1
+        status = "REGRESSION" if change > threshold else "ok"
+        print(f"{stage:>14}: {reference['min']:.3f}s -> {timing['min']:.3f}s ({change:+.1%}) {status}")
+        if change > threshold:
+            regressions.append(stage)
+    if results["config"] != baseline.get("config"):
+        print("Warning: the baseline was recorded with a different configuration.")
+    return regressions
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Benchmark the TH-Tools pipeline on a synthetic campaign.')
+    parser.add_argument('--trials', type=int, default=3, help='Number of trials per prototype.')
+    parser.add_argument('--prototypes', type=int, default=4, help='Number of prototypes.')
+    parser.add_argument('--distances', type=int, default=DEFAULT_DISTANCE_COUNT, help='Number of distances, starting at 1FOOT in half-foot steps.')
+    parser.add_argument('--grid', type=int, nargs=2, default=[5, 9], metavar=('ROWS', 'COLS'), help='Candle grid size.')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[1920, 1080], metavar=('WIDTH', 'HEIGHT'), help='Synthetic photo size.')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times each stage is timed.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes passed to the stages that support it.')
+    parser.add_argument('--stages', type=str, nargs='+', default=["compile", "plot_single", "plot_average", "detect"],
+                        choices=["compile", "plot_single", "plot_average", "detect"], help='Stages to time.')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Path to save the results as JSON.')
+    parser.add_argument('--baseline', type=str, default=None, help='Results JSON to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown fraction that counts as a regression.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Run the benchmarks
+    distances = make_distances(args.distances)
+    config = {"trials": args.trials, "prototypes": args.prototypes, "distances": args.distances,
+              "grid": args.grid, "image_size": args.image_size, "jobs": args.jobs}
+    stages = run_benchmarks(args.trials, args.prototypes, distances, args.grid[0], args.grid[1],
+                            tuple(args.image_size), args.repeats, args.jobs, set(args.stages))
+    results = {"config": config, "python": platform.python_version(), "machine": platform.machine(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "stages": stages}
+    with open(args.output, "w") as handle:
+        json.dump(results, handle, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+
+    # Compare against the stored baseline
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            raise SystemExit(f"Performance regression in: {', '.join(regressions)}")
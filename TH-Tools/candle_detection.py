@@ -0,0 +1,112 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+from functools import lru_cache
+import numpy as np
+import cv2
+import openpyxl
+from PIL import Image
+import profiling
+
+# HSV thresholds for lit candle flames (loosened for better detection)
+LOWER_ORANGE = np.array([10, 120, 120])
+UPPER_ORANGE = np.array([30, 255, 255])
+
+# Default grid dimensions in grid points (rows and columns), giving a 5x9 candle grid
+GRID_ROWS = 6
+GRID_COLS = 10
+
+# Function to load an image from disk as an RGB array.
+def load_image(image_path):
+    """Return the image at image_path as an RGB uint8 array."""
+    with profiling.span("decode image", file=image_path) as span, Image.open(image_path) as image:
+        span.count()
+        return np.array(image.convert("RGB"))
+
+# Function to build the flame mask of an RGB image.
+def flame_mask(rgb_image, bgr=False):
+    """Return a uint8 mask that is 255 wherever a pixel falls inside the orange flame thresholds.
+
+    Pass bgr=True for frames that come straight from OpenCV.
+    """
+    hsv = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2HSV if bgr else cv2.COLOR_RGB2HSV)
+    return cv2.inRange(hsv, LOWER_ORANGE, UPPER_ORANGE)
+
+# Function to find the pixel region covered by the grid.
+def grid_roi(grid_points, image_shape, scale=1.0):
+    """Return (y0, y1, x0, x1) bounding the grid inside an image of the given shape."""
+    points = np.asarray(grid_points, dtype=float) * scale
+    height, width = image_shape[:2]
+    x0 = int(np.clip(np.floor(points[:, 0].min()), 0, width))
+    x1 = int(np.clip(np.ceil(points[:, 0].max()) + 1, 0, width))
+    y0 = int(np.clip(np.floor(points[:, 1].min()), 0, height))
+    y1 = int(np.clip(np.ceil(points[:, 1].max()) + 1, 0, height))
+    return y0, y1, x0, x1
+
+# Function to rasterize every grid cell quadrilateral into a label image.
+# A full-resolution label image is tens of MB, so only the grids of the current image and its preview are kept.
+@lru_cache(maxsize=2)
+def _cell_labels(grid_key, image_shape, grid_rows, grid_cols, scale):
+    points = np.asarray(grid_key, dtype=float) * scale
+    y0, y1, x0, x1 = grid_roi(grid_key, image_shape, scale)
+    # One byte per pixel holds the 45 cells of the standard grid; larger grids fall back to two
+    dtype = np.uint8 if (grid_rows - 1) * (grid_cols - 1) < 256 else np.uint16
+    labels = np.zeros((y1 - y0, x1 - x0), dtype=dtype)
+
+    # Label 0 is background; cell (row, col) gets label row * (grid_cols - 1) + col + 1
+    for row in range(grid_rows - 1):
+        for col in range(grid_cols - 1):
+            corners = points[[row * grid_cols + col, row * grid_cols + col + 1,
+                              (row + 1) * grid_cols + col + 1, (row + 1) * grid_cols + col]]
+            corners = np.round(corners - (x0, y0)).astype(np.int32)
+            cv2.fillPoly(labels, [corners], row * (grid_cols - 1) + col + 1)
+
+    areas = np.bincount(labels.ravel(), minlength=(grid_rows - 1) * (grid_cols - 1) + 1)[1:]
+    return labels, areas
+
+def cell_labels(grid_points, image_shape, grid_rows=GRID_ROWS, grid_cols=GRID_COLS, scale=1.0):
+    """Return (labels, areas) for the grid ROI, where labels maps each pixel to its cell (0 outside)."""
+    grid_key = tuple(tuple(float(v) for v in point) for point in grid_points)
+    return _cell_labels(grid_key, tuple(image_shape[:2]), grid_rows, grid_cols, float(scale))
+
+# Function to measure the flame pixels inside every grid cell in one pass.
+def measure_candles(rgb_image, grid_points, grid_rows=GRID_ROWS, grid_cols=GRID_COLS, scale=1.0, min_fraction=0.0):
+    """Return (candle_grid, occupancy, flame_area) for the quadrilateral cells of the grid.
+
+    flame_area holds the number of flame pixels per cell, occupancy the fraction of the cell they cover,
+    and candle_grid is 1 wherever the occupancy is above min_fraction.
+    """
+    cells = (grid_rows - 1, grid_cols - 1)
+    with profiling.span("cell labels"):
+        labels, areas = cell_labels(grid_points, rgb_image.shape, grid_rows, grid_cols, scale)
+    y0, y1, x0, x1 = grid_roi(grid_points, rgb_image.shape, scale)
+
+    # Only threshold the part of the image covered by the grid
+    with profiling.span("hsv threshold") as span:
+        mask = flame_mask(np.ascontiguousarray(rgb_image[y0:y1, x0:x1]))
+        span.count()
+    with profiling.span("count flame pixels"):
+        flame_area = np.bincount(labels[mask > 0], minlength=areas.size + 1)[1:].reshape(cells)
+    occupancy = flame_area / np.maximum(areas.reshape(cells), 1)
+    candle_grid = (occupancy > min_fraction).astype(int)
+    return candle_grid, occupancy, flame_area
+
+# Function to detect which grid cells contain a lit candle.
+def detect_candles(rgb_image, grid_points, grid_rows=GRID_ROWS, grid_cols=GRID_COLS, scale=1.0):
+    """Return a (grid_rows - 1, grid_cols - 1) array with 1 wherever a cell contains flame pixels."""
+    return measure_candles(rgb_image, grid_points, grid_rows, grid_cols, scale)[0]
+
+# Function to save a candle grid to an Excel file.
+def save_candle_grid(candle_grid, save_path):
+    """Write the candle grid to the first sheet of a new workbook at save_path."""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+
+    # Write the grid data to the Excel sheet
+    for r in range(candle_grid.shape[0]):
+        for c in range(candle_grid.shape[1]):
+            sheet.cell(row=r + 1, column=c + 1, value=int(candle_grid[r, c]))
+
+    with profiling.span("save workbook", file=save_path):
+        workbook.save(save_path)
@@ -0,0 +1,260 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import re
+import sys
+import hashlib
+import sqlite3
+import argparse
+
+# File name patterns of the TH-Data and TH-Media layout, with the kind of file each one is
+DISTANCE = r'(?P<distance>\d+(?:\.\d+)?)FOOT'
+PATTERNS = [
+    ("trial_workbook", re.compile(r'^TH-Data/T(?P<trial>\d+)P(?P<prototype>\d+)/Data/T\d+P\d+\.xlsx$')),
+    ("dist_workbook", re.compile(r'^TH-Data/T(?P<trial>\d+)P(?P<prototype>\d+)/Data/Dist/T\d+P\d+-' + DISTANCE + r'\.xlsx$')),
+    ("plot", re.compile(r'^TH-Data/T(?P<trial>\d+)P(?P<prototype>\d+)/Plots/' + DISTANCE + r'_heatmap\.png$')),
+    ("average_plot", re.compile(r'^TH-Data/P(?P<prototype>\d+)AveragedPlots/' + DISTANCE + r'_average_heatmap\.png$')),
+    ("photo", re.compile(r'^TH-Media/T(?P<trial>\d+)P(?P<prototype>\d+)Images/T\d+P\d+-' + DISTANCE + r'\.(?:jpe?g|png)$', re.IGNORECASE)),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    trial INTEGER,
+    prototype INTEGER,
+    distance REAL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sheets (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    sheet TEXT NOT NULL,
+    distance REAL,
+    PRIMARY KEY (path, sheet)
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_lookup ON files (kind, prototype, distance, trial);
+CREATE INDEX IF NOT EXISTS sheets_lookup ON sheets (distance);
+"""
+
+# Simple regex to pull the distance in feet out of a sheet name such as "1.5FOOT".
+def parse_distance(name, default=None):
+    """Return the distance in feet in a sheet or file name as a float, or default if there is none.
+
+    Pass default=float('inf') to sort names without a distance last.
+    """
+    match = re.search(r'\d+(?:\.\d+)?', name)
+    return float(match.group()) if match else default
+
+# Function to classify a path relative to the repository root.
+def parse_path(relative_path):
+    """Return (kind, trial, prototype, distance) for a known TH-Data/TH-Media file, or None."""
+    for kind, pattern in PATTERNS:
+        match = pattern.match(relative_path)
+        if match:
+            fields = match.groupdict()
+            return (kind,
+                    int(fields["trial"]) if fields.get("trial") else None,
+                    int(fields["prototype"]) if fields.get("prototype") else None,
+                    float(fields["distance"]) if fields.get("distance") else None)
+    return None
+
+# A function to hash a file for change detection, shared by the compile manifest, trial cubes and pipeline.
+def file_hash(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to open the catalog database, creating its tables if needed.
+def connect(db_path):
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(SCHEMA)
+    return connection
+
+# Function to scan TH-Data and TH-Media and bring the catalog up to date.
+def update_catalog(root, db_path):
+    """Add, refresh or remove catalog entries, re-hashing only files whose size or mtime changed."""
+    connection = connect(db_path)
+    known = {row["path"]: (row["size"], row["mtime"]) for row in connection.execute("SELECT path, size, mtime FROM files")}
+    seen = set()
+    changed = 0
+
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO settings VALUES ('root', ?)", (os.path.abspath(root),))
+        for top in ("TH-Data", "TH-Media"):
+            for directory, _, file_names in os.walk(os.path.join(root, top)):
+                for file_name in file_names:
+                    full_path = os.path.join(directory, file_name)
+                    relative_path = os.path.relpath(full_path, root).replace(os.sep, "/")
+                    parsed = parse_path(relative_path)
+                    if parsed is None:
+                        continue
+                    seen.add(relative_path)
+                    stat = os.stat(full_path)
+                    if known.get(relative_path) == (stat.st_size, stat.st_mtime):
+                        continue
+
+                    # New or changed file: hash it and re-read its sheet names
+                    kind, trial, prototype, distance = parsed
+                    connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       (relative_path, kind, trial, prototype, distance,
+                                        stat.st_size, stat.st_mtime, file_hash(full_path)))
+                    connection.execute("DELETE FROM sheets WHERE path = ?", (relative_path,))
+                    if kind == "trial_workbook":
+                        for position, sheet in enumerate(read_sheet_names(full_path)):
+                            connection.execute("INSERT INTO sheets VALUES (?, ?, ?, ?)",
+                                               (relative_path, position, sheet, parse_distance(sheet)))
+                    changed += 1
+
+        # Forget files that no longer exist
+        removed = set(known) - seen
+        connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+
+    connection.close()
+    print(f"Catalog {db_path} updated: {changed} added or changed, {len(removed)} removed, {len(seen)} total")
+
+# Function to list the sheet names of a workbook without loading its cells.
+def read_sheet_names(path):
+    # openpyxl is only needed when a workbook is new or changed
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True)
+    try:
+        return list(workbook.sheetnames)
+    finally:
+        workbook.close()
+
+# Function to build the WHERE clause shared by the query functions.
+def _filters(table, trial, prototype, min_distance, max_distance):
+    clauses, values = [], []
+    for column, value in (("files.trial", trial), ("files.prototype", prototype)):
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            values.append(value)
+    if min_distance is not None:
+        clauses.append(f"{table}.distance >= ?")
+        values.append(min_distance)
+    if max_distance is not None:
+        clauses.append(f"{table}.distance <= ?")
+        values.append(max_distance)
+    return clauses, values
+
+# Function to read the repository root the catalog was built from.
+def _root(connection, db_path):
+    row = connection.execute("SELECT value FROM settings WHERE key = 'root'").fetchone()
+    if row is None:
+        connection.close()
+        raise ValueError(f"The catalog {db_path} has never been updated. Run catalog.py update <root> {db_path} first.")
+    return row["value"]
+
+# Function to warn about files on disk that a stale catalog does not list yet.
+def _warn_uncatalogued(root, catalogued, kind, trial, prototype, min_distance, max_distance, directory):
+    """Print the files matching the query that exist under root but are missing from the catalog."""
+    if directory is not None:
+        tops = [os.path.abspath(directory)]
+    else:
+        tops = [os.path.join(root, "TH-Data"), os.path.join(root, "TH-Media")]
+    missing = []
+    for top in tops:
+        for current, _, file_names in os.walk(top):
+            for file_name in file_names:
+                full_path = os.path.join(current, file_name)
+                parsed = parse_path(os.path.relpath(full_path, root).replace(os.sep, "/"))
+                if parsed is None or full_path in catalogued:
+                    continue
+                file_kind, file_trial, file_prototype, distance = parsed
+                if ((kind is None or file_kind == kind) and (trial is None or file_trial == trial)
+                        and (prototype is None or file_prototype == prototype)
+                        and (min_distance is None or (distance is not None and distance >= min_distance))
+                        and (max_distance is None or (distance is not None and distance <= max_distance))):
+                    missing.append(full_path)
+    if missing:
+        print(f"Warning: {len(missing)} matching files are not in the catalog and are left out, "
+              f"run catalog.py update to add them: {', '.join(sorted(missing))}", file=sys.stderr)
+
+# Function to look up catalogued files.
+def query_files(db_path, kind=None, trial=None, prototype=None, min_distance=None, max_distance=None, directory=None,
+                check_stale=False):
+    """Return catalogued files as dicts with an absolute "path", ordered by prototype, trial and distance.
+
+    With check_stale, the directories are walked and files on disk that match the query but are not catalogued
+    yet are reported with a warning; otherwise only the catalog is read.
+    """
+    connection = connect(db_path)
+    root = _root(connection, db_path)
+    clauses, values = _filters("files", trial, prototype, min_distance, max_distance)
+    if kind is not None:
+        clauses.append("files.kind = ?")
+        values.append(kind)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = connection.execute(f"SELECT * FROM files {where} ORDER BY prototype, trial, distance, path", values).fetchall()
+    connection.close()
+
+    results = []
+    for row in rows:
+        entry = dict(row)
+        entry["path"] = os.path.join(root, *row["path"].split("/"))
+        if directory is None or os.path.dirname(entry["path"]) == os.path.abspath(directory):
+            results.append(entry)
+    if check_stale:
+        _warn_uncatalogued(root, {os.path.join(root, *row["path"].split("/")) for row in rows}, kind, trial,
+                           prototype, min_distance, max_distance, directory)
+    return results
+
+# Function to look up the sheets of the compiled trial workbooks.
+def query_sheets(db_path, trial=None, prototype=None, min_distance=None, max_distance=None):
+    """Return (trial, prototype, distance, absolute workbook path, sheet name) for every matching sheet."""
+    connection = connect(db_path)
+    root = _root(connection, db_path)
+    clauses, values = _filters("sheets", trial, prototype, min_distance, max_distance)
+    where = f"AND {' AND '.join(clauses)}" if clauses else ""
+    rows = connection.execute(
+        "SELECT files.trial, files.prototype, sheets.distance, files.path, sheets.sheet FROM sheets "
+        f"JOIN files ON files.path = sheets.path WHERE files.kind = 'trial_workbook' {where} "
+        "ORDER BY files.prototype, sheets.distance, files.trial", values).fetchall()
+    connection.close()
+    return [(row[0], row[1], row[2], os.path.join(root, *row[3].split("/")), row[4]) for row in rows]
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Catalog the TH-Data and TH-Media files in a SQLite index and query it.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    update_parser = subparsers.add_parser('update', help='Scan the repository and update the catalog.')
+    update_parser.add_argument('root', type=str, help='Repository root containing TH-Data and TH-Media.')
+    update_parser.add_argument('db', type=str, help='Path to the catalog database.')
+    query_parser = subparsers.add_parser('query', help='List catalogued sheets or files.')
+    query_parser.add_argument('db', type=str, help='Path to the catalog database.')
+    query_parser.add_argument('--kind', type=str, default='sheet', choices=['sheet'] + [kind for kind, _ in PATTERNS], help='What to list.')
+    query_parser.add_argument('--trial', type=int, default=None, help='Only this trial number.')
+    query_parser.add_argument('--prototype', type=int, default=None, help='Only this prototype number.')
+    query_parser.add_argument('--min-distance', type=float, default=None, help='Smallest distance in feet.')
+    query_parser.add_argument('--max-distance', type=float, default=None, help='Largest distance in feet.')
+    query_parser.add_argument('--check-stale', action='store_true', help='Also walk the data directories and warn about matching files the catalog is missing.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Update or query the catalog
+    if args.command == 'update':
+        update_catalog(args.root, args.db)
+    elif args.kind == 'sheet':
+        for trial, prototype, distance, path, sheet in query_sheets(args.db, args.trial, args.prototype,
+                                                                    args.min_distance, args.max_distance):
+            print(f"T{trial}P{prototype}\t{distance:g}\t{sheet}\t{path}")
+    else:
+        for entry in query_files(args.db, args.kind, args.trial, args.prototype, args.min_distance, args.max_distance,
+                                 check_stale=args.check_stale):
+            print(f"{entry['kind']}\t{entry['path']}")
@@ -4,30 +4,43 @@
 # Python modules required by the current program
 import os
 import re
+import json
 from openpyxl import load_workbook, Workbook
 import argparse
+import catalog
+import profiling
 
 # Simple regex to remove various project titles.
 def extract_numbers(string):
     """Extract all numbers from the string, returning a tuple of floats for sorting."""
-    numbers = re.findall(r'\d+', string)
+    numbers = re.findall(r'\d+(?:\.\d+)?', string)
     return tuple(float(num) for num in numbers) if numbers else (float('inf'),)
 
+# A function to list the Excel files of a folder, from the catalog when one is given.
+def list_excel_files(folder_path, catalog_db=None, check_stale=False):
+    """Return the sorted Excel file names in folder_path."""
+    if catalog_db:
+        entries = catalog.query_files(catalog_db, kind="dist_workbook", directory=folder_path, check_stale=check_stale)
+        return sorted(os.path.basename(entry["path"]) for entry in entries)
+    return sorted([f for f in os.listdir(folder_path) if f.endswith((".xlsx", ".xls"))])
+
 # Function to compile all the individual matrices into one excel file.
-def compile_excel_files(folder_path, output_file):
+def compile_excel_files(folder_path, output_file, catalog_db=None, check_stale=False):
     # Create a new workbook
     compiled_workbook = Workbook()
     compiled_workbook.remove(compiled_workbook.active)  # Remove the default sheet
 
     # Get all Excel files in the folder
-    excel_files = sorted([f for f in os.listdir(folder_path) if f.endswith((".xlsx", ".xls"))])
+    excel_files = list_excel_files(folder_path, catalog_db, check_stale)
 
     tabs = []
 
     for file_name in excel_files:
         file_path = os.path.join(folder_path, file_name)
         # Load the Excel file
-        workbook = load_workbook(file_path)
+        with profiling.span("load workbook", file=file_name) as span:
+            workbook = load_workbook(file_path)
+            span.count(len(workbook.sheetnames))
 
         # Extract the part of the file name after the hyphen
         stripped_name = os.path.splitext(file_name)[0].split('-')[-1].strip()
@@ -41,24 +54,126 @@ def compile_excel_files(folder_path, output_file):
     tabs.sort(key=lambda x: extract_numbers(x[0]))
 
     # Create new sorted sheets in the compiled workbook and copy content
-    for name, original_sheet in tabs:
-        new_sheet = compiled_workbook.create_sheet(title=name)
-        for row in original_sheet.iter_rows(values_only=True):
-            new_sheet.append(row)
+    with profiling.span("copy sheets") as span:
+        for name, original_sheet in tabs:
+            new_sheet = compiled_workbook.create_sheet(title=name)
+            for row in original_sheet.iter_rows(values_only=True):
+                new_sheet.append(row)
+            span.count()
 
     # Save the compiled workbook
-    compiled_workbook.save(output_file)
+    with profiling.span("save workbook", file=output_file):
+        compiled_workbook.save(output_file)
     print(f"All Excel files compiled into {output_file}")
 
-if __name__ == "__main__":
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description='Compile multiple Excel files into one with separate sheets.')
+# Function to compile the matrices one sheet at a time, re-reading only the workbooks that changed.
+def compile_excel_files_streaming(folder_path, output_file, catalog_db=None, check_stale=False):
+    """Compile like compile_excel_files, but stream sheets through read-only/write-only workbooks.
+
+    A manifest of source hashes is kept next to the output so unchanged sheets are copied from the
+    previous output instead of being re-read from their source workbooks.
+    """
+    manifest_path = output_file + ".manifest.json"
+    manifest = {}
+    if os.path.exists(manifest_path) and os.path.exists(output_file):
+        with open(manifest_path) as handle:
+            manifest = json.load(handle)
+
+    # Get all Excel files in the folder
+    excel_files = list_excel_files(folder_path, catalog_db, check_stale)
+
+    # Work out the sheets of every source, reusing the manifest entry when its hash is unchanged
+    sources = {}
+    tabs = []
+    changed = 0
+    for file_name in excel_files:
+        file_path = os.path.join(folder_path, file_name)
+        with profiling.span("hash workbook", file=file_name):
+            digest = catalog.file_hash(file_path)
+        previous = manifest.get(file_name)
+        if previous and previous["sha256"] == digest:
+            sheet_names = [sheet_name for sheet_name, _ in previous["sheets"]]
+            sources[file_name] = {"sha256": digest, "reused": dict(previous["sheets"])}
+        else:
+            with profiling.span("load workbook", file=file_name):
+                workbook = load_workbook(file_path, read_only=True)
+                sheet_names = workbook.sheetnames
+                workbook.close()
+            sources[file_name] = {"sha256": digest, "reused": {}}
+            changed += 1
+
+        # Extract the part of the file name after the hyphen
+        stripped_name = os.path.splitext(file_name)[0].split('-')[-1].strip()
+        for sheet_name in sheet_names:
+            tabs.append((stripped_name, file_name, sheet_name))
+
+    if not changed and set(sources) == set(manifest):
+        print(f"{output_file} is up to date")
+        return
+
+    # Sort tabs by the numeric values extracted from the stripped name
+    tabs.sort(key=lambda x: extract_numbers(x[0]))
+
+    # Stream every sheet into a write-only workbook, from the old output or from its source
+    previous_output = load_workbook(output_file, read_only=True) if os.path.exists(output_file) else None
+    compiled_workbook = Workbook(write_only=True)
+    for name, file_name, sheet_name in tabs:
+        new_sheet = compiled_workbook.create_sheet(title=name)
+        old_title = sources[file_name]["reused"].get(sheet_name)
+        if old_title is not None and previous_output is not None and old_title in previous_output.sheetnames:
+            with profiling.span("copy previous sheet", sheet=name):
+                for row in previous_output[old_title].iter_rows(values_only=True):
+                    new_sheet.append(row)
+        else:
+            with profiling.span("copy source sheet", sheet=name):
+                workbook = load_workbook(os.path.join(folder_path, file_name), read_only=True)
+                for row in workbook[sheet_name].iter_rows(values_only=True):
+                    new_sheet.append(row)
+                workbook.close()
+        sources[file_name].setdefault("sheets", []).append([sheet_name, new_sheet.title])
+
+    # Save to a temporary file first since the previous output may still be open for reading
+    tmp_file = output_file + ".tmp"
+    with profiling.span("save workbook", file=output_file):
+        compiled_workbook.save(tmp_file)
+    if previous_output is not None:
+        previous_output.close()
+    os.replace(tmp_file, output_file)
+
+    # Record the manifest for the next incremental compile
+    new_manifest = {file_name: {"sha256": info["sha256"], "sheets": info.get("sheets", [])}
+                    for file_name, info in sources.items()}
+    with open(manifest_path, "w") as handle:
+        json.dump(new_manifest, handle, indent=2)
+    print(f"All Excel files compiled into {output_file} ({changed} of {len(excel_files)} sources re-read)")
+
+# Function to add the compile options to an argument parser, shared with the thunderhead entry point.
+def add_arguments(parser):
     parser.add_argument('folder_path', type=str, help='Path to the folder containing Excel files.')
     parser.add_argument('output_file', type=str, help='Path to save the compiled Excel file.')
+    parser.add_argument('--catalog', type=str, default=None, help='Take the file list from a catalog database instead of listing the folder.')
+    parser.add_argument('--check-stale', action='store_true', help='With --catalog, warn about workbooks in the folder that the catalog is missing.')
+    parser.add_argument('--stream', action='store_true', help='Stream sheets one at a time and only re-read workbooks that changed since the last compile.')
+    profiling.add_argument(parser)
 
-    # Parse the arguments
-    args = parser.parse_args()
+# Function to run the compile from parsed arguments.
+def run(args, parser):
+    if args.profile:
+        profiling.start("compile_excel")
 
     # Compile the Excel files
-    compile_excel_files(args.folder_path, args.output_file)
+    if args.stream:
+        compile_excel_files_streaming(args.folder_path, args.output_file, args.catalog, args.check_stale)
+    else:
+        compile_excel_files(args.folder_path, args.output_file, args.catalog, args.check_stale)
+    if args.profile:
+        profiling.finish(args.profile)
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Compile multiple Excel files into one with separate sheets.')
+    add_arguments(parser)
 
+    # Parse the arguments
+    args = parser.parse_args()
+    run(args, parser)
@@ -0,0 +1,277 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import re
+import csv
+import glob
+import argparse
+import numpy as np
+
+# Default number of z slices processed at once, which bounds the memory used per field
+DEFAULT_SLAB = 32
+
+# Function to read the header of a legacy binary VTK file as written by FluidX3D's write_device_to_vtk.
+def read_vtk_header(path):
+    """Return a dict with the dimensions, origin, spacing, dtype, components and data offset of a VTK file."""
+    header = {"origin": (0.0, 0.0, 0.0), "spacing": (1.0, 1.0, 1.0)}
+    with open(path, "rb") as handle:
+        while True:
+            line = handle.readline()
+            if not line:
+                raise ValueError(f"{path} ended before its LOOKUP_TABLE line")
+            words = line.decode("ascii", errors="replace").split()
+            if not words:
+                continue
+            keyword = words[0].upper()
+            if keyword == "ASCII":
+                raise ValueError(f"{path} is an ASCII VTK file; only binary exports are supported")
+            if keyword == "DIMENSIONS":
+                header["dimensions"] = tuple(int(v) for v in words[1:4])
+            elif keyword == "ORIGIN":
+                header["origin"] = tuple(float(v) for v in words[1:4])
+            elif keyword == "SPACING":
+                header["spacing"] = tuple(float(v) for v in words[1:4])
+            elif keyword in ("SCALARS", "VECTORS"):
+                header["dtype"] = {"float": ">f4", "double": ">f8", "int": ">i4", "char": ">i1",
+                                   "unsigned_char": ">u1"}[words[2]]
+                header["components"] = int(words[3]) if keyword == "SCALARS" and len(words) > 3 else (3 if keyword == "VECTORS" else 1)
+                if keyword == "VECTORS":
+                    header["offset"] = handle.tell()
+                    return header
+            elif keyword == "LOOKUP_TABLE":
+                header["offset"] = handle.tell()
+                return header
+
+# Function to memory-map a field export without reading it into RAM.
+def open_field(path, dimensions=None, components=3, dtype="<f4"):
+    """Return a read-only (Nz, Ny, Nx, components) memory map and the header of a VTK or raw field file.
+
+    Raw dumps have no header, so their dimensions (Nx, Ny, Nz), components and dtype must be given.
+    """
+    if path.lower().endswith(".vtk"):
+        header = read_vtk_header(path)
+    else:
+        if dimensions is None:
+            raise ValueError("Raw field files need their dimensions (Nx, Ny, Nz).")
+        header = {"dimensions": tuple(dimensions), "origin": (0.0, 0.0, 0.0), "spacing": (1.0, 1.0, 1.0),
+                  "dtype": dtype, "components": components, "offset": 0}
+    nx, ny, nz = header["dimensions"]
+    field = np.memmap(path, dtype=header["dtype"], mode="r", offset=header["offset"],
+                      shape=(nz, ny, nx, header["components"]))
+    return field, header
+
+# Function to write a velocity field as a binary VTK file in the FluidX3D layout.
+def write_vtk(path, velocity, spacing=1.0, origin=(0.0, 0.0, 0.0)):
+    """Write a (Nz, Ny, Nx, 3) array as a big-endian float VTK STRUCTURED_POINTS file."""
+    nz, ny, nx, components = velocity.shape
+    header = (f"# vtk DataFile Version 3.0\nFluidX3D\nBINARY\nDATASET STRUCTURED_POINTS\n"
+              f"DIMENSIONS {nx} {ny} {nz}\nORIGIN {origin[0]} {origin[1]} {origin[2]}\n"
+              f"SPACING {spacing} {spacing} {spacing}\nPOINT_DATA {nx * ny * nz}\n"
+              f"SCALARS data float {components}\nLOOKUP_TABLE default\n")
+    with open(path, "wb") as handle:
+        handle.write(header.encode("ascii"))
+        handle.write(np.ascontiguousarray(velocity, dtype=">f4").tobytes())
+
+# Function to compute the velocity gradient tensor of a slab with central differences.
+def velocity_gradient(u, spacing):
+    """Return grad[..., i, j] = du_i/dx_j for a (z, y, x, 3) block, with x, y, z in index order 0, 1, 2."""
+    grad = np.empty(u.shape[:3] + (3, 3), dtype=np.float32)
+    for i in range(3):
+        # np.gradient returns derivatives along z, y, x; reorder them to x, y, z
+        dz, dy, dx = np.gradient(u[..., i], spacing[2], spacing[1], spacing[0])
+        grad[..., i, 0], grad[..., i, 1], grad[..., i, 2] = dx, dy, dz
+    return grad
+
+# Function to compute Q-criterion and vorticity for one z slab, using a one-cell halo from its neighbours.
+def slab_q_vorticity(field, z0, z1, spacing):
+    """Return (Q, vorticity) for slices z0:z1 of a memory-mapped (Nz, Ny, Nx, 3) velocity field."""
+    lo, hi = max(z0 - 1, 0), min(z1 + 1, field.shape[0])
+    u = np.asarray(field[lo:hi, ..., :3], dtype=np.float32)
+    grad = velocity_gradient(u, spacing)[z0 - lo:z0 - lo + (z1 - z0)]
+    strain = 0.5 * (grad + np.swapaxes(grad, -1, -2))
+    rotation = 0.5 * (grad - np.swapaxes(grad, -1, -2))
+    q = 0.5 * (np.sum(rotation ** 2, axis=(-1, -2)) - np.sum(strain ** 2, axis=(-1, -2)))
+    vorticity = np.stack([grad[..., 2, 1] - grad[..., 1, 2],
+                          grad[..., 0, 2] - grad[..., 2, 0],
+                          grad[..., 1, 0] - grad[..., 0, 1]], axis=-1)
+    return q, vorticity
+
+# Function to iterate over a field in z slabs.
+def iter_slabs(field, slab=DEFAULT_SLAB):
+    for z0 in range(0, field.shape[0], slab):
+        yield z0, min(z0 + slab, field.shape[0])
+
+# Function to measure the vortex ring in one field export.
+def measure_ring(path, axis=1, q_threshold=None, slab=DEFAULT_SLAB, dimensions=None):
+    """Return the centroid, radius and circulation of the vortex ring in a field file.
+
+    The ring is taken to be the region where Q exceeds q_threshold (by default 10% of the maximum Q)
+    travelling along the given axis (0 = x, 1 = y, 2 = z; FluidX3D setups fire along y).
+    Positions are in the units of the file's SPACING.
+    """
+    field, header = open_field(path, dimensions)
+    spacing, origin = header["spacing"], header["origin"]
+    nz, ny, nx = field.shape[:3]
+
+    # First pass: maximum Q, so the default threshold adapts to the field
+    if q_threshold is None:
+        q_max = max(float(slab_q_vorticity(field, z0, z1, spacing)[0].max()) for z0, z1 in iter_slabs(field, slab))
+        q_threshold = 0.1 * q_max if q_max > 0 else np.inf
+
+    # Second pass: Q-weighted moments of the ring region
+    xs = origin[0] + spacing[0] * np.arange(nx)
+    ys = origin[1] + spacing[1] * np.arange(ny)
+    weight_sum = 0.0
+    first = np.zeros(3)
+    second = np.zeros(3)
+    for z0, z1 in iter_slabs(field, slab):
+        q, _ = slab_q_vorticity(field, z0, z1, spacing)
+        w = np.where(q > q_threshold, q, 0.0)
+        if not w.any():
+            continue
+        zs = origin[2] + spacing[2] * np.arange(z0, z1)
+        z, y, x = np.meshgrid(zs, ys, xs, indexing="ij")
+        weight_sum += w.sum()
+        for k, coordinate in enumerate((x, y, z)):
+            first[k] += (w * coordinate).sum()
+            second[k] += (w * coordinate ** 2).sum()
+    if weight_sum == 0:
+        return {"centroid": [np.nan] * 3, "radius": np.nan, "circulation": np.nan, "q_threshold": q_threshold}
+    centroid = first / weight_sum
+
+    # The core sits on a circle around the axis, so the radius follows from the in-plane second moments
+    in_plane = [k for k in range(3) if k != axis]
+    radius = float(np.sqrt(sum(second[k] / weight_sum - centroid[k] ** 2 for k in in_plane)))
+    circulation = ring_circulation(field, header, centroid, radius, axis)
+    return {"centroid": centroid.tolist(), "radius": radius, "circulation": circulation, "q_threshold": q_threshold}
+
+# Function to integrate the vorticity through a window around one side of the ring core.
+def ring_circulation(field, header, centroid, radius, axis=1):
+    """Return the circulation through the part of the plane containing the axis that surrounds one core.
+
+    The window reaches from a quarter to twice the ring radius away from the axis and one radius either side
+    along it, which keeps axis, wake and boundary vorticity out of the integral.
+    """
+    spacing, origin = header["spacing"], header["origin"]
+    nz, ny, nx = field.shape[:3]
+    xs = origin[0] + spacing[0] * np.arange(nx)
+    ys = origin[1] + spacing[1] * np.arange(ny)
+    zs = origin[2] + spacing[2] * np.arange(nz)
+    if axis == 2:
+        # Cut with the y-z plane through the centroid, whose normal is x
+        ix = min(max(int(round((centroid[0] - origin[0]) / spacing[0])), 0), nx - 1)
+        lo, hi = max(ix - 1, 0), min(ix + 2, nx)
+        grad = velocity_gradient(np.asarray(field[:, :, lo:hi, :3], dtype=np.float32), spacing)[:, :, ix - lo]
+        normal = grad[..., 2, 1] - grad[..., 1, 2]
+        cross, along = ys[None, :] - centroid[1], zs[:, None] - centroid[2]
+        area = spacing[1] * spacing[2]
+    else:
+        # Cut with the x-y plane through the centroid, whose normal is z
+        iz = min(max(int(round((centroid[2] - origin[2]) / spacing[2])), 0), nz - 1)
+        _, vorticity = slab_q_vorticity(field, iz, iz + 1, spacing)
+        normal = vorticity[0, ..., 2]
+        if axis == 1:
+            cross, along = xs[None, :] - centroid[0], ys[:, None] - centroid[1]
+        else:
+            cross, along = ys[:, None] - centroid[1], xs[None, :] - centroid[0]
+        area = spacing[0] * spacing[1]
+    window = (cross > 0.25 * radius) & (cross < 2 * radius) & (np.abs(along) < radius)
+    return float(np.abs((normal * window).sum() * area))
+
+# Function to parse the time step out of an export name such as u-000001000.vtk.
+def parse_step(path):
+    numbers = re.findall(r'\d+', os.path.basename(path))
+    return int(numbers[-1]) if numbers else 0
+
+# Function to track the vortex ring over a time series of exports.
+def track_ring(paths, dt=1.0, axis=1, q_threshold=None, slab=DEFAULT_SLAB, dimensions=None):
+    """Return one row per export with time, centroid, radius, translational speed and circulation.
+
+    Only one slab of one export is in memory at a time.
+    """
+    paths = sorted(paths, key=parse_step)
+    rows = []
+    for path in paths:
+        ring = measure_ring(path, axis, q_threshold, slab, dimensions)
+        rows.append({"file": os.path.basename(path), "time": parse_step(path) * dt,
+                     "x": ring["centroid"][0], "y": ring["centroid"][1], "z": ring["centroid"][2],
+                     "radius": ring["radius"], "circulation": ring["circulation"]})
+
+    # Translational speed along the axis from the centroid positions
+    if len(rows) > 1:
+        times = np.array([row["time"] for row in rows])
+        positions = np.array([row["xyz"[axis]] for row in rows])
+        speeds = np.gradient(positions, times)
+    else:
+        speeds = [np.nan] * len(rows)
+    for row, speed in zip(rows, speeds):
+        row["speed"] = float(speed)
+    return rows
+
+# Function to build an analytic vortex ring with Lamb-Oseen cores, for testing the tracker.
+def synthetic_vortex_ring(shape, center, radius, core, circulation, axis=1):
+    """Return a (Nz, Ny, Nx, 3) velocity field of a thin vortex ring around the given axis."""
+    nz, ny, nx = shape
+    z, y, x = np.meshgrid(np.arange(nz), np.arange(ny), np.arange(nx), indexing="ij")
+    position = np.stack([x - center[0], y - center[1], z - center[2]], axis=-1).astype(np.float64)
+    along = position[..., axis]
+    in_plane = position.copy()
+    in_plane[..., axis] = 0
+    rho = np.linalg.norm(in_plane, axis=-1)
+    radial = in_plane / np.maximum(rho, 1e-12)[..., None]
+    axis_vector = np.zeros(3)
+    axis_vector[axis] = 1.0
+
+    # Offset from the nearest point on the core circle, and the core tangent there
+    offset = (rho - radius)[..., None] * radial + along[..., None] * axis_vector
+    distance = np.linalg.norm(offset, axis=-1)
+    tangent = np.cross(axis_vector, radial)
+    swirl = circulation / (2 * np.pi * np.maximum(distance, 1e-12)) * (1 - np.exp(-(distance / core) ** 2))
+    direction = np.cross(tangent, offset / np.maximum(distance, 1e-12)[..., None])
+    return (swirl[..., None] * direction).astype(np.float32)
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Track the vortex ring in FluidX3D velocity field exports.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    track_parser = subparsers.add_parser('track', help='Track the ring over a series of exports.')
+    track_parser.add_argument('files', type=str, nargs='+', help='Velocity exports (.vtk or raw), or glob patterns.')
+    track_parser.add_argument('output_file', type=str, help='CSV file to save the ring track.')
+    track_parser.add_argument('--dt', type=float, default=1.0, help='Time per simulation step.')
+    track_parser.add_argument('--axis', type=int, default=1, choices=[0, 1, 2], help='Direction of travel (0 = x, 1 = y, 2 = z).')
+    track_parser.add_argument('--q-threshold', type=float, default=None, help='Q-criterion threshold of the ring region.')
+    track_parser.add_argument('--slab', type=int, default=DEFAULT_SLAB, help='Number of z slices processed at once.')
+    track_parser.add_argument('--dimensions', type=int, nargs=3, default=None, metavar=('NX', 'NY', 'NZ'), help='Grid size of raw exports.')
+    synthetic_parser = subparsers.add_parser('synthetic', help='Write a translating analytic vortex ring as VTK files.')
+    synthetic_parser.add_argument('output_dir', type=str, help='Directory to save the VTK files.')
+    synthetic_parser.add_argument('--size', type=int, nargs=3, default=[48, 96, 48], metavar=('NX', 'NY', 'NZ'), help='Grid size.')
+    synthetic_parser.add_argument('--steps', type=int, default=5, help='Number of exports.')
+    synthetic_parser.add_argument('--speed', type=float, default=4.0, help='Cells travelled per export.')
+    synthetic_parser.add_argument('--radius', type=float, default=10.0, help='Ring radius in cells.')
+    synthetic_parser.add_argument('--core', type=float, default=2.5, help='Core radius in cells.')
+    synthetic_parser.add_argument('--circulation', type=float, default=1.0, help='Ring circulation.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.command == 'synthetic':
+        os.makedirs(args.output_dir, exist_ok=True)
+        nx, ny, nz = args.size
+        for step in range(args.steps):
+            center = (nx / 2, ny / 4 + args.speed * step, nz / 2)
+            velocity = synthetic_vortex_ring((nz, ny, nx), center, args.radius, args.core, args.circulation)
+            write_vtk(os.path.join(args.output_dir, f"u-{step:09d}.vtk"), velocity)
+        print(f"{args.steps} synthetic vortex ring fields saved to {args.output_dir}")
+    else:
+        files = [path for pattern in args.files for path in (sorted(glob.glob(pattern)) or [pattern])]
+        rows = track_ring(files, args.dt, args.axis, args.q_threshold, args.slab, args.dimensions)
+        with open(args.output_file, "w", newline="") as handle:
+            writer = csv.DictWriter(handle, fieldnames=["file", "time", "x", "y", "z", "radius", "speed", "circulation"])
+            writer.writeheader()
+            writer.writerows(rows)
+        for row in rows:
+            print(f"{row['file']}: t={row['time']:g} centroid=({row['x']:.2f}, {row['y']:.2f}, {row['z']:.2f}) "
+                  f"R={row['radius']:.2f} U={row['speed']:.3f} Gamma={row['circulation']:.3f}")
+        print(f"Vortex ring track saved to {args.output_file}")
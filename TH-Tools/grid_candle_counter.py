@@ -5,9 +5,17 @@
 import tkinter as tk
 from tkinter import filedialog
 from PIL import Image, ImageTk
+import math
+import argparse
 import numpy as np
-import cv2
-import openpyxl
+import candle_detection
+import grid_registration
+import profiling
+
+# Editor display settings
+REDRAW_INTERVAL_MS = 16  # Coalesce drag redraws to roughly the display refresh rate
+MAX_DISPLAY_SIZE = 4096  # Large JPEGs are decoded at a reduced size for display
+MIN_PYRAMID_SIZE = 256  # Smallest zoom level kept in the image pyramid
 
 # Class that handles the grid adjustment for candle detection
 class GridAdjuster:
@@ -36,13 +44,24 @@ class GridAdjuster:
         self.pan_start = None
         self.image = None
         self.photo_image = None
+        self.pyramid = []  # Downsampled display images as (pixels per image pixel, image) pairs
+        self.image_item = None  # Persistent canvas items, moved with coords instead of recreated
+        self.image_key = None
+        self.point_items = []
+        self.line_items = []
+        self.point_lines = []
+        self.redraw_pending = False
+        self.dirty_points = set()
+        self.dirty_all = False
         self.grid_offset = [0, 0]  # Offset for panning the image
         self.scale = 1.0  # Scaling factor for zooming in/out
 
         # Set grid dimensions (rows and columns)
-        self.grid_rows = 6  
-        self.grid_cols = 10
+        self.grid_rows = candle_detection.GRID_ROWS
+        self.grid_cols = candle_detection.GRID_COLS
         self.candle_grid = None  # Placeholder for storing detected candle positions
+        self.image_path = None
+        self.reference = None  # (image path, grid points) of the last saved or loaded layout, for auto registration
 
         # Add buttons for various functionalities
         load_button = tk.Button(master, text="Load Image", command=self.load_image, bg=self.bg_color, fg=self.fg_color)
@@ -60,6 +79,9 @@ class GridAdjuster:
         load_layout_button = tk.Button(master, text="Load Grid Layout", command=self.load_grid_layout, bg=self.bg_color, fg=self.fg_color)
         load_layout_button.pack(side=tk.TOP, padx=10, pady=10)
 
+        auto_grid_button = tk.Button(master, text="Auto Grid", command=self.auto_grid, bg=self.bg_color, fg=self.fg_color)
+        auto_grid_button.pack(side=tk.TOP, padx=10, pady=10)
+
         # Bind mouse and keyboard events to their respective handlers
         self.canvas.bind("<ButtonPress-1>", self.on_click)
         self.canvas.bind("<B1-Motion>", self.on_drag)
@@ -67,6 +89,7 @@ class GridAdjuster:
         self.canvas.bind("<ButtonPress-2>", self.start_pan)
         self.canvas.bind("<B2-Motion>", self.pan_image)
         self.canvas.bind("<ButtonRelease-2>", self.end_pan)
+        self.canvas.bind("<Configure>", lambda event: self.schedule_redraw())
 
         self.master.bind("<Shift_L>", self.shift_pressed)
         self.master.bind("<KeyRelease-Shift_L>", self.shift_released)
@@ -87,38 +110,143 @@ class GridAdjuster:
 
     # Draw grid points and lines on the canvas
     def draw_grid_points(self):
-        self.canvas.delete("all")  # Clear the canvas
+        # Recreate the grid items only when the number of points changed
+        if len(self.point_items) != len(self.grid_points):
+            self.create_grid_items()
 
         # Draw the image on the canvas, if it exists
-        if self.image:
-            resized_image = self.image.resize((int(self.image.width * self.scale), int(self.image.height * self.scale)))
-            self.photo_image = ImageTk.PhotoImage(resized_image)
-            self.canvas.create_image(self.grid_offset[0], self.grid_offset[1], anchor="nw", image=self.photo_image, tags="image")
-
-        # Draw grid points and connecting lines
-        for i, (x, y) in enumerate(self.grid_points):
-            x = x * self.scale + self.grid_offset[0]
-            y = y * self.scale + self.grid_offset[1]
-            self.canvas.create_oval(x - 5, y - 5, x + 5, y + 5, fill=self.grid_color, outline=self.fg_color, tags="grid_point")
+        self.draw_image()
+        self.update_grid_items()
+
+    # Create one persistent canvas item per grid point and connecting line
+    def create_grid_items(self):
+        self.canvas.delete("grid_point")
+        self.line_items = []
+        self.point_lines = [[] for _ in self.grid_points]
+        for i in range(len(self.grid_points)):
+            neighbours = []
             if i % self.grid_cols != self.grid_cols - 1:
-                next_point = self.grid_points[i + 1]
-                nx, ny = next_point
-                nx = nx * self.scale + self.grid_offset[0]
-                ny = ny * self.scale + self.grid_offset[1]
-                self.canvas.create_line(x, y, nx, ny, fill=self.line_color, tags="grid_point")
+                neighbours.append(i + 1)
             if i < len(self.grid_points) - self.grid_cols:
-                next_point = self.grid_points[i + self.grid_cols]
-                nx, ny = next_point
-                nx = nx * self.scale + self.grid_offset[0]
-                ny = ny * self.scale + self.grid_offset[1]
-                self.canvas.create_line(x, y, nx, ny, fill=self.line_color, tags="grid_point")
+                neighbours.append(i + self.grid_cols)
+            for j in neighbours:
+                item = self.canvas.create_line(0, 0, 0, 0, fill=self.line_color, tags="grid_point")
+                self.point_lines[i].append(len(self.line_items))
+                self.point_lines[j].append(len(self.line_items))
+                self.line_items.append((item, i, j))
+        self.point_items = [
+            self.canvas.create_oval(0, 0, 0, 0, fill=self.grid_color, outline=self.fg_color, tags="grid_point")
+            for _ in self.grid_points
+        ]
+
+    # Move the grid items to the current point positions, optionally only around some points
+    def update_grid_items(self, indices=None):
+        if indices is None:
+            indices = range(len(self.grid_points))
+            lines = range(len(self.line_items))
+        else:
+            lines = {line for i in indices for line in self.point_lines[i]}
+
+        def to_canvas(i):
+            x, y = self.grid_points[i]
+            return x * self.scale + self.grid_offset[0], y * self.scale + self.grid_offset[1]
+
+        for i in indices:
+            x, y = to_canvas(i)
+            self.canvas.coords(self.point_items[i], x - 5, y - 5, x + 5, y + 5)
+        for line in lines:
+            item, i, j = self.line_items[line]
+            self.canvas.coords(item, *to_canvas(i), *to_canvas(j))
+
+    # Draw only the visible part of the image, taken from the closest pyramid level
+    def draw_image(self):
+        if not self.pyramid:
+            return
+        full_width, full_height = self.image.size
+        canvas_width = max(self.canvas.winfo_width(), 1)
+        canvas_height = max(self.canvas.winfo_height(), 1)
+
+        # Visible region in full-resolution image coordinates
+        x0 = max(0.0, -self.grid_offset[0] / self.scale)
+        y0 = max(0.0, -self.grid_offset[1] / self.scale)
+        x1 = min(full_width, (canvas_width - self.grid_offset[0]) / self.scale)
+        y1 = min(full_height, (canvas_height - self.grid_offset[1]) / self.scale)
+        if x1 <= x0 or y1 <= y0:
+            if self.image_item is not None:
+                self.canvas.itemconfig(self.image_item, state="hidden")
+            return
+
+        # Use the smallest level that still has at least one pixel per screen pixel
+        level_scale, level = next(((ls, im) for ls, im in reversed(self.pyramid) if ls >= self.scale), self.pyramid[0])
+        box = (int(x0 * level_scale), int(y0 * level_scale),
+               min(level.width, math.ceil(x1 * level_scale)), min(level.height, math.ceil(y1 * level_scale)))
+        size = (max(1, round((box[2] - box[0]) / level_scale * self.scale)),
+                max(1, round((box[3] - box[1]) / level_scale * self.scale)))
+
+        # Resample only when the visible region or zoom changed
+        key = (level_scale, box, size)
+        if key != self.image_key:
+            self.photo_image = ImageTk.PhotoImage(level.resize(size, box=box))
+            self.image_key = key
+            if self.image_item is None:
+                self.image_item = self.canvas.create_image(0, 0, anchor="nw", image=self.photo_image, tags="image")
+                self.canvas.tag_lower(self.image_item)
+            else:
+                self.canvas.itemconfig(self.image_item, image=self.photo_image)
+        self.canvas.itemconfig(self.image_item, state="normal")
+        self.canvas.coords(self.image_item,
+                           self.grid_offset[0] + box[0] / level_scale * self.scale,
+                           self.grid_offset[1] + box[1] / level_scale * self.scale)
+
+    # Queue a redraw for the next refresh, merging all events that arrive before it
+    def schedule_redraw(self, points=None):
+        if points is None:
+            self.dirty_all = True
+        else:
+            self.dirty_points.update(points)
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.master.after(REDRAW_INTERVAL_MS, self.flush_redraw)
+
+    # Perform the queued redraw
+    def flush_redraw(self):
+        self.redraw_pending = False
+        if self.dirty_all or len(self.point_items) != len(self.grid_points):
+            self.draw_grid_points()
+        elif self.dirty_points:
+            self.update_grid_items(self.dirty_points)
+        self.dirty_all = False
+        self.dirty_points = set()
+
+    # Build the display pyramid, decoding large JPEGs at a reduced size
+    def build_pyramid(self, image_path):
+        full_width, full_height = self.image.size
+        factor = max(1.0, max(full_width, full_height) / MAX_DISPLAY_SIZE)
+        with Image.open(image_path) as display:
+            display.draft("RGB", (int(full_width / factor), int(full_height / factor)))
+            level = display.convert("RGB")
+        if max(level.size) > MAX_DISPLAY_SIZE:
+            level.thumbnail((MAX_DISPLAY_SIZE, MAX_DISPLAY_SIZE))
+
+        self.pyramid = []
+        while True:
+            self.pyramid.append((level.width / full_width, level))
+            if max(level.size) <= MIN_PYRAMID_SIZE:
+                break
+            level = level.reduce(2)
+        self.image_key = None
 
     # Load an image and initialize the grid based on the image size
     def load_image(self):
         image_path = filedialog.askopenfilename(filetypes=[("Image files", "*.jpg *.jpeg *.png")])
         if image_path:
+            # The full image is only decoded when detecting; the editor draws from the pyramid
             self.image = Image.open(image_path)
+            self.image_path = image_path
             img_width, img_height = self.image.size
+            with profiling.span("build pyramid", file=image_path) as span:
+                self.build_pyramid(image_path)
+                span.count()
             self.grid_offset = [0, 0]  # Reset the offset whenever a new image is loaded
             self.scale = 1.0  # Reset the scale to 1.0
             self.canvas.config(scrollregion=(0, 0, img_width, img_height))
@@ -131,36 +259,14 @@ class GridAdjuster:
             print("No image loaded.")
             return
 
-        # Convert image to OpenCV format for processing
-        cv_image = np.array(self.image)
-        cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
-
-        hsv = cv2.cvtColor(cv_image, cv2.COLOR_BGR2HSV)
-        lower_orange = np.array([10, 120, 120])  # Loosened thresholds for better detection
-        upper_orange = np.array([30, 255, 255])
-        mask = cv2.inRange(hsv, lower_orange, upper_orange)
-
-        # Initialize an empty grid to store candle detection results
-        self.candle_grid = np.zeros((self.grid_rows - 1, self.grid_cols - 1), dtype=int)
-
-        # Iterate over each cell in the grid to detect candles
-        for row in range(self.grid_rows - 1):
-            for col in range(self.grid_cols - 1):
-                p1 = self.grid_points[row * self.grid_cols + col]
-                p2 = self.grid_points[row * self.grid_cols + col + 1]
-                p3 = self.grid_points[(row + 1) * self.grid_cols + col]
-                p4 = self.grid_points[(row + 1) * self.grid_cols + col + 1]
-
-                # Calculate the bounding box for the current grid cell
-                x_start = min(p1[0], p2[0], p3[0], p4[0]) * self.scale
-                y_start = min(p1[1], p2[1], p3[1], p4[1]) * self.scale
-                x_end = max(p1[0], p2[0], p3[0], p4[0]) * self.scale
-                y_end = max(p1[1], p2[1], p3[1], p4[1]) * self.scale
-
-                # Check if the cell contains any candle-like pixels
-                cell = mask[int(y_start):int(y_end), int(x_start):int(x_end)]
-                if np.any(cell > 0):
-                    self.candle_grid[row, col] = 1
+        # Run the shared detection on the loaded image
+        with profiling.span("decode image", file=self.image_path) as span:
+            rgb_image = np.array(self.image.convert("RGB"))
+            span.count()
+        with profiling.span("detect candles", file=self.image_path) as span:
+            self.candle_grid = candle_detection.detect_candles(
+                rgb_image, self.grid_points, self.grid_rows, self.grid_cols, self.scale)
+            span.count()
 
         print(f"Detected Candle Grid:\n{self.candle_grid}")
         self.prompt_candle_correction()  # Prompt the user for manual corrections
@@ -168,12 +274,12 @@ class GridAdjuster:
     # Zoom in by increasing the scale factor
     def zoom_in(self, event):
         self.scale *= 1.1
-        self.draw_grid_points()
+        self.schedule_redraw()
 
     # Zoom out by decreasing the scale factor
     def zoom_out(self, event):
         self.scale /= 1.1
-        self.draw_grid_points()
+        self.schedule_redraw()
 
     # Prompt the user to manually correct the candle detection grid
     def prompt_candle_correction(self):
@@ -214,15 +320,7 @@ class GridAdjuster:
         if not save_path:
             return
 
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-
-        # Write the grid data to the Excel sheet
-        for r in range(self.candle_grid.shape[0]):
-            for c in range(self.candle_grid.shape[1]):
-                sheet.cell(row=r + 1, column=c + 1, value=self.candle_grid[r, c])
-
-        workbook.save(save_path)
+        candle_detection.save_candle_grid(self.candle_grid, save_path)
         print(f"Candle grid saved to {save_path}")
 
     # Save the grid layout (positions of grid points) to a file
@@ -231,6 +329,8 @@ class GridAdjuster:
         if not layout_path:
             return
         np.save(layout_path, self.grid_points)
+        if self.image_path:
+            self.reference = (self.image_path, list(self.grid_points))
         print(f"Grid layout saved to {layout_path}")
 
     # Load a grid layout from a file
@@ -239,9 +339,35 @@ class GridAdjuster:
         if not layout_path:
             return
         self.grid_points = np.load(layout_path).tolist()
+        if self.image_path:
+            self.reference = (self.image_path, list(self.grid_points))
         self.draw_grid_points()
         print(f"Grid layout loaded from {layout_path}")
 
+    # Place the grid automatically, carrying over the last saved or loaded layout when there is one
+    def auto_grid(self):
+        if not self.image:
+            print("No image loaded.")
+            return
+
+        with profiling.span("decode image", file=self.image_path):
+            rgb_image = np.array(self.image.convert("RGB"))
+        reference_image = reference_points = None
+        if self.reference and self.reference[0] != self.image_path:
+            reference_image = candle_detection.load_image(self.reference[0])
+            reference_points = self.reference[1]
+        try:
+            with profiling.span("auto grid", file=self.image_path) as span:
+                grid_points, matched = grid_registration.auto_layout(rgb_image, self.grid_rows, self.grid_cols,
+                                                                     reference_image, reference_points)
+                span.count()
+        except ValueError as error:
+            print(f"Auto grid failed: {error}")
+            return
+        self.grid_points = [(float(x), float(y)) for x, y in grid_points]
+        self.draw_grid_points()
+        print(f"Auto grid placed ({matched} of {(self.grid_rows - 1) * (self.grid_cols - 1)} candles matched)")
+
     # Handle left mouse click event (select grid point or start panning)
     def on_click(self, event):
         if self.panning:
@@ -264,17 +390,17 @@ class GridAdjuster:
             self.grid_offset[0] += dx
             self.grid_offset[1] += dy
             self.pan_start = [event.x, event.y]
-            self.draw_grid_points()
+            self.schedule_redraw()
         elif self.shift_held and self.pan_start is not None:
             dx, dy = event.x - self.pan_start[0], event.y - self.pan_start[1]
             self.grid_points = [(x + dx / self.scale, y + dy / self.scale) for x, y in self.grid_points]
             self.pan_start = [event.x, event.y]
-            self.draw_grid_points()
+            self.schedule_redraw(range(len(self.grid_points)))
         elif self.selected_point is not None:
             new_x = (event.x - self.grid_offset[0]) / self.scale
             new_y = (event.y - self.grid_offset[1]) / self.scale
             self.grid_points[self.selected_point] = (new_x, new_y)
-            self.draw_grid_points()
+            self.schedule_redraw([self.selected_point])
 
     # End the dragging event (reset the panning start position)
     def end_drag(self, event):
@@ -292,7 +418,7 @@ class GridAdjuster:
             self.grid_offset[0] += dx
             self.grid_offset[1] += dy
             self.pan_start = [event.x, event.y]
-            self.draw_grid_points()
+            self.schedule_redraw()
 
     # End the panning event (reset the panning flag)
     def end_pan(self, event):
@@ -309,7 +435,18 @@ class GridAdjuster:
 
 # Main execution block to run the application
 if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Place the candle grid on a photo and count the lit candles.')
+    profiling.add_argument(parser)
+
+    # Parse the arguments
+    args = parser.parse_args()
+    if args.profile:
+        profiling.start("grid_candle_counter")
+
     root = tk.Tk()
     app = GridAdjuster(root)
     root.mainloop()
+    if args.profile:
+        profiling.finish(args.profile)
 
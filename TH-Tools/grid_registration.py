@@ -0,0 +1,227 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import argparse
+import numpy as np
+import cv2
+import candle_detection
+
+# Registration runs on a copy of the photo downscaled to this size along its longest side
+WORK_SIZE = 1024
+
+# Candle radius range as a fraction of the working image width (tea lights in TH-Media are about 2.5%)
+MIN_RADIUS = 0.015
+MAX_RADIUS = 0.035
+
+# Detections further than this from a lattice node, in candle spacings, are treated as clutter
+LATTICE_TOLERANCE = 0.3
+
+# Fewest ORB matches accepted for a homography
+MIN_MATCHES = 12
+
+# Function to make the grayscale working copy of a photo.
+def work_image(rgb_image, work_size=WORK_SIZE):
+    """Return (grayscale image, scale) where scale maps full-size pixel coordinates to the working copy."""
+    height, width = rgb_image.shape[:2]
+    scale = min(1.0, work_size / max(height, width))
+    gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+# Function to find the round candle bases, lit or not.
+def detect_candle_bases(rgb_image, work_size=WORK_SIZE, min_radius=MIN_RADIUS, max_radius=MAX_RADIUS):
+    """Return (centers, radii) of the candle-sized circles found in the photo, in full-size pixel coordinates."""
+    gray, scale = work_image(rgb_image, work_size)
+    width = gray.shape[1]
+    circles = cv2.HoughCircles(cv2.medianBlur(gray, 5), cv2.HOUGH_GRADIENT, dp=1, minDist=width * min_radius * 2,
+                               param1=80, param2=25, minRadius=int(width * min_radius), maxRadius=int(width * max_radius))
+    if circles is None:
+        return np.zeros((0, 2)), np.zeros(0)
+    circles = circles[0].astype(float) / scale
+    # Circles far from the typical candle size are clutter
+    radius = np.median(circles[:, 2])
+    circles = circles[np.abs(circles[:, 2] - radius) < 0.3 * radius]
+    return circles[:, :2], circles[:, 2]
+
+# Function to fit a homography from lattice coordinates (column, row) to pixels.
+def _fit_lattice(centers, homography, spacing, iterations=4):
+    """Return (homography, lattice indices, inlier mask) after snapping the centers to lattice nodes."""
+    inliers = np.zeros(len(centers), dtype=bool)
+    nodes = np.zeros((len(centers), 2))
+    for _ in range(iterations):
+        lattice = cv2.perspectiveTransform(centers[None].astype(np.float64), np.linalg.inv(homography))[0]
+        nodes = np.round(lattice)
+        inliers = np.all(np.abs(lattice - nodes) < LATTICE_TOLERANCE, axis=1)
+        if inliers.sum() < 4:
+            break
+        refit, _ = cv2.findHomography(nodes[inliers], centers[inliers], cv2.RANSAC, LATTICE_TOLERANCE * spacing)
+        if refit is None:
+            break
+        homography = refit
+    return homography, nodes.astype(int), inliers
+
+# Function to turn a lattice homography into grid points around the candles.
+def _grid_points(homography, grid_rows, grid_cols):
+    # Grid points sit half a spacing out from the candle centres, in the row-major order of initialize_grid
+    corners = np.array([(col - 0.5, row - 0.5) for row in range(grid_rows) for col in range(grid_cols)])
+    return cv2.perspectiveTransform(corners[None], homography)[0]
+
+# Function to choose the grid-sized block of lattice nodes holding the most detections.
+def _best_window(nodes, inliers, candle_rows, candle_cols):
+    best, best_count = (0, 0), -1
+    found = nodes[inliers]
+    if len(found) == 0:
+        raise ValueError("No candle bases lie on a common lattice.")
+    # Window origins run from the first node to the last that still fits; when the nodes span less than the grid,
+    # from the last origin whose window reaches the far nodes back to the first node, so every window covers them all
+    col_lo, col_hi = sorted((int(found[:, 0].min()), int(found[:, 0].max()) - candle_cols + 1))
+    row_lo, row_hi = sorted((int(found[:, 1].min()), int(found[:, 1].max()) - candle_rows + 1))
+    for col0 in range(col_lo, col_hi + 1):
+        for row0 in range(row_lo, row_hi + 1):
+            inside = ((found[:, 0] >= col0) & (found[:, 0] < col0 + candle_cols)
+                      & (found[:, 1] >= row0) & (found[:, 1] < row0 + candle_rows))
+            if inside.sum() > best_count:
+                best, best_count = (col0, row0), int(inside.sum())
+    return best
+
+# Function to fit the candle grid to the detected candle bases.
+def fit_grid(centers, grid_rows=candle_detection.GRID_ROWS, grid_cols=candle_detection.GRID_COLS):
+    """Return (grid points, candles matched) for a grid of grid_rows x grid_cols points fitted to the candle centres."""
+    candle_rows, candle_cols = grid_rows - 1, grid_cols - 1
+    if len(centers) < 4:
+        raise ValueError(f"Found only {len(centers)} candle bases.")
+
+    # The lattice directions are the medians of the nearest-neighbour steps that run across and down the photo
+    offsets = centers[None] - centers[:, None]
+    distances = np.linalg.norm(offsets, axis=2)
+    np.fill_diagonal(distances, np.inf)
+    nearest = np.argsort(distances, axis=1)[:, :4]
+    steps = offsets[np.arange(len(centers))[:, None], nearest].reshape(-1, 2)
+    across = steps[np.abs(steps[:, 0]) > np.abs(steps[:, 1])]
+    down = steps[np.abs(steps[:, 0]) <= np.abs(steps[:, 1])]
+    if len(across) == 0 or len(down) == 0:
+        raise ValueError("Candle bases do not form a grid.")
+    across = np.median(across * np.sign(across[:, :1]), axis=0)
+    down = np.median(down * np.sign(down[:, 1:]), axis=0)
+
+    # Start from an affine lattice through the detection nearest the middle and let the homography absorb perspective
+    origin = centers[np.argmin(np.linalg.norm(centers - np.median(centers, axis=0), axis=1))]
+    homography = np.array([[across[0], down[0], origin[0]], [across[1], down[1], origin[1]], [0, 0, 1]])
+    spacing = float(min(np.linalg.norm(across), np.linalg.norm(down)))
+    homography, nodes, inliers = _fit_lattice(centers, homography, spacing)
+
+    # Renumber the lattice so the best-covered block starts at (0, 0)
+    col0, row0 = _best_window(nodes, inliers, candle_rows, candle_cols)
+    shift = np.array([[1, 0, col0], [0, 1, row0], [0, 0, 1]], dtype=float)
+    homography, nodes, inliers = _fit_lattice(centers, homography @ shift, spacing)
+    return _grid_points(homography, grid_rows, grid_cols), _count_matched(nodes, inliers, grid_rows, grid_cols)
+
+# Function to count the detections that landed on a candle of the grid.
+def _count_matched(nodes, inliers, grid_rows, grid_cols):
+    return int(np.sum(inliers & (nodes[:, 0] >= 0) & (nodes[:, 0] < grid_cols - 1)
+                      & (nodes[:, 1] >= 0) & (nodes[:, 1] < grid_rows - 1)))
+
+# Function to snap an approximate grid onto the candle bases found in the photo.
+def refine_grid(rgb_image, grid_points, grid_rows=candle_detection.GRID_ROWS, grid_cols=candle_detection.GRID_COLS):
+    """Return (grid points, candles matched) after refitting a grid to the detected candles.
+
+    Only the correction between the grid's best-fit lattice and the refitted one is applied, so points
+    an operator placed off the lattice keep their offsets.
+    """
+    centers, _ = detect_candle_bases(rgb_image)
+    points = np.asarray(grid_points, dtype=float)
+    if len(centers) < 4:
+        return points, 0
+    corners = np.array([(col - 0.5, row - 0.5) for row in range(grid_rows) for col in range(grid_cols)])
+    initial, _ = cv2.findHomography(corners, points)
+    # Candle spacing from the grid itself: the shorter of the mean column and row steps
+    grid = points.reshape(grid_rows, grid_cols, 2)
+    spacing = float(min(np.linalg.norm(np.diff(grid, axis=1), axis=2).mean(),
+                        np.linalg.norm(np.diff(grid, axis=0), axis=2).mean()))
+    homography, nodes, inliers = _fit_lattice(centers, initial, spacing)
+    correction = homography @ np.linalg.inv(initial)
+    return cv2.perspectiveTransform(points[None], correction)[0], _count_matched(nodes, inliers, grid_rows, grid_cols)
+
+# Function to carry a labelled layout from a reference photo onto another photo of the same stand.
+def register_layout(reference_image, reference_points, rgb_image, work_size=WORK_SIZE):
+    """Return (grid points, matches used) with the reference layout warped onto rgb_image by an ORB homography."""
+    reference_gray, reference_scale = work_image(reference_image, work_size)
+    gray, scale = work_image(rgb_image, work_size)
+    points = np.asarray(reference_points, dtype=float)
+
+    # Only features on and around the candle tray are used, so a tray that moved on the table still registers
+    mask = np.zeros_like(reference_gray)
+    y0, y1, x0, x1 = candle_detection.grid_roi(points, reference_image.shape, reference_scale)
+    margin_y, margin_x = (y1 - y0) // 4, (x1 - x0) // 4
+    mask[max(0, y0 - margin_y):y1 + margin_y, max(0, x0 - margin_x):x1 + margin_x] = 255
+
+    orb = cv2.ORB_create(nfeatures=5000)
+    reference_keys, reference_descriptors = orb.detectAndCompute(reference_gray, mask)
+    keys, descriptors = orb.detectAndCompute(gray, None)
+    if reference_descriptors is None or descriptors is None:
+        raise ValueError("No features found to register the layout.")
+
+    # Lowe's ratio test keeps only distinctive matches
+    pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(reference_descriptors, descriptors, k=2)
+    good = [pair[0] for pair in pairs if len(pair) == 2 and pair[0].distance < 0.75 * pair[1].distance]
+    if len(good) < MIN_MATCHES:
+        raise ValueError(f"Only {len(good)} feature matches between the photos; need at least {MIN_MATCHES}.")
+    source = np.float32([reference_keys[m.queryIdx].pt for m in good])
+    target = np.float32([keys[m.trainIdx].pt for m in good])
+    homography, inliers = cv2.findHomography(source, target, cv2.RANSAC, 3.0)
+    if homography is None or inliers.sum() < MIN_MATCHES:
+        raise ValueError("Could not find a consistent homography between the photos.")
+
+    warped = cv2.perspectiveTransform(points[None] * reference_scale, homography)[0] / scale
+    return warped, int(inliers.sum())
+
+# Function to produce a layout for a photo, from a reference when there is one and from the candles otherwise.
+def auto_layout(rgb_image, grid_rows=candle_detection.GRID_ROWS, grid_cols=candle_detection.GRID_COLS,
+                reference_image=None, reference_points=None):
+    """Return (grid points, candles matched) for the photo."""
+    if reference_image is None:
+        centers, _ = detect_candle_bases(rgb_image)
+        return fit_grid(centers, grid_rows, grid_cols)
+    warped, _ = register_layout(reference_image, reference_points, rgb_image)
+    refined, matched = refine_grid(rgb_image, warped, grid_rows, grid_cols)
+    # Keep the plain warp when too few candles were found to trust the refit
+    if matched < (grid_rows - 1) * (grid_cols - 1) // 2:
+        return warped, matched
+    return refined, matched
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Fit candle grid layouts to photos automatically.')
+    parser.add_argument('images', type=str, nargs='+', help='Photos to lay out.')
+    parser.add_argument('output_dir', type=str, help='Directory to save a {photo}.npy layout for each photo.')
+    parser.add_argument('--reference', type=str, nargs=2, default=None, metavar=('IMAGE', 'LAYOUT'), help='Labelled photo and its saved layout to register from.')
+    parser.add_argument('--rows', type=int, default=candle_detection.GRID_ROWS, help='Number of grid point rows.')
+    parser.add_argument('--cols', type=int, default=candle_detection.GRID_COLS, help='Number of grid point columns.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Ensure output directory exists
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # Lay out every photo
+    reference_image = reference_points = None
+    if args.reference:
+        reference_image = candle_detection.load_image(args.reference[0])
+        reference_points = np.load(args.reference[1])
+    for image_path in args.images:
+        # One photo that cannot be laid out does not stop the rest
+        try:
+            grid_points, matched = auto_layout(candle_detection.load_image(image_path), args.rows, args.cols,
+                                               reference_image, reference_points)
+        except ValueError as error:
+            print(f"Skipped {image_path}: {error}")
+            continue
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        layout_file = os.path.join(args.output_dir, f"{stem}.npy")
+        np.save(layout_file, grid_points)
+        print(f"Layout for {image_path} saved to {layout_file} ({matched} of {(args.rows - 1) * (args.cols - 1)} candles matched)")
@@ -0,0 +1,332 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import math
+import zlib
+import struct
+import multiprocessing
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import profiling
+
+# ColorBrewer YlGnBu anchors, which matplotlib's YlGnBu interpolates linearly
+YLGNBU = ["#ffffd9", "#edf8b1", "#c7e9b4", "#7fcdbb", "#41b6c4", "#1d91c0", "#225ea8", "#253494", "#081d58"]
+
+# Output formats that hold one page per sheet instead of a single montage image
+MULTIPAGE_EXTENSIONS = (".pdf", ".tif", ".tiff")
+
+BACKENDS = ("matplotlib", "raster")
+
+# Class that draws heatmaps into one reusable Agg figure.
+class HeatmapRenderer:
+    """Render candle heatmaps, reusing the figure, colorbar and annotations between sheets of the same shape."""
+
+    def __init__(self):
+        # matplotlib and seaborn are only imported when this backend is used
+        with profiling.span("import matplotlib"):
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot
+            import seaborn
+            from seaborn.utils import relative_luminance
+        self.plt = matplotlib.pyplot
+        self.sns = seaborn
+        self.relative_luminance = relative_luminance
+
+        self.figure = None
+        self.mesh = None
+        self.texts = None
+        self.shape = None
+
+    # Build a fresh figure exactly the way the plotting scripts always have.
+    def _build(self, data):
+        if self.figure is not None:
+            self.plt.close(self.figure)
+        self.figure = self.plt.figure(figsize=(10, 8))
+        ax = self.sns.heatmap(data, cmap="YlGnBu", annot=True, fmt=".1f", cbar=True, vmin=0, vmax=1)
+        self.mesh = ax.collections[0]
+        self.texts = list(ax.texts)
+        self.shape = data.shape
+
+    # Swap the data and annotations of the existing figure in place.
+    def _update(self, data):
+        self.mesh.set_array(data.ravel())
+        self.mesh.update_scalarmappable()
+        for text, color, value in zip(self.texts, self.mesh.get_facecolors(), data.flat):
+            text.set_text(f"{value:.1f}")
+            text.set_color(".15" if self.relative_luminance(color) > .408 else "w")
+
+    # Render a single matrix with a title and save it to disk.
+    def render(self, data, title, output_file):
+        """Draw data as an annotated YlGnBu heatmap titled title and save it to output_file."""
+        data = np.asarray(data)
+        with profiling.span("seaborn heatmap", file=output_file) as span:
+            span.count()
+            # Masked (NaN) cells drop their annotation, so only plain grids of a known shape are updated in place
+            if self.figure is None or data.shape != self.shape or np.isnan(data).any():
+                self._build(data)
+            else:
+                self._update(data)
+            self.figure.axes[0].set_title(title)
+        with profiling.span("savefig", file=output_file) as span:
+            self.figure.savefig(output_file)
+            span.count()
+
+    # Release the figure once all sheets are rendered.
+    def close(self):
+        if self.figure is not None:
+            self.plt.close(self.figure)
+            self.figure = None
+
+# Function to build the YlGnBu lookup table.
+def ylgnbu_table(size=256):
+    """Return a (size, 3) uint8 RGB table running from 0 to 1 through the YlGnBu anchors."""
+    anchors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in YLGNBU], dtype=float)
+    positions = np.linspace(0, 1, len(anchors))
+    steps = np.linspace(0, 1, size)
+    return np.round(np.stack([np.interp(steps, positions, anchors[:, i]) for i in range(3)], axis=1)).astype(np.uint8)
+
+# Function to pick dark or light annotation text the way seaborn does.
+def text_colors(table):
+    """Return the annotation colour for each table entry: dark on light cells, white on dark ones."""
+    linear = table / 255.0
+    linear = np.where(linear <= .03928, linear / 12.92, ((linear + .055) / 1.055) ** 2.4)
+    luminance = linear @ np.array([.2126, .7152, .0722])
+    return np.where(luminance[:, None] > .408, np.array([38, 38, 38]), np.array([255, 255, 255])).astype(np.uint8)
+
+# Function to load a scalable font, falling back to the bitmap default on old Pillow versions.
+@lru_cache(maxsize=16)
+def load_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+# Function to rasterize one character once, on a cell as tall as the font's line.
+@lru_cache(maxsize=1024)
+def char_mask(char, size):
+    """Return (coverage mask, advance width) of a character drawn with its baseline at the font's ascent."""
+    font = load_font(size)
+    ascent, descent = font.getmetrics()
+    advance = font.getlength(char)
+    mask = Image.new("L", (math.ceil(advance) + size // 2, ascent + descent))
+    ImageDraw.Draw(mask).text((0, ascent), char, font=font, fill=255, anchor="ls")
+    return np.asarray(mask, dtype=np.float32) / 255, advance
+
+# Function to lay out a string from the cached characters.
+@lru_cache(maxsize=512)
+def glyph_mask(text, size):
+    """Return the string, each line centred, as a float coverage mask in [0, 1]."""
+    lines = []
+    for line in text.split("\n"):
+        glyphs = [char_mask(char, size) for char in line]
+        offsets = np.concatenate([[0], np.cumsum([advance for _, advance in glyphs])])
+        height = char_mask(" ", size)[0].shape[0]
+        mask = np.zeros((height, math.ceil(offsets[-1]) + size // 2 + 1), dtype=np.float32)
+        for (glyph, _), offset in zip(glyphs, offsets):
+            x = int(round(offset))
+            np.maximum(mask[:, x:x + glyph.shape[1]], glyph, out=mask[:, x:x + glyph.shape[1]])
+        # Trim the blank columns left of the first and right of the last stroke
+        used = np.nonzero(mask.any(axis=0))[0]
+        lines.append(mask[:, used[0]:used[-1] + 1] if used.size else mask[:, :1])
+    width = max(line.shape[1] for line in lines)
+    result = np.zeros((sum(line.shape[0] for line in lines), width), dtype=np.float32)
+    y = 0
+    for line in lines:
+        x = (width - line.shape[1]) // 2
+        result[y:y + line.shape[0], x:x + line.shape[1]] = line
+        y += line.shape[0]
+    return result
+
+# Function to paste a glyph mask centred on a point, clipping whatever falls outside the canvas.
+def blit(canvas, mask, center_x, center_y, color):
+    height, width = mask.shape
+    top, left = int(round(center_y - height / 2)), int(round(center_x - width / 2))
+    y0, x0 = max(top, 0), max(left, 0)
+    y1, x1 = min(top + height, canvas.shape[0]), min(left + width, canvas.shape[1])
+    if y1 <= y0 or x1 <= x0:
+        return
+    alpha = mask[y0 - top:y1 - top, x0 - left:x1 - left, None]
+    region = canvas[y0:y1, x0:x1]
+    region[:] = region * (1 - alpha) + np.asarray(color, dtype=np.float32) * alpha + 0.5
+
+# Function to write an RGB array as a PNG quickly.
+def write_png(output_file, rgb):
+    """Save a (height, width, 3) uint8 array as a PNG using the Up filter and fast zlib compression.
+
+    Heatmaps are mostly flat colour down each column, so Up-filtered rows are nearly all zeros and
+    compress well at level 1; Pillow's adaptive per-row filtering is most of its encoding time here.
+    """
+    height, width, _ = rgb.shape
+    rows = rgb.reshape(height, width * 3)
+    raw = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 0] = 2  # Up filter
+    raw[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=raw[1:, 1:])
+    data = zlib.compress(raw, 1)
+
+    def chunk(kind, payload):
+        return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+
+    with open(output_file, "wb") as handle:
+        handle.write(b"\x89PNG\r\n\x1a\n")
+        handle.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        handle.write(chunk(b"IDAT", data))
+        handle.write(chunk(b"IEND", b""))
+
+# Class that draws heatmaps straight into a NumPy buffer, without matplotlib.
+class RasterRenderer:
+    """Render annotated YlGnBu heatmaps with a colorbar and title at a fixed pixel size."""
+
+    def __init__(self, width=1000, height=800):
+        self.width = width
+        self.height = height
+        self.table = ylgnbu_table()
+        self.text_table = text_colors(self.table)
+        self.background = None
+
+    # Lay out the plot area, colorbar and tick labels for a grid shape; only redone when the shape changes.
+    def _layout(self, shape):
+        width, height = self.width, self.height
+        rows, cols = shape
+        x0, x1 = int(width * 0.1), int(width * 0.78)
+        y0, y1 = int(height * 0.12), int(height * 0.9)
+        self.col_edges = np.linspace(x0, x1, cols + 1).round().astype(int)
+        self.row_edges = np.linspace(y0, y1, rows + 1).round().astype(int)
+        self.label_size = max(8, int(min(np.diff(self.col_edges).min(), np.diff(self.row_edges).min()) * 0.22))
+
+        canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+        tick_size = max(8, int(height * 0.016))
+        tick_color = (38, 38, 38)
+        for r in range(rows):
+            blit(canvas, glyph_mask(str(r), tick_size), x0 - tick_size, (self.row_edges[r] + self.row_edges[r + 1]) / 2, tick_color)
+        for c in range(cols):
+            blit(canvas, glyph_mask(str(c), tick_size), (self.col_edges[c] + self.col_edges[c + 1]) / 2, y1 + tick_size, tick_color)
+
+        # Colorbar with 1 at the top, as in the seaborn plots
+        bar_x0, bar_x1 = int(width * 0.82), int(width * 0.85)
+        steps = np.linspace(len(self.table) - 1, 0, y1 - y0).round().astype(int)
+        canvas[y0:y1, bar_x0:bar_x1] = self.table[steps][:, None]
+        for tick in np.linspace(0, 1, 6):
+            y = y1 - tick * (y1 - y0)
+            canvas[int(min(y, y1 - 1)), bar_x1:bar_x1 + 4] = tick_color
+            blit(canvas, glyph_mask(f"{tick:.1f}", tick_size), bar_x1 + 6 + tick_size, y, tick_color)
+        self.background = canvas
+        self.shape = shape
+
+    # Draw one matrix and return it as an RGB array.
+    def draw(self, data, title):
+        """Return a (height, width, 3) uint8 image of data as an annotated heatmap with title above it."""
+        data = np.asarray(data, dtype=float)
+        if self.background is None or data.shape != self.shape:
+            self._layout(data.shape)
+        canvas = self.background.copy()
+        rows, cols = data.shape
+
+        # Fill every cell with its table colour, leaving missing cells blank, and annotate it from the cached
+        # glyphs as seaborn does
+        missing = np.isnan(data)
+        index = np.round(np.clip(np.nan_to_num(data), 0, 1) * (len(self.table) - 1)).astype(int)
+        for r in range(rows):
+            y0, y1 = self.row_edges[r], self.row_edges[r + 1]
+            for c in range(cols):
+                if missing[r, c]:
+                    continue
+                x0, x1 = self.col_edges[c], self.col_edges[c + 1]
+                canvas[y0:y1, x0:x1] = self.table[index[r, c]]
+                blit(canvas, glyph_mask(f"{data[r, c]:.1f}", self.label_size), (x0 + x1) / 2, (y0 + y1) / 2,
+                     self.text_table[index[r, c]])
+
+        title = glyph_mask(title, max(10, int(self.height * 0.022)))
+        blit(canvas, title, (self.col_edges[0] + self.col_edges[-1]) / 2, self.height * 0.02 + title.shape[0] / 2, (0, 0, 0))
+        return canvas
+
+    # Render a single matrix with a title and save it to disk.
+    def render(self, data, title, output_file):
+        """Draw data as an annotated YlGnBu heatmap titled title and save it to output_file."""
+        with profiling.span("raster draw", file=output_file) as span:
+            image = self.draw(data, title)
+            span.count()
+        with profiling.span("png encode", file=output_file) as span:
+            write_png(output_file, image)
+            span.count()
+
+    def close(self):
+        self.background = None
+
+# Function to create the renderer of a backend.
+def make_renderer(backend="matplotlib"):
+    if backend == "raster":
+        return RasterRenderer()
+    if backend == "matplotlib":
+        return HeatmapRenderer()
+    raise ValueError(f"Unknown heatmap backend {backend}; expected one of {', '.join(BACKENDS)}.")
+
+# Function to draw every sheet into one file: a tiled montage, or one page per sheet for PDF and TIFF.
+def render_montage(jobs, output_file, columns=None, tile_size=(500, 400)):
+    """Render the (data, title) jobs with the raster backend into output_file and return it."""
+    jobs = list(jobs)
+    if not jobs:
+        raise ValueError("No heatmaps to put in the montage.")
+    if output_file.lower().endswith(MULTIPAGE_EXTENSIONS):
+        renderer = RasterRenderer()
+        with profiling.span("raster draw") as span:
+            pages = [Image.fromarray(renderer.draw(data, title)) for data, title in jobs]
+            span.count(len(pages))
+        with profiling.span("save multipage", file=output_file):
+            pages[0].save(output_file, save_all=True, append_images=pages[1:])
+        return output_file
+
+    renderer = RasterRenderer(*tile_size)
+    columns = columns or math.ceil(math.sqrt(len(jobs)))
+    rows = math.ceil(len(jobs) / columns)
+    width, height = tile_size
+    montage = np.full((rows * height, columns * width, 3), 255, dtype=np.uint8)
+    with profiling.span("raster draw") as span:
+        for i, (data, title) in enumerate(jobs):
+            row, col = divmod(i, columns)
+            montage[row * height:(row + 1) * height, col * width:(col + 1) * width] = renderer.draw(data, title)
+            span.count()
+    with profiling.span("png encode", file=output_file):
+        if output_file.lower().endswith(".png"):
+            write_png(output_file, montage)
+        else:
+            Image.fromarray(montage).save(output_file)
+    return output_file
+
+# Per-process renderer used by the worker pool.
+_worker_renderer = None
+
+def _init_worker(backend="matplotlib", profile_origin=None):
+    global _worker_renderer
+    profiling.start_worker(profile_origin)
+    _worker_renderer = make_renderer(backend)
+
+def _render_job(job):
+    data, title, output_file = job
+    _worker_renderer.render(data, title, output_file)
+    # The spans recorded here travel back with the result and are merged into the parent's profile
+    return output_file, profiling.take_events()
+
+# Function to render a list of (data, title, output_file) jobs, optionally over a process pool.
+def render_heatmaps(jobs, n_jobs=1, backend="matplotlib"):
+    """Render every job with the given backend and yield the output file of each in order."""
+    jobs = list(jobs)
+    if n_jobs <= 1 or len(jobs) <= 1:
+        renderer = make_renderer(backend)
+        try:
+            for data, title, output_file in jobs:
+                renderer.render(data, title, output_file)
+                yield output_file
+        finally:
+            renderer.close()
+        return
+
+    # Hand each worker a contiguous run of sheets so its figure is reused as much as possible
+    chunksize = max(1, len(jobs) // n_jobs)
+    with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(backend, profiling.worker_origin())) as pool:
+        for output_file, events in pool.imap(_render_job, jobs, chunksize=chunksize):
+            profiling.merge(events)
+            yield output_file
@@ -0,0 +1,183 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import json
+import time
+import argparse
+import numpy as np
+import openpyxl
+import catalog
+import trial_cube
+
+# Model parameters with the bounds used when fitting. Lengths are in candle column spacings, distances in feet.
+#   strength     peak ring velocity at the launcher relative to the velocity that blows a candle out
+#   radius       ring radius at the launcher
+#   growth       radius gained per foot travelled (entrainment)
+#   decay        exponent of the velocity loss as the ring grows, U ~ (radius / R) ** decay
+#   range        distance at which the ring breaks down
+#   breakup      distance over which the breakdown happens
+#   softness     width of the blow-out threshold, covering flame-to-flame scatter
+#   aspect       row spacing relative to column spacing as seen by the ring
+#   center_row   row the ring axis passes through
+#   center_col   column the ring axis passes through
+PARAMETERS = [
+    ("strength", 0.5, 20.0),
+    ("radius", 0.2, 6.0),
+    ("growth", 0.0, 3.0),
+    ("decay", 0.0, 4.0),
+    ("range", 2.0, 15.0),
+    ("breakup", 0.05, 3.0),
+    ("softness", 0.02, 1.0),
+    ("aspect", 0.0, 1.5),
+    ("center_row", 0.0, 4.0),
+    ("center_col", 0.0, 8.0),
+]
+PARAMETER_NAMES = [name for name, _, _ in PARAMETERS]
+
+# Candle grid of the test stand
+GRID_SHAPE = (5, 9)
+
+# Parameter sets evaluated together, to keep the broadcast arrays small
+CHUNK_SIZE = 2048
+
+# Function to average the measured candle matrices of one prototype.
+def load_observations(data_root, prototype, cube_dir=None):
+    """Return (sheet names, distances in feet, mean lit fraction (D, rows, cols), trial count) for a prototype."""
+    per_sheet = {}
+    for trial, proto, path in trial_cube.find_trial_workbooks(data_root):
+        if proto != prototype:
+            continue
+        sheets = trial_cube.read_workbook_sheets(cube_dir, path) if cube_dir else trial_cube.parse_workbook(path).items()
+        for name, matrix in sheets:
+            per_sheet.setdefault(name, []).append(np.asarray(matrix, dtype=float))
+    if not per_sheet:
+        raise ValueError(f"No trial workbooks for prototype {prototype} under {data_root}")
+    names = sorted(per_sheet, key=lambda name: catalog.parse_distance(name, float('inf')))
+    counts = {len(per_sheet[name]) for name in names}
+    observed = np.stack([np.mean(per_sheet[name], axis=0) for name in names])
+    return names, np.array([catalog.parse_distance(name, float('inf')) for name in names]), observed, min(counts)
+
+# Function to evaluate many parameter sets at once.
+def predict(params, distances, grid_shape=GRID_SHAPE):
+    """Return the probability that each candle stays lit, shape (sets, distances, rows, cols).
+
+    The ring leaves the launcher with radius R0 and grows linearly with distance while its velocity
+    falls as (R0 / R) ** decay, until it breaks down around range. The velocity it induces at a
+    candle falls off as a Gaussian of the candle's distance from the ring axis scaled by R, and a
+    candle goes out when that velocity passes the blow-out threshold, smoothed by a logistic of
+    width softness.
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=np.float32))
+    distances = np.asarray(distances, dtype=np.float32)
+    (strength, radius, growth, decay, ring_range, breakup, softness, aspect,
+     center_row, center_col) = (params[:, i, None] for i in range(len(PARAMETERS)))
+
+    ring_radius = radius + growth * distances
+    velocity = strength * (radius / ring_radius) ** decay * (0.5 - 0.5 * np.tanh((distances - ring_range) / breakup))
+
+    rows, cols = np.indices(grid_shape, dtype=np.float32)
+    offset_sq = (aspect[..., None] * (rows[None] - center_row[..., None])) ** 2 + (cols[None] - center_col[..., None]) ** 2
+    local = velocity[..., None, None] * np.exp(-offset_sq[:, None] / ring_radius[..., None, None] ** 2)
+    # Logistic written with tanh so it cannot overflow
+    return 0.5 + 0.5 * np.tanh((1 - local) / (2 * softness[..., None, None]))
+
+# Function to score parameter sets against the measured lit fractions.
+def loss(params, distances, observed, eps=1e-6):
+    """Return the mean binary cross-entropy of every parameter set, evaluated in chunks."""
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    result = np.empty(len(params))
+    for start in range(0, len(params), CHUNK_SIZE):
+        lit = np.clip(predict(params[start:start + CHUNK_SIZE], distances, observed.shape[1:]), eps, 1 - eps)
+        cross_entropy = -(observed * np.log(lit) + (1 - observed) * np.log(1 - lit))
+        result[start:start + CHUNK_SIZE] = cross_entropy.mean(axis=(1, 2, 3))
+    return result
+
+# Function to fit the model with the cross-entropy method, which only needs batched evaluations.
+def fit(distances, observed, population=4000, iterations=40, elite_fraction=0.02, seed=0):
+    """Return (best parameters, best loss, loss per iteration) for the measured lit fractions."""
+    rng = np.random.default_rng(seed)
+    low = np.array([lo for _, lo, _ in PARAMETERS])
+    high = np.array([hi for _, _, hi in PARAMETERS])
+    mean = (low + high) / 2
+    std = (high - low) / 2
+    elite = max(2, int(population * elite_fraction))
+    best, best_loss, history = None, np.inf, []
+
+    for _ in range(iterations):
+        samples = np.clip(rng.normal(mean, std, (population, len(PARAMETERS))), low, high)
+        if best is not None:
+            samples[0] = best
+        scores = loss(samples, distances, observed)
+        order = np.argsort(scores)[:elite]
+        if scores[order[0]] < best_loss:
+            best, best_loss = samples[order[0]].copy(), float(scores[order[0]])
+        # Refit the sampling distribution to the elite, keeping a little spread so it does not collapse early
+        mean = samples[order].mean(axis=0)
+        std = np.maximum(samples[order].std(axis=0), (high - low) * 1e-3)
+        history.append(best_loss)
+    return best, best_loss, history
+
+# Function to write predicted matrices in the layout of a T{n}P{m}.xlsx workbook, so the plot scripts can read them.
+def save_prediction(lit, sheet_names, output_file):
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for name, matrix in zip(sheet_names, lit):
+        sheet = workbook.create_sheet(title=name)
+        for row in matrix:
+            sheet.append([round(float(value), 4) for value in row])
+    workbook.save(output_file)
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Fit and evaluate a reduced-order vortex-ring knockdown model.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    fit_parser = subparsers.add_parser('fit', help='Fit the model to the measured prototypes.')
+    fit_parser.add_argument('data_root', type=str, help='Path to the TH-Data directory.')
+    fit_parser.add_argument('output', type=str, help='Path to save the fitted parameters as JSON.')
+    fit_parser.add_argument('--prototypes', type=int, nargs='+', default=[1, 2, 3, 4], help='Prototypes to fit.')
+    fit_parser.add_argument('--cube', type=str, default=None, help='Trial cube directory to read the matrices from.')
+    fit_parser.add_argument('--population', type=int, default=4000, help='Parameter sets evaluated per iteration.')
+    fit_parser.add_argument('--iterations', type=int, default=40, help='Number of fitting iterations.')
+    fit_parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    predict_parser = subparsers.add_parser('predict', help='Write the predicted candle grids of a fitted prototype.')
+    predict_parser.add_argument('params_file', type=str, help='JSON file written by the fit command.')
+    predict_parser.add_argument('prototype', type=int, help='Prototype whose parameters to use.')
+    predict_parser.add_argument('output_file', type=str, help='Path to save the predicted workbook.')
+    predict_parser.add_argument('--set', type=str, action='append', default=[], metavar='NAME=VALUE', help='Override a parameter.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.command == 'fit':
+        # Fit every prototype and report the fit quality
+        results = {"parameters": PARAMETER_NAMES, "prototypes": {}}
+        for prototype in args.prototypes:
+            names, distances, observed, trials = load_observations(args.data_root, prototype, args.cube)
+            start = time.perf_counter()
+            best, best_loss, _ = fit(distances, observed, args.population, args.iterations, seed=args.seed)
+            elapsed = time.perf_counter() - start
+            rmse = float(np.sqrt(np.mean((predict(best, distances)[0] - observed) ** 2)))
+            per_eval = elapsed / (args.population * args.iterations) * 1e6
+            results["prototypes"][str(prototype)] = {"values": dict(zip(PARAMETER_NAMES, best.tolist())),
+                                                     "loss": best_loss, "rmse": rmse, "trials": trials, "sheets": names}
+            print(f"P{prototype}: loss {best_loss:.4f}, RMSE {rmse:.3f} over {trials} trials "
+                  f"({elapsed:.2f}s, {per_eval:.1f}us per parameter set)")
+            print("    " + ", ".join(f"{name}={value:.3f}" for name, value in zip(PARAMETER_NAMES, best)))
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
+        print(f"Fitted parameters saved to {args.output}")
+    else:
+        # Predict the grids of one prototype, optionally with some parameters changed
+        with open(args.params_file) as handle:
+            fitted = json.load(handle)["prototypes"][str(args.prototype)]
+        values = dict(fitted["values"])
+        for override in args.set:
+            name, value = override.split("=")
+            if name not in values:
+                raise SystemExit(f"Unknown parameter {name}; expected one of {', '.join(PARAMETER_NAMES)}")
+            values[name] = float(value)
+        distances = [catalog.parse_distance(name, float('inf')) for name in fitted["sheets"]]
+        lit = predict([values[name] for name in PARAMETER_NAMES], distances)[0]
+        save_prediction(lit, fitted["sheets"], args.output_file)
+        print(f"Predicted candle grids saved to {args.output_file}")
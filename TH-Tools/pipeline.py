@@ -0,0 +1,343 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import io
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+import numpy as np
+import catalog
+import compile_excel
+import heatmap_render
+
+# Directory of the stage cache, relative to the repository root
+CACHE_DIR = ".pipeline-cache"
+STATE_FILE = "state.json"
+
+# Bump when a stage changes what it writes so cached outputs are not reused
+CACHE_VERSION = 1
+
+# Grid layout saved from the grid candle counter; photos are only detected in image folders that have one
+LAYOUT_FILE = "grid_layout.npy"
+
+TRIAL_DIR = re.compile(r'^T(\d+)P(\d+)$')
+IMAGE_DIR = re.compile(r'^T(\d+)P(\d+)Images$')
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Class describing one step of the pipeline and the files it reads and writes.
+class Stage:
+    """A named call of function(root, *args) that reads inputs and writes outputs, all relative to root."""
+
+    def __init__(self, name, function, args, inputs, outputs):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.inputs = sorted(inputs)
+        self.outputs = sorted(outputs)
+
+# Stage functions. Paths are relative to root so the cache does not depend on where the repository lives.
+def detect_stage(root, photo, layout_file, output_dir):
+    import batch_detect
+    import candle_detection
+
+    grid_points = np.load(os.path.join(root, layout_file)).tolist()
+    os.makedirs(os.path.join(root, output_dir), exist_ok=True)
+    batch_detect.process_image((os.path.join(root, photo), grid_points, candle_detection.GRID_ROWS,
+                                candle_detection.GRID_COLS, os.path.join(root, output_dir), False, None))
+
+def compile_stage(root, dist_dir, output_file):
+    compile_excel.compile_excel_files(os.path.join(root, dist_dir), os.path.join(root, output_file))
+
+def plot_stage(root, workbook, plots_dir, backend):
+    import plot_single
+
+    plot_single.plot_heatmaps(os.path.join(root, workbook), os.path.join(root, plots_dir), backend=backend)
+
+def average_stage(root, workbooks, plots_dir, backend):
+    import plot_average
+
+    plot_average.plot_average_heatmaps([os.path.join(root, w) for w in workbooks], os.path.join(root, plots_dir),
+                                       backend=backend)
+
+# Function to name the sheets a compiled workbook will have, the way compile_excel names them.
+def sheet_names(root, dist_files, workbook):
+    if dist_files:
+        names = [os.path.splitext(os.path.basename(f))[0].split('-')[-1].strip() for f in dist_files]
+        return sorted(names, key=compile_excel.extract_numbers)
+    return catalog.read_sheet_names(os.path.join(root, workbook))
+
+# Function to declare the stages for the TH-Data and TH-Media layout.
+def build_graph(root, backend="matplotlib"):
+    """Return the list of stages: detect per photo, compile and plot per trial, average per prototype.
+
+    A photo whose per-distance workbook already exists and was not written by the pipeline is not
+    detected: that workbook was counted by hand and is used as it is.
+    """
+    stages = []
+    detected = {}
+    produced = PipelineCache(root).produced()
+
+    # Candle detection, for every photo in an image folder with a saved grid layout
+    media_root = os.path.join(root, "TH-Media")
+    for entry in sorted(os.listdir(media_root)) if os.path.isdir(media_root) else []:
+        match = IMAGE_DIR.match(entry)
+        layout_file = f"TH-Media/{entry}/{LAYOUT_FILE}"
+        if not match or not os.path.exists(os.path.join(root, layout_file)):
+            continue
+        dist_dir = f"TH-Data/T{match.group(1)}P{match.group(2)}/Data/Dist"
+        for file_name in sorted(os.listdir(os.path.join(media_root, entry))):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                stem = os.path.splitext(file_name)[0]
+                output_file = f"{dist_dir}/{stem}.xlsx"
+                if os.path.exists(os.path.join(root, output_file)) and output_file not in produced:
+                    continue
+                stages.append(Stage(f"detect {stem}", detect_stage, (f"TH-Media/{entry}/{file_name}", layout_file, dist_dir),
+                                    [f"TH-Media/{entry}/{file_name}", layout_file], [output_file]))
+                detected.setdefault(dist_dir, []).append(output_file)
+
+    # Compiling the per-distance workbooks of each trial, and plotting the compiled workbook
+    per_prototype = {}
+    data_root = os.path.join(root, "TH-Data")
+    for entry in sorted(os.listdir(data_root)):
+        match = TRIAL_DIR.match(entry)
+        if not match:
+            continue
+        workbook = f"TH-Data/{entry}/Data/{entry}.xlsx"
+        dist_dir = f"TH-Data/{entry}/Data/Dist"
+        dist_files = set(detected.get(dist_dir, []))
+        if os.path.isdir(os.path.join(root, dist_dir)):
+            dist_files |= {f"{dist_dir}/{f}" for f in os.listdir(os.path.join(root, dist_dir)) if f.endswith((".xlsx", ".xls"))}
+        if dist_files:
+            stages.append(Stage(f"compile {entry}", compile_stage, (dist_dir, workbook), dist_files, [workbook]))
+        elif not os.path.exists(os.path.join(root, workbook)):
+            continue
+
+        names = sheet_names(root, sorted(dist_files), workbook)
+        plots_dir = f"TH-Data/{entry}/Plots"
+        stages.append(Stage(f"plot {entry}", plot_stage, (workbook, plots_dir, backend), [workbook],
+                            [f"{plots_dir}/{name}_heatmap.png" for name in names]))
+        per_prototype.setdefault(int(match.group(2)), []).append((workbook, names))
+
+    # Averaging the trials of each prototype
+    for prototype, trials in sorted(per_prototype.items()):
+        workbooks = [workbook for workbook, _ in trials]
+        plots_dir = f"TH-Data/P{prototype}AveragedPlots"
+        outputs = [f"{plots_dir}/{name}_average_heatmap.png" for name in trials[0][1]]
+        outputs += [f"{plots_dir}/{name}" for name in ("average_std.xlsx", "average_ci.xlsx", "average_scores.csv")]
+        stages.append(Stage(f"average P{prototype}", average_stage, (workbooks, plots_dir, backend), workbooks, outputs))
+    return stages
+
+# Class that keeps the content hashes of files and the outputs of every stage ever run.
+class PipelineCache:
+    """Content-addressed store under cache_dir: outputs are kept by hash so any earlier result can be restored."""
+
+    def __init__(self, root, cache_dir=CACHE_DIR):
+        self.root = root
+        self.cache_dir = os.path.join(root, cache_dir)
+        self.state = {"version": CACHE_VERSION, "hashes": {}, "stages": {}}
+        state_path = os.path.join(self.cache_dir, STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path) as handle:
+                state = json.load(handle)
+            if state.get("version") == CACHE_VERSION:
+                self.state = state
+
+    # Hash a file, re-reading it only when its size or modification time changed.
+    def file_hash(self, path):
+        stat = os.stat(os.path.join(self.root, path))
+        known = self.state["hashes"].get(path)
+        if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = catalog.file_hash(os.path.join(self.root, path))
+        self.state["hashes"][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def produced(self):
+        """Return the paths any stage has ever written."""
+        return set(self.state.get("produced", {}))
+
+    def stage_key(self, stage):
+        """Return the hash of the stage's function, arguments and input contents."""
+        description = {"version": CACHE_VERSION, "function": stage.function.__name__, "args": stage.args,
+                       "inputs": {path: self.file_hash(path) for path in stage.inputs}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, "stages", f"{key}.json")
+
+    def is_current(self, stage, key):
+        """Return whether the stage last ran on these inputs and its outputs are still there."""
+        return (self.state["stages"].get(stage.name) == key
+                and all(os.path.exists(os.path.join(self.root, path)) for path in stage.outputs))
+
+    def restore(self, stage, key):
+        """Copy the stage's outputs for these inputs back from the store, returning False if they are not all there."""
+        if not os.path.exists(self._entry_path(key)):
+            return False
+        with open(self._entry_path(key)) as handle:
+            outputs = json.load(handle)
+        if set(outputs) != set(stage.outputs) or not all(os.path.exists(self._object_path(d)) for d in outputs.values()):
+            return False
+        for path, digest in outputs.items():
+            full_path = os.path.join(self.root, path)
+            if os.path.exists(full_path) and self.file_hash(path) == digest:
+                continue
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            shutil.copyfile(self._object_path(digest), full_path)
+        self.state["stages"][stage.name] = key
+        self.state.setdefault("produced", {}).update(dict.fromkeys(stage.outputs, stage.name))
+        return True
+
+    def store(self, stage, key):
+        """Record the outputs the stage just wrote under the key of its inputs."""
+        outputs = {}
+        for path in stage.outputs:
+            if not os.path.exists(os.path.join(self.root, path)):
+                raise FileNotFoundError(f"Stage {stage.name} did not write {path}")
+            digest = self.file_hash(path)
+            object_path = self._object_path(digest)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                shutil.copyfile(os.path.join(self.root, path), object_path + ".tmp")
+                os.replace(object_path + ".tmp", object_path)
+            outputs[path] = digest
+        os.makedirs(os.path.dirname(self._entry_path(key)), exist_ok=True)
+        with open(self._entry_path(key), "w") as handle:
+            json.dump(outputs, handle, indent=2)
+        self.state["stages"][stage.name] = key
+        self.state.setdefault("produced", {}).update(dict.fromkeys(stage.outputs, stage.name))
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = os.path.join(self.cache_dir, STATE_FILE + ".tmp")
+        with open(tmp_path, "w") as handle:
+            json.dump(self.state, handle)
+        os.replace(tmp_path, os.path.join(self.cache_dir, STATE_FILE))
+
+# Function to run one stage in a worker, returning what it printed.
+def run_stage(job):
+    root, name, function, args = job
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        function(root, *args)
+    return name, output.getvalue()
+
+# Function to bring every stage up to date, running independent stages in parallel.
+def run_pipeline(root, stages, n_jobs=1, verbose=False):
+    """Run the stages whose inputs changed, in dependency order, and return the names of those run and restored."""
+    cache = PipelineCache(root)
+    produced_by = {path: stage.name for stage in stages for path in stage.outputs}
+    depends = {stage.name: {produced_by[path] for path in stage.inputs if path in produced_by} for stage in stages}
+    pending = list(stages)
+    finished = set()
+    ran, restored = [], []
+
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        while pending:
+            # Every stage whose upstream stages are finished can run at the same time
+            ready = [stage for stage in pending if depends[stage.name] <= finished]
+            if not ready:
+                raise ValueError("The pipeline stages depend on each other in a cycle: "
+                                 + ", ".join(stage.name for stage in pending))
+            work = []
+            for stage in ready:
+                missing = [path for path in stage.inputs if not os.path.exists(os.path.join(root, path))]
+                if missing:
+                    raise FileNotFoundError(f"Stage {stage.name} is missing its input {missing[0]}")
+                key = cache.stage_key(stage)
+                if cache.is_current(stage, key):
+                    continue
+                if cache.restore(stage, key):
+                    restored.append(stage.name)
+                    print(f"Restored {stage.name} from the cache")
+                    continue
+                work.append((stage, key))
+
+            jobs = [(root, stage.name, stage.function, stage.args) for stage, _ in work]
+            results = pool.imap(run_stage, jobs) if pool and len(jobs) > 1 else map(run_stage, jobs)
+            for (stage, key), (name, output) in zip(work, results):
+                cache.store(stage, key)
+                ran.append(name)
+                print(f"Ran {name}")
+                if verbose and output:
+                    print(output.rstrip())
+            # Save after every wave so an interrupted run keeps the stages it finished
+            cache.save()
+
+            finished |= {stage.name for stage in ready}
+            pending = [stage for stage in pending if stage.name not in finished]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return ran, restored
+
+# Function to fingerprint the files the stages read, to notice new photos and edited sheets.
+def source_fingerprint(root, stages):
+    """Return {path: (size, mtime)} of every stage input, including inputs another stage wrote.
+
+    A hand-corrected output of one stage changes the input hashes of the stages after it, so those are
+    rebuilt while the stage that wrote it keeps the correction.
+    """
+    fingerprint = {}
+    for stage in stages:
+        for path in stage.inputs:
+            if os.path.exists(os.path.join(root, path)):
+                stat = os.stat(os.path.join(root, path))
+                fingerprint[path] = (stat.st_size, stat.st_mtime_ns)
+    return fingerprint
+
+# Function to re-run the affected stages whenever a source file appears, changes or disappears.
+def watch(root, n_jobs=1, backend="matplotlib", interval=2.0, verbose=False):
+    stages = build_graph(root, backend)
+    run_pipeline(root, stages, n_jobs, verbose)
+    fingerprint = source_fingerprint(root, stages)
+    print(f"Watching {len(fingerprint)} input files, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(interval)
+            stages = build_graph(root, backend)
+            current = source_fingerprint(root, stages)
+            if current == fingerprint:
+                continue
+            changed = sorted(path for path in set(current) | set(fingerprint) if current.get(path) != fingerprint.get(path))
+            print(f"Changed: {', '.join(changed)}")
+            ran, restored = run_pipeline(root, stages, n_jobs, verbose)
+            print(f"{len(ran)} stages run, {len(restored)} restored from the cache")
+            fingerprint = source_fingerprint(root, stages)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Run the detect, compile, plot and average steps as a cached pipeline.')
+    parser.add_argument('root', type=str, help='Repository root containing TH-Data and TH-Media.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of stages run in parallel.')
+    parser.add_argument('--backend', type=str, default='matplotlib', choices=heatmap_render.BACKENDS, help='Renderer of the heatmaps.')
+    parser.add_argument('--watch', action='store_true', help='Keep running and update the outputs affected by each change.')
+    parser.add_argument('--interval', type=float, default=2.0, help='Seconds between checks for changes in watch mode.')
+    parser.add_argument('--list', action='store_true', help='Only list the stages and what they depend on.')
+    parser.add_argument('--verbose', action='store_true', help='Show what each stage printed.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.list:
+        for stage in build_graph(args.root, args.backend):
+            print(f"{stage.name}: {len(stage.inputs)} inputs -> {len(stage.outputs)} outputs")
+    elif args.watch:
+        watch(args.root, args.jobs, args.backend, args.interval, args.verbose)
+    else:
+        ran, restored = run_pipeline(args.root, build_graph(args.root, args.backend), args.jobs, args.verbose)
+        print(f"{len(ran)} stages run, {len(restored)} restored from the cache")
@@ -3,11 +3,16 @@
 
 # Python modules required by the current program
 import os
+import csv
+import glob
+import math
 import argparse
-import openpyxl
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import catalog
+import heatmap_render
+import profiling
+import trial_cube
 
 # A function to read in data from an excel spreadsheet.
 def read_sheet_data(workbook, sheet_name):
@@ -25,51 +30,240 @@ def calculate_zero_proximity_score(matrix):
     zero_proximity = 100 - (np.abs(matrix).mean() * 100)
     return max(0, zero_proximity)
 
+# A function to load every sheet of a workbook as a {name: matrix} dict.
+def load_sheets(excel_file, cube_dir=None):
+    """Return an ordered dict of sheet name -> matrix from the trial cube if given, otherwise from the workbook."""
+    if cube_dir:
+        return dict(trial_cube.read_workbook_sheets(cube_dir, excel_file))
+    # openpyxl is only needed when the workbook is parsed rather than read from a cube
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(excel_file, data_only=True)
+    return {sheet_name: read_sheet_data(workbook, sheet_name) for sheet_name in workbook.sheetnames}
+
+# Class that keeps a running mean and variance with Welford's algorithm.
+class RunningStats:
+    """Accumulate the mean and sample variance of equally shaped arrays one at a time."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, value):
+        value = np.asarray(value, dtype=float)
+        self.count += 1
+        if self.mean is None:
+            self.mean = np.zeros_like(value)
+            self.m2 = np.zeros_like(value)
+        elif value.shape != self.mean.shape:
+            raise ValueError(f"Expected a matrix of shape {self.mean.shape}, got {value.shape}.")
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    # Half-width of the two-sided confidence interval of the mean.
+    def ci_halfwidth(self, confidence=0.95):
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return t_critical(self.count - 1, confidence) * self.std / math.sqrt(self.count)
+
+# Degrees of freedom up to which the t critical value is solved exactly; above it the expansion is within 1e-6 of it
+EXACT_T_DF = 30
+
+# A function to compute the probability that |T| < tan(theta) * sqrt(df) for Student's t with integer df.
+def t_central_probability(theta, df):
+    """Closed-form finite series of Abramowitz & Stegun 26.7.3 and 26.7.4 in theta = atan(t / sqrt(df))."""
+    cos2 = math.cos(theta) ** 2
+    if df % 2 == 0:
+        term = total = 1.0
+        for k in range(2, df, 2):
+            term *= cos2 * (k - 1) / k
+            total += term
+        return math.sin(theta) * total
+    total = 0.0
+    if df > 1:
+        term = total = 1.0
+        for k in range(3, df, 2):
+            term *= cos2 * (k - 1) / k
+            total += term
+    return 2 / math.pi * (theta + math.sin(theta) * math.cos(theta) * total)
+
+# A function to compute the two-sided Student's t critical value without scipy.
+def t_critical(df, confidence=0.95):
+    """Return the t value with the given two-sided confidence for df degrees of freedom."""
+    if df <= EXACT_T_DF:
+        # Bisect on theta, where the central probability rises monotonically from 0 to 1 over [0, pi/2)
+        low, high = 0.0, math.pi / 2
+        for _ in range(60):
+            middle = (low + high) / 2
+            if t_central_probability(middle, df) < confidence:
+                low = middle
+            else:
+                high = middle
+        return math.sqrt(df) * math.tan((low + high) / 2)
+    # Cornish-Fisher expansion around the normal quantile (Abramowitz & Stegun 26.7.5)
+    p = 0.5 + confidence / 2
+    z = NormalDist().inv_cdf(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+# A function to expand any glob patterns among the given trial files.
+def expand_files(patterns):
+    """Return the file paths matched by each pattern, keeping plain paths as they are."""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        files.extend(matches if matches else [pattern])
+    return files
+
+# Function to write one workbook with a sheet per distance.
+def save_matrices(matrices, output_file):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for sheet_name, matrix in matrices.items():
+        sheet = workbook.create_sheet(title=sheet_name)
+        for row in matrix:
+            sheet.append([float(value) for value in row])
+    workbook.save(output_file)
+
 # Function to average the excel matrices and then plot them using sns and matplotlib.
-def plot_average_heatmaps(excel_files, output_dir):
-    # Load the workbooks
-    workbooks = [openpyxl.load_workbook(file, data_only=True) for file in excel_files]
-
-    # Ensure all workbooks have the same sheets
-    sheet_names = workbooks[0].sheetnames
-    for wb in workbooks:
-        if wb.sheetnames != sheet_names:
+def plot_average_heatmaps(excel_files, output_dir, cube_dir=None, n_jobs=1, confidence=0.95,
+                          backend="matplotlib", montage=None):
+    # Accumulate every sheet one workbook at a time
+    sheet_names = None
+    matrix_stats = {}
+    score_stats = {}
+    for file in expand_files(excel_files):
+        with profiling.span("load workbook", file=file) as span:
+            workbook = load_sheets(file, cube_dir)
+            span.count(len(workbook))
+
+        # Ensure all workbooks have the same sheets
+        if sheet_names is None:
+            sheet_names = list(workbook)
+            matrix_stats = {sheet_name: RunningStats() for sheet_name in sheet_names}
+            score_stats = {sheet_name: RunningStats() for sheet_name in sheet_names}
+        elif list(workbook) != sheet_names:
             raise ValueError("All Excel files must have the same sheet names in the same order.")
 
+        with profiling.span("accumulate statistics", file=file) as span:
+            for sheet_name, matrix in workbook.items():
+                matrix_stats[sheet_name].update(matrix)
+                # Unclipped per-trial score, so its mean matches the score of the averaged matrix
+                score_stats[sheet_name].update(100 - np.abs(matrix).mean() * 100)
+                span.count()
+        del workbook
+
+    if sheet_names is None:
+        raise ValueError("No Excel files were given.")
+
     # Ensure output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    jobs = []
+    scores = []
     for sheet_name in sheet_names:
-        # Read and average the sheet data from all workbooks
-        matrices = [read_sheet_data(wb, sheet_name) for wb in workbooks]
-        avg_matrix = np.mean(matrices, axis=0)
-
-        # Handle all-zero matrices: Set the color scale to have a minimum below zero
-        plt.figure(figsize=(10, 8))
-        sns.heatmap(avg_matrix, cmap="YlGnBu", annot=True, fmt=".1f", cbar=True, vmin=0, vmax=1)
+        # Averaged matrix of this sheet across all trials
+        stats = matrix_stats[sheet_name]
+        avg_matrix = stats.mean
 
-        # Calculate the zero proximity score
+        # Calculate the zero proximity score and its confidence band across trials
         zero_proximity_score = calculate_zero_proximity_score(avg_matrix)
+        score_band = float(score_stats[sheet_name].ci_halfwidth(confidence))
+        scores.append((sheet_name, stats.count, zero_proximity_score, float(score_stats[sheet_name].std),
+                       max(0, zero_proximity_score - score_band), min(100, zero_proximity_score + score_band)))
 
         # Display the zero proximity score on the plot
-        plt.title(f"Averaged Heatmap of {sheet_name}\nZero Proximity Score: {zero_proximity_score:.2f}%")
+        title = f"Averaged Heatmap of {sheet_name}\nZero Proximity Score: {zero_proximity_score:.2f}%"
+        if stats.count > 1:
+            title += f" \u00b1 {score_band:.2f}% ({confidence:.0%} CI, n={stats.count})"
 
-        # Save the plot
+        # Queue the plot to be saved
         output_file = os.path.join(output_dir, f"{sheet_name}_average_heatmap.png")
-        plt.savefig(output_file)
-        plt.close()
-        print(f"Averaged heatmap saved for {sheet_name} at {output_file}")
+        jobs.append((avg_matrix, title, output_file))
+
+    # Draw every sheet into a single montage or multipage file instead of one PNG per sheet
+    if montage:
+        with profiling.span("render montage", file=montage) as span:
+            output_file = heatmap_render.render_montage([(data, title) for data, title, _ in jobs], montage)
+            span.count(len(jobs))
+        print(f"Averaged heatmaps of {len(jobs)} sheets saved at {output_file}")
+    else:
+        # Render the heatmaps, over a process pool when more than one job is requested
+        with profiling.span("render heatmaps", backend=backend, jobs=n_jobs) as span:
+            for sheet_name, output_file in zip(sheet_names, heatmap_render.render_heatmaps(jobs, n_jobs, backend)):
+                print(f"Averaged heatmap saved for {sheet_name} at {output_file}")
+                span.count()
+
+    # Save the per-cell spread and the score bands next to the plots
+    with profiling.span("save statistics"):
+        save_matrices({name: matrix_stats[name].std for name in sheet_names}, os.path.join(output_dir, "average_std.xlsx"))
+        save_matrices({name: matrix_stats[name].ci_halfwidth(confidence) for name in sheet_names},
+                      os.path.join(output_dir, "average_ci.xlsx"))
+        with open(os.path.join(output_dir, "average_scores.csv"), "w", newline="") as handle:
+            writer = csv.writer(handle)
+            writer.writerow(["sheet", "trials", "zero_proximity_score", "score_std", "ci_low", "ci_high"])
+            writer.writerows(scores)
+    print(f"Per-cell standard deviation, confidence intervals and score bands saved in {output_dir}")
+
+# Function to add the averaging options to an argument parser, shared with the thunderhead entry point.
+def add_arguments(parser):
+    parser.add_argument('excel_files', type=str, nargs='*', help='Paths or glob patterns of the trial Excel files.')
+    parser.add_argument('output_dir', type=str, help='Directory to save the averaged heatmaps.')
+    parser.add_argument('--cube', type=str, default=None, help='Read the matrices from a trial cube directory instead of parsing the workbooks.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used to render the heatmaps.')
+    parser.add_argument('--catalog', type=str, default=None, help='Catalog database to take the trial workbooks from.')
+    parser.add_argument('--check-stale', action='store_true', help='With --catalog, warn about trial workbooks that the catalog is missing.')
+    parser.add_argument('--prototype', type=int, default=None, help='Prototype whose trials are averaged; required with --catalog.')
+    parser.add_argument('--backend', type=str, default=None, choices=heatmap_render.BACKENDS, help='Renderer of the per-sheet heatmaps (default matplotlib); raster skips matplotlib and is much faster.')
+    parser.add_argument('--montage', type=str, default=None, help='Save every sheet into this one file instead: a tiled .png, or a page per sheet for .pdf/.tif. Always drawn by the raster renderer in one process.')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the per-cell and score intervals.')
+    profiling.add_argument(parser)
+
+# Function to plot the averaged heatmaps from parsed arguments.
+def run(args, parser):
+    # The catalog is read one prototype at a time
+    if args.catalog and args.prototype is None:
+        parser.error("--catalog needs --prototype, averaging different prototypes together is meaningless")
+    # A montage is always drawn by the raster renderer in this process
+    if args.montage and (args.backend == 'matplotlib' or args.jobs > 1):
+        parser.error("--montage is drawn by the raster renderer in one process; it cannot be combined with "
+                     "--backend matplotlib or --jobs")
+    if args.profile:
+        profiling.start("plot_average")
+
+    # Take the trial workbooks from the catalog when asked to
+    if args.catalog:
+        args.excel_files += [entry["path"] for entry in
+                             catalog.query_files(args.catalog, kind="trial_workbook", prototype=args.prototype,
+                                                 check_stale=args.check_stale)]
+    if not args.excel_files:
+        parser.error("no Excel files given")
+
+    # Plot averaged heatmaps
+    plot_average_heatmaps(args.excel_files, args.output_dir, args.cube, args.jobs, args.confidence,
+                          args.backend or 'matplotlib', args.montage)
+    if args.profile:
+        profiling.finish(args.profile)
 
 if __name__ == "__main__":
     # Set up argument parser
     parser = argparse.ArgumentParser(description='Plot averaged heatmaps for corresponding sheets in multiple Excel files.')
-    parser.add_argument('excel_files', type=str, nargs=3, help='Paths to the three Excel files.')
-    parser.add_argument('output_dir', type=str, help='Directory to save the averaged heatmaps.')
+    add_arguments(parser)
 
     # Parse the arguments
     args = parser.parse_args()
-
-    # Plot averaged heatmaps
-    plot_average_heatmaps(args.excel_files, args.output_dir)
-
+    run(args, parser)
@@ -4,10 +4,10 @@
 # Python modules required by the current program
 import os
 import argparse
-import openpyxl
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import heatmap_render
+import profiling
+import trial_cube
 
 # A function to read in data from an excel spreadsheet.
 def read_sheet_data(sheet):
@@ -24,47 +24,92 @@ def calculate_zero_proximity_score(matrix):
     zero_proximity = 100 - (np.abs(matrix).mean() * 100)
     return max(0, zero_proximity)
 
+# A function to yield every sheet of a workbook as a (name, matrix) pair.
+def iter_sheets(excel_file, cube_dir=None):
+    """Yield (sheet name, matrix) from the trial cube if given, otherwise from the workbook."""
+    if cube_dir:
+        with profiling.span("read trial cube", file=excel_file):
+            sheets = trial_cube.read_workbook_sheets(cube_dir, excel_file)
+        yield from sheets
+        return
+
+    # openpyxl is only needed when the workbook is parsed rather than read from a cube
+    from openpyxl import load_workbook
+
+    with profiling.span("load workbook", file=excel_file) as span:
+        workbook = load_workbook(excel_file, data_only=True)
+        span.count(len(workbook.sheetnames))
+    for sheet_name in workbook.sheetnames:
+        # Read sheet data into a 2D list (assuming the sheet is a grid of numbers)
+        with profiling.span("read sheet", sheet=sheet_name) as span:
+            data = read_sheet_data(workbook[sheet_name])
+            span.count()
+        yield sheet_name, data
+
 # Function to plot the excel matrix using sns and matplotlib.
-def plot_heatmaps(excel_file, output_dir):
-    # Load the workbook
-    workbook = openpyxl.load_workbook(excel_file, data_only=True)
-    
+def plot_heatmaps(excel_file, output_dir, cube_dir=None, n_jobs=1, backend="matplotlib", montage=None):
     # Ensure output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for sheet_name in workbook.sheetnames:
-        sheet = workbook[sheet_name]
-
-        # Read sheet data into a 2D list (assuming the sheet is a grid of numbers)
-        data = read_sheet_data(sheet)
-
+    jobs = []
+    sheet_names = []
+    for sheet_name, data in iter_sheets(excel_file, cube_dir):
         if data.size > 0:
-            # Handle all-zero matrices: Set the color scale to have a minimum below zero
-            plt.figure(figsize=(10, 8))
-            sns.heatmap(data, cmap="YlGnBu", annot=True, fmt=".1f", cbar=True, vmin=0, vmax=1)
-
             # Calculate the zero proximity score
             zero_proximity_score = calculate_zero_proximity_score(data)
 
             # Display the zero proximity score on the plot
-            plt.title(f"Heatmap of {sheet_name}\nZero Proximity Score: {zero_proximity_score:.2f}%")
+            title = f"Heatmap of {sheet_name}\nZero Proximity Score: {zero_proximity_score:.2f}%"
 
-            # Save the plot
+            # Queue the plot to be saved
             output_file = os.path.join(output_dir, f"{sheet_name}_heatmap.png")
-            plt.savefig(output_file)
-            plt.close()
+            jobs.append((data, title, output_file))
+            sheet_names.append(sheet_name)
+
+    # Draw every sheet into a single montage or multipage file instead of one PNG per sheet
+    if montage:
+        with profiling.span("render montage", file=montage) as span:
+            output_file = heatmap_render.render_montage([(data, title) for data, title, _ in jobs], montage)
+            span.count(len(jobs))
+        print(f"Heatmaps of {len(jobs)} sheets saved at {output_file}")
+        return
+
+    # Render the heatmaps, over a process pool when more than one job is requested
+    with profiling.span("render heatmaps", backend=backend, jobs=n_jobs) as span:
+        for sheet_name, output_file in zip(sheet_names, heatmap_render.render_heatmaps(jobs, n_jobs, backend)):
             print(f"Heatmap saved for {sheet_name} at {output_file}")
+            span.count()
 
-if __name__ == "__main__":
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description='Plot heatmaps for each sheet in an Excel file with zero proximity scores.')
+# Function to add the plotting options to an argument parser, shared with the thunderhead entry point.
+def add_arguments(parser):
     parser.add_argument('excel_file', type=str, help='Path to the Excel file.')
     parser.add_argument('output_dir', type=str, help='Directory to save the heatmaps.')
+    parser.add_argument('--cube', type=str, default=None, help='Read the matrices from a trial cube directory instead of parsing the workbook.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used to render the heatmaps.')
+    parser.add_argument('--backend', type=str, default=None, choices=heatmap_render.BACKENDS, help='Renderer of the per-sheet heatmaps (default matplotlib); raster skips matplotlib and is much faster.')
+    parser.add_argument('--montage', type=str, default=None, help='Save every sheet into this one file instead: a tiled .png, or a page per sheet for .pdf/.tif. Always drawn by the raster renderer in one process.')
+    profiling.add_argument(parser)
 
-    # Parse the arguments
-    args = parser.parse_args()
+# Function to plot the heatmaps from parsed arguments.
+def run(args, parser):
+    # A montage is always drawn by the raster renderer in this process
+    if args.montage and (args.backend == 'matplotlib' or args.jobs > 1):
+        parser.error("--montage is drawn by the raster renderer in one process; it cannot be combined with "
+                     "--backend matplotlib or --jobs")
+    if args.profile:
+        profiling.start("plot_single")
 
     # Plot heatmaps
-    plot_heatmaps(args.excel_file, args.output_dir)
+    plot_heatmaps(args.excel_file, args.output_dir, args.cube, args.jobs, args.backend or 'matplotlib', args.montage)
+    if args.profile:
+        profiling.finish(args.profile)
 
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Plot heatmaps for each sheet in an Excel file with zero proximity scores.')
+    add_arguments(parser)
+
+    # Parse the arguments
+    args = parser.parse_args()
+    run(args, parser)
@@ -0,0 +1,205 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import json
+import time
+import threading
+
+# resource is Unix-only; on Windows the peak is read through psutil when it is installed
+try:
+    import resource
+except ImportError:
+    resource = None
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+# Number of stages listed in the summary table
+SUMMARY_ROWS = 15
+
+# Profile being recorded, or None when profiling is off so span() costs one global lookup
+_active = None
+
+# Function to return the peak resident memory of the process so far in MB, or None where it cannot be read.
+def peak_rss_mb():
+    if resource is not None:
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        # peak_wset is the peak working set on Windows
+        return getattr(memory, "peak_wset", memory.rss) / 2 ** 20
+    return None
+
+# Function to format a peak RSS for the summary table.
+def format_rss(peak, width):
+    return f"{peak:>{width}.1f}" if peak is not None else f"{'n/a':>{width}}"
+
+# Class standing in for a span when profiling is off.
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, items=1):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+# Class timing one stage of a run.
+class Span:
+    """Record the wall time, CPU time, peak RSS and items handled between entering and leaving the block."""
+
+    def __init__(self, profile, name, category, args):
+        self.profile = profile
+        self.name = name
+        self.category = category
+        self.args = args
+        self.items = 0
+
+    def __enter__(self):
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall_end = time.perf_counter()
+        cpu_end = time.process_time()
+        self.profile.events.append({
+            "name": self.name,
+            "category": self.category,
+            "start": self.wall_start - self.profile.origin,
+            "wall": wall_end - self.wall_start,
+            "cpu": cpu_end - self.cpu_start,
+            "peak_rss_mb": peak_rss_mb(),
+            "items": self.items,
+            "pid": self.profile.pid,
+            "thread": threading.get_ident(),
+            "args": self.args,
+        })
+        return False
+
+    def count(self, items=1):
+        """Add to the number of sheets, images or rows this stage handled."""
+        self.items += items
+
+# Class holding the spans of one profiled run.
+class Profile:
+    def __init__(self, name, origin=None):
+        self.name = name
+        # perf_counter is a system-wide monotonic clock, so pool workers given the parent's origin line up with it
+        self.origin = time.perf_counter() if origin is None else origin
+        self.pid = os.getpid()
+        self.events = []
+
+# Function to time a block of work when profiling is on.
+def span(name, category="stage", **args):
+    """Return a context manager timing the block as name; a shared no-op when profiling is off."""
+    if _active is None:
+        return _NULL_SPAN
+    return Span(_active, name, category, args)
+
+# Function to switch profiling on for the rest of the run.
+def start(name):
+    global _active
+    _active = Profile(name)
+    return _active
+
+# Function to hand pool workers what they need to profile themselves.
+def worker_origin():
+    """Return the origin of the active profile for a pool initializer, or None when profiling is off."""
+    return None if _active is None else _active.origin
+
+# Function to start or stop profiling in a pool worker, from its initializer.
+def start_worker(origin):
+    """Profile this worker against the parent's origin, or switch profiling off here when origin is None.
+
+    A forked worker inherits the parent's profile, so this is called either way.
+    """
+    global _active
+    _active = None if origin is None else Profile("worker", origin)
+
+# Function to take the spans a pool worker recorded, to return them with its job result.
+def take_events():
+    """Return and forget the spans recorded in this process since the last call."""
+    if _active is None:
+        return []
+    events, _active.events = _active.events, []
+    return events
+
+# Function to add the spans returned by a pool worker to the active profile.
+def merge(events):
+    if _active is not None:
+        _active.events.extend(events)
+
+# Function to total the spans by name.
+def summarize(events):
+    """Return rows of (name, calls, wall, cpu, items, peak RSS) sorted by total wall time."""
+    totals = {}
+    for event in events:
+        row = totals.setdefault(event["name"], [event["name"], 0, 0.0, 0.0, 0, None])
+        row[1] += 1
+        row[2] += event["wall"]
+        row[3] += event["cpu"]
+        row[4] += event["items"]
+        if event["peak_rss_mb"] is not None:
+            row[5] = max(row[5] or 0.0, event["peak_rss_mb"])
+    return sorted(totals.values(), key=lambda row: row[2], reverse=True)
+
+# Function to convert the spans to the Chrome trace event format, for chrome://tracing or Perfetto.
+def chrome_trace(profile):
+    threads = {}
+    events = []
+    for event in profile.events:
+        # Each pool worker is shown as its own process
+        pid = event.get("pid", profile.pid)
+        tid = threads.setdefault((pid, event["thread"]), len(threads))
+        events.append({"name": event["name"], "cat": event["category"], "ph": "X", "pid": pid, "tid": tid,
+                       "ts": round(event["start"] * 1e6, 1), "dur": round(event["wall"] * 1e6, 1),
+                       "args": dict(event["args"], cpu_ms=round(event["cpu"] * 1e3, 3), items=event["items"],
+                                    peak_rss_mb=None if event["peak_rss_mb"] is None
+                                    else round(event["peak_rss_mb"], 1))})
+    events.append({"name": "process_name", "ph": "M", "pid": profile.pid, "args": {"name": profile.name}})
+    for pid in sorted({pid for pid, _ in threads} - {profile.pid}):
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{profile.name} worker {pid}"}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# Function to print the hottest stages.
+def print_summary(profile, rows=SUMMARY_ROWS):
+    total = time.perf_counter() - profile.origin
+    peak = peak_rss_mb()
+    print(f"Profile of {profile.name}: {total:.3f}s wall, "
+          + (f"{peak:.1f} MB peak RSS" if peak is not None else "peak RSS unavailable"))
+    print(f"{'stage':<32}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'% wall':>8}{'items':>8}{'rss MB':>9}")
+    for name, calls, wall, cpu, items, peak in summarize(profile.events)[:rows]:
+        print(f"{name[:31]:<32}{calls:>7}{wall:>10.3f}{cpu:>10.3f}{100 * wall / total:>8.1f}{items:>8}{format_rss(peak, 9)}")
+
+# Function to stop profiling and write the profile as JSON and as a Chrome trace.
+def finish(output_file):
+    """Write output_file and the .trace.json next to it, print the summary and switch profiling off."""
+    global _active
+    profile, _active = _active, None
+    if profile is None:
+        return None
+    summary = [dict(zip(("name", "calls", "wall", "cpu", "items", "peak_rss_mb"), row))
+               for row in summarize(profile.events)]
+    with open(output_file, "w") as handle:
+        json.dump({"name": profile.name, "wall": time.perf_counter() - profile.origin,
+                   "peak_rss_mb": peak_rss_mb(),
+                   "summary": summary, "events": profile.events}, handle, indent=2)
+    trace_file = os.path.splitext(output_file)[0] + ".trace.json"
+    with open(trace_file, "w") as handle:
+        json.dump(chrome_trace(profile), handle)
+    print_summary(profile)
+    print(f"Profile saved to {output_file} and {trace_file}")
+    return output_file
+
+# Function to add the --profile flag to a script's argument parser.
+def add_argument(parser):
+    parser.add_argument('--profile', type=str, nargs='?', const='profile.json', default=None, metavar='FILE',
+                        help='Record the time, CPU and memory of every stage to FILE (default profile.json) and a Chrome trace.')
@@ -0,0 +1,320 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import csv
+import math
+import argparse
+import warnings
+import itertools
+import numpy as np
+import catalog
+import trial_cube
+
+# Upper bound on the temporary arrays of one batch, so 10k+ resamples never need all their copies at once
+MAX_BATCH_BYTES = 64 << 20
+
+# Candidate half-score distances and widths (feet) of the effective-range fit
+RANGE_GRID = np.arange(0.0, 15.0001, 0.05)
+WIDTH_GRID = np.geomspace(0.05, 5.0, 40)
+
+# Function to turn a candle matrix into the knockdown score of calculate_zero_proximity_score, without clipping.
+def knockdown_score(matrices, axes=(-2, -1)):
+    """Return 100 minus the lit percentage over the given axes, ignoring NaN padding."""
+    # In float64, so scores from float32 workbook matrices match the cube's exactly and permutation ties are found
+    return 100 - np.nanmean(np.abs(np.asarray(matrices, dtype=float)), axis=axes) * 100
+
+# Function to load every trial of every prototype as one array of knockdown scores.
+def load_scores(data_root, cube_dir=None):
+    """Return (prototypes, sheet names, distances in feet, scores) with scores shaped (prototype, trial, distance).
+
+    Trials a prototype does not have are NaN.
+    """
+    if cube_dir:
+        cube, meta = trial_cube.load_cube(cube_dir)
+        # Padding-only sheets average to NaN; nanmean warns about them instead of honouring np.errstate
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            scores = np.transpose(knockdown_score(np.asarray(cube, dtype=float)), (1, 0, 2))
+        names = meta["distances"]
+        return meta["prototypes"], names, np.array([catalog.parse_distance(n, float('inf')) for n in names]), scores
+
+    workbooks = [(trial, prototype, trial_cube.parse_workbook(path))
+                 for trial, prototype, path in trial_cube.find_trial_workbooks(data_root)]
+    if not workbooks:
+        raise ValueError(f"No trial workbooks found under {data_root}")
+    trials = sorted({trial for trial, _, _ in workbooks})
+    prototypes = sorted({prototype for _, prototype, _ in workbooks})
+    names = sorted({name for _, _, sheets in workbooks for name, m in sheets.items() if m.size},
+                   key=lambda name: catalog.parse_distance(name, float('inf')))
+    scores = np.full((len(prototypes), len(trials), len(names)), np.nan)
+    for trial, prototype, sheets in workbooks:
+        for name, matrix in sheets.items():
+            if matrix.size:
+                scores[prototypes.index(prototype), trials.index(trial), names.index(name)] = knockdown_score(matrix)
+    return prototypes, names, np.array([catalog.parse_distance(n, float('inf')) for n in names]), scores
+
+# Function to work out how many resamples fit in one batch.
+def batch_size(bytes_per_resample, max_bytes=MAX_BATCH_BYTES):
+    return max(1, int(max_bytes // max(1, bytes_per_resample)))
+
+# Function to average trials picked by index, skipping missing values.
+def resampled_means(values, index):
+    """Return the (resamples, distance) means of values (trial, distance) over the trials picked by index (resamples, n)."""
+    finite = np.isfinite(values)
+    picked = np.where(finite, values, 0.0)[index]
+    counts = finite[index].sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return picked.sum(axis=1) / counts
+
+# Function to bootstrap the mean knockdown score of each prototype at each distance.
+def bootstrap_means(scores, resamples=10000, seed=0, max_bytes=MAX_BATCH_BYTES):
+    """Return the (resamples, prototype, distance) bootstrap distribution of the per-distance mean score.
+
+    Trials are resampled with replacement within each prototype, keeping a trial's distances together.
+    """
+    rng = np.random.default_rng(seed)
+    n_protos, _, n_dist = scores.shape
+    means = np.empty((resamples, n_protos, n_dist))
+    for p in range(n_protos):
+        valid = scores[p, np.isfinite(scores[p]).any(axis=1)]
+        if len(valid) == 0:
+            means[:, p] = np.nan
+            continue
+        step = batch_size(len(valid) * n_dist * 8 * 2, max_bytes)
+        for start in range(0, resamples, step):
+            stop = min(resamples, start + step)
+            index = rng.integers(0, len(valid), (stop - start, len(valid)))
+            means[start:stop, p] = resampled_means(valid, index)
+    return means
+
+# Function to turn a bootstrap distribution into percentile intervals.
+def percentile_interval(samples, confidence=0.95, axis=0):
+    alpha = (1 - confidence) / 2
+    # Distances with no trials give an all-NaN column, whose interval is NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanquantile(samples, alpha, axis=axis), np.nanquantile(samples, 1 - alpha, axis=axis)
+
+# Function to list the group splits of a permutation test, exactly when there are few enough of them.
+def permutation_masks(n_a, n_b, permutations, rng):
+    """Return a boolean (splits, n_a + n_b) array marking group A, and whether it lists every split."""
+    n = n_a + n_b
+    if math.comb(n, n_a) <= permutations:
+        masks = np.zeros((math.comb(n, n_a), n), dtype=bool)
+        for row, members in enumerate(itertools.combinations(range(n), n_a)):
+            masks[row, list(members)] = True
+        return masks, True
+    order = np.argsort(rng.random((permutations, n)), axis=1)
+    masks = np.zeros((permutations, n), dtype=bool)
+    np.put_along_axis(masks, order[:, :n_a], True, axis=1)
+    return masks, False
+
+# Function to test whether two prototypes differ in mean knockdown score, at every distance at once.
+def permutation_test(a, b, permutations=10000, seed=0, max_bytes=MAX_BATCH_BYTES):
+    """Return (observed difference of means, two-sided p-value) per distance for trial arrays a and b (trial, distance).
+
+    When the trials can be split between the groups in no more than permutations ways every split is
+    enumerated and the p-value is exact; otherwise splits are drawn at random.
+    """
+    rng = np.random.default_rng(seed)
+    a = a[np.isfinite(a).any(axis=1)]
+    b = b[np.isfinite(b).any(axis=1)]
+    pooled = np.concatenate([a, b])
+    finite = np.isfinite(pooled).astype(float)
+    values = np.where(finite > 0, pooled, 0.0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        observed = np.nanmean(a, axis=0) - np.nanmean(b, axis=0)
+    masks, exact = permutation_masks(len(a), len(b), permutations, rng)
+
+    # Differences of the group means for every split as two matrix products per batch
+    extreme = np.zeros(pooled.shape[1])
+    step = batch_size(pooled.shape[0] * 8 + pooled.shape[1] * 8 * 4, max_bytes)
+    for start in range(0, len(masks), step):
+        group_a = masks[start:start + step].astype(float)
+        group_b = 1.0 - group_a
+        with np.errstate(invalid="ignore", divide="ignore"):
+            diff = group_a @ values / (group_a @ finite) - group_b @ values / (group_b @ finite)
+        # Small tolerance so splits that tie the observed statistic count as at least as extreme
+        extreme += (np.abs(diff) >= np.abs(observed) - 1e-9).sum(axis=0)
+    if exact:
+        p_value = extreme / len(masks)
+    else:
+        p_value = (extreme + 1) / (len(masks) + 1)
+    p_value[~np.isfinite(observed)] = np.nan
+    return observed, p_value
+
+# Function to adjust a family of p-values for multiple comparisons with Holm's step-down method.
+def holm_adjust(p_values):
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full_like(p_values, np.nan)
+    finite = np.flatnonzero(np.isfinite(p_values))
+    order = finite[np.argsort(p_values[finite])]
+    running = 0.0
+    for rank, i in enumerate(order):
+        running = max(running, (len(order) - rank) * p_values[i])
+        adjusted[i] = min(1.0, running)
+    return adjusted
+
+# Logistic fall-off of the knockdown score with distance.
+def range_curve(distances, top, half_range, width):
+    """Return top / (1 + exp((d - half_range) / width)), written with tanh so it cannot overflow."""
+    return top * (0.5 - 0.5 * np.tanh((np.asarray(distances) - half_range) / (2 * width)))
+
+# Function to fit the effective range of many score-vs-distance curves at once.
+def fit_range(distances, curves, max_bytes=MAX_BATCH_BYTES):
+    """Return (top, half_range, width) arrays fitted by least squares to each row of curves (curves, distance).
+
+    Only the falling edge is fitted: distances before a curve's highest score are left out, since up close
+    the ring has not formed yet. The plateau top is solved in closed form for every (half_range, width)
+    on the grid, so the search over the whole grid and every curve is a pair of matrix products.
+    """
+    curves = np.atleast_2d(np.asarray(curves, dtype=float))
+    distances = np.asarray(distances, dtype=float)
+    half_range, width = (g.ravel() for g in np.meshgrid(RANGE_GRID, WIDTH_GRID, indexing="ij"))
+    # Single precision halves the cost of the products and is ample for scores in percent
+    basis = range_curve(distances[None], 1.0, half_range[:, None], width[:, None]).astype(np.float32)
+    basis_sq = basis ** 2
+
+    finite = np.isfinite(curves)
+    peak = np.nanargmax(np.where(finite, curves, -np.inf), axis=1)
+    weights = (finite & (np.arange(len(distances))[None] >= peak[:, None])).astype(np.float32)
+    values = np.where(finite, curves, 0.0).astype(np.float32) * weights
+
+    result = np.full((len(curves), 3), np.nan)
+    step = batch_size(len(half_range) * 4 * 5, max_bytes)
+    for start in range(0, len(curves), step):
+        y, w = values[start:start + step], weights[start:start + step]
+        cross = y @ basis.T
+        norm = w @ basis_sq.T
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # Best plateau for each candidate, kept within the 0-100 % a score can take
+            top = np.clip(cross / norm, 0, 100)
+            # Residual sum of squares, up to the sum of y squared that is the same for every candidate
+            residual = np.where(norm > 0, top * (top * norm - 2 * cross), np.inf)
+        best = np.argmin(residual, axis=1)
+        rows = np.arange(len(y))
+        result[start:start + step] = np.column_stack([top[rows, best], half_range[best], width[best]])
+    return result[:, 0], result[:, 1], result[:, 2]
+
+# Function to run the full comparison and collect the result tables.
+def compare_prototypes(scores, distances, resamples=10000, permutations=10000, confidence=0.95, seed=0,
+                       max_bytes=MAX_BATCH_BYTES):
+    """Return (bootstrap means, per-distance intervals, pairwise tests, range fits) for a (prototype, trial, distance) score array."""
+    n_protos = scores.shape[0]
+    boot = bootstrap_means(scores, resamples, seed, max_bytes)
+    low, high = percentile_interval(boot, confidence)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        means = np.nanmean(scores, axis=1)
+    intervals = {"mean": means, "low": low, "high": high, "trials": np.isfinite(scores).sum(axis=1)}
+
+    tests = []
+    for i, j in itertools.combinations(range(n_protos), 2):
+        diff, p_value = permutation_test(scores[i], scores[j], permutations, seed + 1 + i * n_protos + j, max_bytes)
+        diff_low, diff_high = percentile_interval(boot[:, i] - boot[:, j], confidence)
+        tests.append({"pair": (i, j), "diff": diff, "low": diff_low, "high": diff_high,
+                      "p": p_value, "p_holm": holm_adjust(p_value)})
+
+    # Fit the observed mean curves and every bootstrap curve in one batch
+    fitted = fit_range(distances, means, max_bytes)
+    boot_fits = fit_range(distances, boot.reshape(-1, len(distances)), max_bytes)
+    boot_range = boot_fits[1].reshape(resamples, n_protos)
+    range_low, range_high = percentile_interval(boot_range, confidence)
+    fits = {"top": fitted[0], "half_range": fitted[1], "width": fitted[2], "low": range_low, "high": range_high}
+    return boot, intervals, tests, fits
+
+# Function to round a value for the CSV tables, writing 0.0 rather than -0.0.
+def rounded(value, digits):
+    return round(float(value), digits) + 0.0
+
+# Function to write the result tables as CSV files.
+def save_tables(output_dir, prototypes, sheet_names, intervals, tests, fits):
+    with open(os.path.join(output_dir, "score_intervals.csv"), "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["prototype", "sheet", "trials", "mean_score", "ci_low", "ci_high"])
+        for p, prototype in enumerate(prototypes):
+            for d, sheet_name in enumerate(sheet_names):
+                writer.writerow([f"P{prototype}", sheet_name, int(intervals["trials"][p, d]), rounded(intervals["mean"][p, d], 3),
+                                 rounded(intervals["low"][p, d], 3), rounded(intervals["high"][p, d], 3)])
+
+    with open(os.path.join(output_dir, "pairwise_tests.csv"), "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["prototype_a", "prototype_b", "sheet", "score_difference", "ci_low", "ci_high", "p_value", "p_holm"])
+        for test in tests:
+            i, j = test["pair"]
+            for d, sheet_name in enumerate(sheet_names):
+                writer.writerow([f"P{prototypes[i]}", f"P{prototypes[j]}", sheet_name, rounded(test["diff"][d], 3),
+                                 rounded(test["low"][d], 3), rounded(test["high"][d], 3),
+                                 rounded(test["p"][d], 4), rounded(test["p_holm"][d], 4)])
+
+    with open(os.path.join(output_dir, "effective_range.csv"), "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["prototype", "plateau_score", "half_score_range_ft", "width_ft", "range_ci_low", "range_ci_high"])
+        for p, prototype in enumerate(prototypes):
+            writer.writerow([f"P{prototype}", rounded(fits["top"][p], 2), rounded(fits["half_range"][p], 2),
+                             rounded(fits["width"][p], 3), rounded(fits["low"][p], 2), rounded(fits["high"][p], 2)])
+
+# Function to plot the score curves with their intervals and fitted fall-off, and the pairwise p-values.
+def save_plots(output_dir, prototypes, sheet_names, distances, intervals, tests, fits, confidence=0.95):
+    # matplotlib and seaborn are only imported when plots are saved
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plt.figure(figsize=(10, 6))
+    smooth = np.linspace(distances.min(), distances.max(), 200)
+    for p, prototype in enumerate(prototypes):
+        line, = plt.plot(distances, intervals["mean"][p], "o", label=f"P{prototype}")
+        plt.fill_between(distances, intervals["low"][p], intervals["high"][p], color=line.get_color(), alpha=0.2)
+        plt.plot(smooth, range_curve(smooth, fits["top"][p], fits["half_range"][p], fits["width"][p]),
+                 color=line.get_color(), label=f"P{prototype} fit, range {fits['half_range'][p]:.1f} ft")
+    plt.xlabel("Distance (ft)")
+    plt.ylabel("Zero Proximity Score (%)")
+    plt.title(f"Knockdown score by distance with {confidence:.0%} bootstrap intervals")
+    plt.legend()
+    plt.savefig(os.path.join(output_dir, "score_curves.png"))
+    plt.close()
+
+    plt.figure(figsize=(12, 4))
+    labels = [f"P{prototypes[i]} vs P{prototypes[j]}" for i, j in (test["pair"] for test in tests)]
+    # Unadjusted, since with three trials a side no split is rarer than 1 in 10; the CSV also has Holm-adjusted values
+    sns.heatmap(np.array([test["p"] for test in tests]), cmap="YlGnBu_r", annot=True, fmt=".2f", vmin=0, vmax=1,
+                xticklabels=sheet_names, yticklabels=labels)
+    plt.title("Permutation p-values of the score difference")
+    plt.tight_layout()
+    plt.savefig(os.path.join(output_dir, "pairwise_pvalues.png"))
+    plt.close()
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Compare the prototypes with bootstrap intervals, permutation tests and effective-range fits.')
+    parser.add_argument('data_root', type=str, help='Path to the TH-Data directory.')
+    parser.add_argument('output_dir', type=str, help='Directory to save the tables and plots.')
+    parser.add_argument('--cube', type=str, default=None, help='Read the matrices from a trial cube directory instead of parsing the workbooks.')
+    parser.add_argument('--resamples', type=int, default=10000, help='Number of bootstrap resamples.')
+    parser.add_argument('--permutations', type=int, default=10000, help='Maximum number of permutations per test; fewer possible splits are enumerated exactly.')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--max-memory', type=int, default=MAX_BATCH_BYTES >> 20, help='Memory cap of one batch in MB.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Ensure output directory exists
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # Run the comparison
+    prototypes, sheet_names, distances, scores = load_scores(args.data_root, args.cube)
+    _, intervals, tests, fits = compare_prototypes(scores, distances, args.resamples, args.permutations,
+                                                   args.confidence, args.seed, args.max_memory << 20)
+    save_tables(args.output_dir, prototypes, sheet_names, intervals, tests, fits)
+    save_plots(args.output_dir, prototypes, sheet_names, distances, intervals, tests, fits, args.confidence)
+    for p, prototype in enumerate(prototypes):
+        print(f"P{prototype}: effective range {fits['half_range'][p]:.2f} ft "
+              f"({fits['low'][p]:.2f}-{fits['high'][p]:.2f} ft), plateau {fits['top'][p]:.1f}%")
+    print(f"Tables and plots saved in {args.output_dir}")
@@ -0,0 +1,350 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import re
+import pty
+import tty
+import json
+import time
+import glob
+import errno
+import asyncio
+import termios
+import argparse
+import numpy as np
+
+# Phase timings of TH-MCU/ArduinoMAIN/Mixing_Main.ino, in milliseconds
+MISTING_TIME_MS = 2000
+AIR_TIME_MS = 1000
+ARC_TIME_MS = 8000
+BAUD = 9600
+
+# Phases of a shot, in firing order. The index is what gets stored in the chunks.
+PHASES = ["IDLE", "MIST", "AIR", "ARC"]
+
+# Mixing_Main prints this without a newline for as long as the arc is on
+ARC_TOKEN = b"Flying..."
+
+# Firmware that reports its phase changes does so as "<millis> <PHASE>" lines
+PHASE_LINE = re.compile(r'^(\d+)\s+(' + '|'.join(PHASES) + r')$')
+
+# Longest partial line kept while waiting for its end
+MAX_LINE = 256
+
+# Class holding the bytes read from the port until the parser gets to them.
+class RingBuffer:
+    """Fixed-size byte buffer that overwrites the oldest bytes when full and counts what it dropped."""
+
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if len(data) >= self.capacity:
+            self.dropped += self.size + len(data) - self.capacity
+            data = data[-self.capacity:]
+            self.start, self.size = 0, 0
+        overflow = self.size + len(data) - self.capacity
+        if overflow > 0:
+            self.start = (self.start + overflow) % self.capacity
+            self.size -= overflow
+            self.dropped += overflow
+        end = (self.start + self.size) % self.capacity
+        first = min(len(data), self.capacity - end)
+        self.buffer[end:end + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.size += len(data)
+
+    def read(self):
+        """Return and remove everything in the buffer."""
+        end = self.start + self.size
+        if end <= self.capacity:
+            data = bytes(self.buffer[self.start:end])
+        else:
+            data = bytes(self.buffer[self.start:]) + bytes(self.buffer[:end - self.capacity])
+        self.start = end % self.capacity
+        self.size = 0
+        return data
+
+# Class turning the raw serial stream into phase transitions.
+class PhaseParser:
+    """Track the firmware phase from "<millis> <PHASE>" lines and the arc's "Flying..." output.
+
+    With the current firmware only the arc is visible, so when it starts from idle the mist and air
+    starts are back-dated by the firmware's fixed phase times and flagged as inferred, and the arc is
+    taken to have ended once no "Flying..." has arrived for arc_gap seconds.
+    """
+
+    def __init__(self, arc_gap=0.5):
+        self.arc_gap = arc_gap
+        self.phase = "IDLE"
+        self.shot = 0
+        self.pending = b""
+        self.last_arc = None
+        self.events = []
+        self.messages = []
+
+    def feed(self, data, host_time):
+        self.pending += data
+        while True:
+            newline = self.pending.find(b"\n")
+            arc = self.pending.find(ARC_TOKEN)
+            if arc >= 0 and (newline < 0 or arc < newline):
+                # Text printed before the arc token on the same line is still a message
+                self._line(self.pending[:arc], host_time)
+                self.pending = self.pending[arc + len(ARC_TOKEN):]
+                self._arc(host_time)
+            elif newline >= 0:
+                self._line(self.pending[:newline], host_time)
+                self.pending = self.pending[newline + 1:]
+            else:
+                break
+        if len(self.pending) > MAX_LINE:
+            self._line(self.pending, host_time)
+            self.pending = b""
+
+    def check(self, host_time):
+        """Close an arc that has gone quiet."""
+        if self.phase == "ARC" and self.last_arc is not None and host_time - self.last_arc > self.arc_gap:
+            self._transition("IDLE", self.last_arc, inferred=True)
+            self.last_arc = None
+
+    def _line(self, raw, host_time):
+        text = raw.decode("ascii", errors="replace").strip()
+        if not text:
+            return
+        match = PHASE_LINE.match(text)
+        if match:
+            self._transition(match.group(2), host_time, int(match.group(1)))
+        else:
+            self.messages.append((host_time, text))
+
+    def _arc(self, host_time):
+        if self.phase == "IDLE":
+            self._transition("MIST", host_time - (MISTING_TIME_MS + AIR_TIME_MS) / 1000, inferred=True)
+            self._transition("AIR", host_time - AIR_TIME_MS / 1000, inferred=True)
+        if self.phase != "ARC":
+            self._transition("ARC", host_time, inferred=self.phase != "AIR")
+        self.last_arc = host_time
+
+    def _transition(self, phase, host_time, device_ms=-1, inferred=False):
+        if phase == self.phase:
+            return
+        if phase == "MIST":
+            self.shot += 1
+        self.phase = phase
+        if phase != "ARC":
+            self.last_arc = None
+        self.events.append((host_time, device_ms, PHASES.index(phase), inferred, self.shot))
+
+# Class collecting parsed events and writing them out as columnar chunks.
+class ChunkWriter:
+    """Write events and messages to .npz chunks tagged with the trial, prototype and distance."""
+
+    def __init__(self, output_dir, trial, prototype, distance=None, chunk_events=1024, metadata=None):
+        self.output_dir = output_dir
+        self.tag = f"T{trial}P{prototype}" + (f"-{distance:g}FOOT" if distance is not None else "")
+        self.metadata = dict(metadata or {}, trial=trial, prototype=prototype, distance=distance, phases=PHASES)
+        self.chunk_events = chunk_events
+        self.session = time.strftime("%Y%m%dT%H%M%S")
+        self.index = 0
+        self.events = []
+        self.messages = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, events, messages):
+        self.events.extend(events)
+        self.messages.extend(messages)
+        if len(self.events) + len(self.messages) >= self.chunk_events:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Write the buffered rows, if any, and return the chunk path."""
+        if not self.events and not self.messages:
+            return None
+        events = np.array(self.events, dtype=[("host_time", "f8"), ("device_ms", "i8"), ("phase", "u1"),
+                                              ("inferred", "?"), ("shot", "i4")])
+        path = os.path.join(self.output_dir, f"{self.tag}-{self.session}-{self.index:05d}.npz")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as handle:
+            np.savez_compressed(handle, **{name: events[name] for name in events.dtype.names},
+                                message_time=np.array([m[0] for m in self.messages], dtype="f8"),
+                                message=np.array([m[1] for m in self.messages], dtype=str),
+                                metadata=np.array(json.dumps(self.metadata)))
+        os.replace(tmp_path, path)
+        self.index += 1
+        self.events, self.messages = [], []
+        return path
+
+# Function to read every chunk of a session back into one table.
+def read_chunks(pattern):
+    """Return a dict of event columns, with trial, prototype and distance columns from each chunk's tags."""
+    columns = {}
+    for path in sorted(glob.glob(pattern)):
+        with np.load(path) as chunk:
+            meta = json.loads(str(chunk["metadata"]))
+            count = len(chunk["host_time"])
+            for name in ("host_time", "device_ms", "phase", "inferred", "shot"):
+                columns.setdefault(name, []).append(chunk[name])
+            for name in ("trial", "prototype", "distance"):
+                value = np.nan if meta[name] is None else meta[name]
+                columns.setdefault(name, []).append(np.full(count, value))
+    return {name: np.concatenate(parts) for name, parts in columns.items()}
+
+# Function to put a serial port or pty into raw mode at the given baud rate.
+def open_port(port, baud=BAUD):
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    # TCSANOW keeps anything the firmware sent before the port was opened
+    tty.setraw(fd, termios.TCSANOW)
+    attributes = termios.tcgetattr(fd)
+    speed = getattr(termios, f"B{baud}")
+    attributes[4] = attributes[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    return fd
+
+# Function to read a port until it closes or the duration runs out, writing chunks as it goes.
+async def ingest(port, writer, baud=BAUD, duration=None, buffer_size=1 << 16, arc_gap=0.5):
+    """Return (bytes read, bytes dropped, parser) after ingesting the port."""
+    loop = asyncio.get_running_loop()
+    fd = open_port(port, baud)
+    ring = RingBuffer(buffer_size)
+    parser = PhaseParser(arc_gap)
+    readable = asyncio.Event()
+    closed = asyncio.Event()
+    total = 0
+
+    # The reader only copies bytes into the ring so parsing and disk writes never hold up the port
+    def on_readable():
+        nonlocal total
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as error:
+            if error.errno != errno.EIO:
+                raise
+            data = b""
+        if not data:
+            loop.remove_reader(fd)
+            closed.set()
+        ring.write(data)
+        total += len(data)
+        readable.set()
+
+    loop.add_reader(fd, on_readable)
+    deadline = None if duration is None else loop.time() + duration
+    try:
+        while not closed.is_set() and (deadline is None or loop.time() < deadline):
+            try:
+                await asyncio.wait_for(readable.wait(), timeout=0.1)
+            except asyncio.TimeoutError:
+                pass
+            readable.clear()
+            now = time.time()
+            # Checking before feeding lets a silence that ends with new data still close the arc
+            parser.check(now)
+            parser.feed(ring.read(), now)
+            parser.check(now)
+            writer.add(parser.events, parser.messages)
+            parser.events, parser.messages = [], []
+    finally:
+        if not closed.is_set():
+            loop.remove_reader(fd)
+        os.close(fd)
+    # Whatever is left belongs to the last shot
+    parser.feed(ring.read() + b"\n", time.time())
+    parser.check(float("inf"))
+    writer.add(parser.events, parser.messages)
+    writer.flush()
+    return total, ring.dropped, parser
+
+# Function to write to the simulated port at no more than the serial line rate.
+def paced_write(fd, data, baud, speed):
+    if baud:
+        # Ten bits per byte on the wire (start, eight data, stop)
+        time.sleep(len(data) * 10 / baud / speed)
+    os.write(fd, data)
+
+# Function to stand in for the firmware on a pty.
+def simulate(fd, shots, interval=1.0, protocol="legacy", baud=BAUD, speed=1.0):
+    """Write the serial output of shots firing cycles to fd, with time compressed by speed.
+
+    The legacy protocol matches Mixing_Main.ino as it is: nothing during the mist and air phases
+    and "Flying..." without newlines during the arc. The phases protocol adds "<millis> <PHASE>"
+    lines at every phase change.
+    """
+    start = time.monotonic()
+
+    def millis():
+        return int((time.monotonic() - start) * 1000 * speed)
+
+    def report(phase):
+        if protocol == "phases":
+            paced_write(fd, f"{millis()} {phase}\n".encode(), baud, speed)
+
+    for _ in range(shots):
+        time.sleep(interval / speed)
+        report("MIST")
+        time.sleep(MISTING_TIME_MS / 1000 / speed)
+        report("AIR")
+        time.sleep(AIR_TIME_MS / 1000 / speed)
+        report("ARC")
+        arc_end = millis() + ARC_TIME_MS
+        while millis() < arc_end:
+            paced_write(fd, ARC_TOKEN, baud or BAUD, speed)
+        report("IDLE")
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Ingest the Mixing_Main serial stream, or simulate the firmware on a pty.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='Read a serial port and write tagged chunks.')
+    ingest_parser.add_argument('port', type=str, help='Serial device, e.g. /dev/ttyACM0, or the pty printed by simulate.')
+    ingest_parser.add_argument('output_dir', type=str, help='Directory to save the chunks.')
+    ingest_parser.add_argument('--trial', type=int, required=True, help='Trial number the shots belong to.')
+    ingest_parser.add_argument('--prototype', type=int, required=True, help='Prototype number the shots belong to.')
+    ingest_parser.add_argument('--distance', type=float, default=None, help='Distance in feet the shots are fired at.')
+    ingest_parser.add_argument('--baud', type=int, default=BAUD, help='Baud rate of the port.')
+    ingest_parser.add_argument('--duration', type=float, default=None, help='Stop after this many seconds.')
+    ingest_parser.add_argument('--buffer-size', type=int, default=1 << 16, help='Ring buffer size in bytes.')
+    ingest_parser.add_argument('--arc-gap', type=float, default=0.5, help='Seconds without "Flying..." after which the arc counts as over.')
+    ingest_parser.add_argument('--chunk-events', type=int, default=1024, help='Rows per chunk file.')
+    simulate_parser = subparsers.add_parser('simulate', help='Run a stand-in for the firmware on a pty.')
+    simulate_parser.add_argument('--shots', type=int, default=3, help='Number of firing cycles.')
+    simulate_parser.add_argument('--interval', type=float, default=1.0, help='Idle seconds before each shot.')
+    simulate_parser.add_argument('--protocol', type=str, default='legacy', choices=['legacy', 'phases'], help='Output format of the firmware.')
+    simulate_parser.add_argument('--speed', type=float, default=1.0, help='Time compression factor.')
+    simulate_parser.add_argument('--baud', type=int, default=BAUD, help='Line rate to pace the output at, 0 for unpaced phase lines.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        # Ingest the port until it closes
+        writer = ChunkWriter(args.output_dir, args.trial, args.prototype, args.distance, args.chunk_events,
+                             {"port": args.port, "baud": args.baud})
+        start = time.perf_counter()
+        total, dropped, phases = asyncio.run(ingest(args.port, writer, args.baud, args.duration, args.buffer_size,
+                                                  args.arc_gap))
+        elapsed = time.perf_counter() - start
+        print(f"Read {total} bytes in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} B/s), dropped {dropped}; "
+              f"{phases.shot} shots in {writer.index} chunks in {args.output_dir}")
+    else:
+        # Serve the simulated firmware until the shots are done
+        master, slave = pty.openpty()
+        # Raw from the start so nothing written before the reader attaches gets echoed or translated
+        tty.setraw(slave)
+        print(os.ttyname(slave), flush=True)
+        try:
+            simulate(master, args.shots, args.interval, args.protocol, args.baud, args.speed)
+        finally:
+            # Give the reader a moment to drain before the pty goes away
+            time.sleep(0.5)
+            os.close(master)
+            os.close(slave)
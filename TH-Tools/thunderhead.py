@@ -0,0 +1,231 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program. Only the standard library is imported here; each
+# subcommand imports the tools it needs when it runs, so a client talking to a worker starts quickly.
+import os
+import sys
+import json
+import signal
+import socket
+import getpass
+import argparse
+import tempfile
+import importlib
+import traceback
+import contextlib
+
+# Tool behind each subcommand; only the tool of the subcommand being run is imported
+TOOLS = {
+    'compile': ('compile_excel', 'Compile the per-distance workbooks of a trial into one workbook.'),
+    'plot': ('plot_single', 'Plot heatmaps for each sheet of a workbook.'),
+    'average': ('plot_average', 'Plot averaged heatmaps across trials.'),
+    'detect': ('batch_detect', 'Detect candles in every photo of a directory using a saved grid layout.'),
+}
+
+# Modules the worker loads once up front, so jobs do not pay for importing them
+WARM_MODULES = ["numpy", "openpyxl", "cv2", "matplotlib.pyplot", "seaborn", "compile_excel", "plot_single",
+                "plot_average", "batch_detect", "heatmap_render", "profiling"]
+
+# Exception raised in the worker by SIGTERM; unlike SystemExit the jobs do not catch it, so the worker stops.
+class WorkerStopped(BaseException):
+    pass
+
+# Function to return the default socket of the persistent worker, private to the current user.
+def default_socket():
+    user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f"thunderhead-{user}.sock")
+
+# Function to find the subcommand of a command line without parsing it.
+def find_command(argv):
+    return next((arg for arg in argv if arg in TOOLS or arg == 'serve'), None)
+
+# Function to build the argument parser from the options of the individual scripts.
+def build_parser(command=None):
+    """Only the tool of command is imported and given its options, so the other subcommands cost nothing."""
+    parser = argparse.ArgumentParser(prog='thunderhead', description='Run the ThunderHead tools from one entry point.')
+    parser.add_argument('--server', action='store_true', help='Send the command to a running worker instead of running it here.')
+    parser.add_argument('--socket', type=str, default=None, help='Socket of the worker (default: a per-user socket in the temporary directory).')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (module, help_text) in TOOLS.items():
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text)
+        if name == command:
+            tool = importlib.import_module(module)
+            tool.add_arguments(subparser)
+            subparser.set_defaults(tool=tool, parser=subparser)
+    subparsers.add_parser('serve', help='Keep the tools loaded and run commands sent over the socket.')
+    return parser
+
+# Function to parse a command line, importing only the tool it runs.
+def parse_command(argv):
+    return build_parser(find_command(argv)).parse_args(argv)
+
+# Function to run one parsed command, returning its exit status.
+def execute(args):
+    try:
+        args.tool.run(args, args.parser)
+    except SystemExit as error:
+        if isinstance(error.code, str):
+            print(error.code, file=sys.stderr)
+            return 1
+        return error.code or 0
+    finally:
+        # Write the profile of a job that failed part way too, and never leave profiling on in the worker
+        if getattr(args, 'profile', None):
+            import profiling
+
+            profiling.finish(args.profile)
+    return 0
+
+# Class that forwards everything a job prints to the client as it is printed.
+class SocketWriter:
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def write(self, text):
+        if text:
+            self.stream.write(json.dumps({self.name: text}) + "\n")
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+# Function to run one job received by the worker.
+def handle_job(request, stream):
+    """Run the argv of a request in the client's directory and return the exit status.
+
+    WorkerStopped is re-raised after telling the client, so the worker reports the job as failed and shuts down.
+    """
+    previous_dir = os.getcwd()
+    stdout, stderr = SocketWriter(stream, "stdout"), SocketWriter(stream, "stderr")
+    try:
+        os.chdir(request["cwd"])
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                args = parse_command(request["argv"])
+                if args.command == 'serve':
+                    raise SystemExit("the worker cannot start another worker")
+                return execute(args)
+            except SystemExit as error:
+                if isinstance(error.code, str):
+                    print(error.code, file=sys.stderr)
+                    return 1
+                return error.code or 0
+            except Exception:
+                traceback.print_exc()
+                return 1
+            except (WorkerStopped, KeyboardInterrupt):
+                print("Job interrupted: the worker is stopping", file=sys.stderr)
+                raise
+    finally:
+        os.chdir(previous_dir)
+
+# Function to raise WorkerStopped when the worker is sent SIGTERM.
+def stop_worker(signum, frame):
+    raise WorkerStopped()
+
+# Function to check whether a worker is already listening on a socket.
+def worker_running(socket_path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+# Function to keep the tools loaded and run the jobs sent over a Unix socket, one at a time.
+def serve(socket_path):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit("The worker needs Unix domain sockets, which this platform does not provide; "
+                         "run the commands without --server instead.")
+    if os.path.exists(socket_path):
+        if worker_running(socket_path):
+            raise SystemExit(f"A worker is already listening on {socket_path}")
+        # Left behind by a worker that did not shut down cleanly
+        os.remove(socket_path)
+    for module in WARM_MODULES:
+        importlib.import_module(module)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the current user may connect
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    # Stop cleanly on SIGTERM too, since a worker started in the background ignores Ctrl+C. Processes forked by a
+    # job's pool go back to the default, as Pool.terminate() stops them with SIGTERM.
+    signal.signal(signal.SIGTERM, stop_worker)
+    os.register_at_fork(after_in_child=lambda: signal.signal(signal.SIGTERM, signal.SIG_DFL))
+    print(f"ThunderHead worker listening on {socket_path}, press Ctrl+C to stop", flush=True)
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile("rw", encoding="utf-8") as stream:
+                line = stream.readline()
+                if not line:
+                    continue
+                try:
+                    status = handle_job(json.loads(line), stream)
+                except (WorkerStopped, KeyboardInterrupt) as error:
+                    # Exit status of a process killed by the signal
+                    status = 128 + (signal.SIGTERM if isinstance(error, WorkerStopped) else signal.SIGINT)
+                    stream.write(json.dumps({"exit": status}) + "\n")
+                    stream.flush()
+                    raise
+                stream.write(json.dumps({"exit": status}) + "\n")
+                stream.flush()
+    except (WorkerStopped, KeyboardInterrupt):
+        print("Worker stopped")
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+# Function to send a command to the worker and relay what it prints, returning its exit status or None if there is no worker.
+def submit(socket_path, argv):
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+    with client, client.makefile("rw", encoding="utf-8") as stream:
+        stream.write(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            target = sys.stdout if "stdout" in message else sys.stderr
+            target.write(message.get("stdout", message.get("stderr")))
+            target.flush()
+    return 1
+
+if __name__ == "__main__":
+    # Parse the client options; the subcommand itself is only parsed where it runs
+    client_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    client_parser.add_argument('--server', action='store_true')
+    client_parser.add_argument('--socket', type=str, default=None)
+    client_args, argv = client_parser.parse_known_args()
+    socket_path = client_args.socket or default_socket()
+
+    if client_args.server and find_command(argv) not in (None, 'serve'):
+        # Hand the rest of the command line to the worker, which reports any errors in it
+        status = submit(socket_path, argv)
+        if status is None:
+            print(f"No worker on {socket_path}; running here instead", file=sys.stderr)
+            status = execute(parse_command(sys.argv[1:]))
+        sys.exit(status)
+
+    # Parse the arguments
+    args = parse_command(sys.argv[1:])
+    if args.command == 'serve':
+        serve(socket_path)
+    else:
+        sys.exit(execute(args))
@@ -0,0 +1,190 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import re
+import json
+import argparse
+import numpy as np
+import catalog
+
+# File names used inside a cube directory.
+CUBE_FILE = "cube.npy"
+META_FILE = "cube_meta.json"
+CUBE_VERSION = 1
+
+# Compiled per-trial workbooks live at TH-Data/T{n}P{m}/Data/T{n}P{m}.xlsx
+WORKBOOK_PATTERN = re.compile(r'^T(\d+)P(\d+)\.xlsx$')
+
+# Function to find every compiled trial workbook under the data directory.
+def find_trial_workbooks(data_root):
+    """Return a sorted list of (trial, prototype, path) for each T{n}P{m}.xlsx workbook."""
+    found = []
+    for entry in sorted(os.listdir(data_root)):
+        data_dir = os.path.join(data_root, entry, "Data")
+        if not os.path.isdir(data_dir):
+            continue
+        for file_name in sorted(os.listdir(data_dir)):
+            match = WORKBOOK_PATTERN.match(file_name)
+            if match:
+                found.append((int(match.group(1)), int(match.group(2)), os.path.join(data_dir, file_name)))
+    return found
+
+# Function to parse every sheet of a workbook into numeric matrices.
+def parse_workbook(path):
+    """Return a dict of sheet name -> 2D float array, keeping only all-numeric rows."""
+    # openpyxl is only needed when a workbook actually has to be re-parsed.
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    sheets = {}
+    try:
+        for sheet_name in workbook.sheetnames:
+            rows = [list(row) for row in workbook[sheet_name].iter_rows(values_only=True)
+                    if row and all(isinstance(cell, (int, float)) for cell in row)]
+            sheets[sheet_name] = np.array(rows, dtype=np.float32)
+    finally:
+        workbook.close()
+    return sheets
+
+# Function to read the metadata sidecar of a cube directory.
+def load_meta(cube_dir):
+    """Return the cube metadata, or None if the cube has not been built yet."""
+    meta_path = os.path.join(cube_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as handle:
+        meta = json.load(handle)
+    if meta.get("version") != CUBE_VERSION:
+        return None
+    return meta
+
+# Function to open the cube array as a read-only memory map.
+def load_cube(cube_dir):
+    """Return (cube, meta) where cube is a memory-mapped (trial, prototype, distance, row, col) array."""
+    meta = load_meta(cube_dir)
+    if meta is None:
+        raise FileNotFoundError(f"No trial cube found in {cube_dir}. Build it with trial_cube.py first.")
+    cube = np.load(os.path.join(cube_dir, CUBE_FILE), mmap_mode="r")
+    return cube, meta
+
+# Function to convert the TH-Data workbooks into the cube, re-parsing only changed files.
+def build_cube(data_root, cube_dir):
+    """Build or refresh the trial cube in cube_dir from the workbooks under data_root."""
+    os.makedirs(cube_dir, exist_ok=True)
+    old_meta = load_meta(cube_dir)
+    old_sources = old_meta["sources"] if old_meta else {}
+    old_cube = np.load(os.path.join(cube_dir, CUBE_FILE), mmap_mode="r") if old_meta else None
+
+    # Decide which workbooks can be reused from the existing cube
+    sources = {}
+    parsed = {}
+    for trial, prototype, path in find_trial_workbooks(data_root):
+        key = os.path.relpath(path, data_root)
+        mtime = os.path.getmtime(path)
+        previous = old_sources.get(key)
+        if previous and previous["mtime"] == mtime:
+            sources[key] = previous
+            continue
+        digest = catalog.file_hash(path)
+        if previous and previous["sha256"] == digest:
+            sources[key] = dict(previous, mtime=mtime)
+            continue
+        sheets = parse_workbook(path)
+        parsed[key] = sheets
+        sources[key] = {
+            "trial": trial,
+            "prototype": prototype,
+            "mtime": mtime,
+            "sha256": digest,
+            "sheets": {name: list(matrix.shape) for name, matrix in sheets.items() if matrix.size > 0},
+        }
+        print(f"Parsed {key}")
+
+    # Work out the axes of the new cube
+    trials = sorted({info["trial"] for info in sources.values()})
+    prototypes = sorted({info["prototype"] for info in sources.values()})
+    distances = sorted({name for info in sources.values() for name in info["sheets"]},
+                       key=lambda name: catalog.parse_distance(name, float('inf')))
+    shapes = [shape for info in sources.values() for shape in info["sheets"].values()]
+    grid = [max((s[0] for s in shapes), default=0), max((s[1] for s in shapes), default=0)]
+
+    # Write the new cube into a temporary file, copying unchanged blocks from the old one
+    tmp_path = os.path.join(cube_dir, CUBE_FILE + ".tmp")
+    cube = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                     shape=(len(trials), len(prototypes), len(distances), grid[0], grid[1]))
+    cube[...] = np.nan
+    for key, info in sources.items():
+        t = trials.index(info["trial"])
+        p = prototypes.index(info["prototype"])
+        for sheet_name, (rows, cols) in info["sheets"].items():
+            d = distances.index(sheet_name)
+            if key in parsed:
+                cube[t, p, d, :rows, :cols] = parsed[key][sheet_name]
+            else:
+                old_t = old_meta["trials"].index(info["trial"])
+                old_p = old_meta["prototypes"].index(info["prototype"])
+                old_d = old_meta["distances"].index(sheet_name)
+                cube[t, p, d, :rows, :cols] = old_cube[old_t, old_p, old_d, :rows, :cols]
+    cube.flush()
+    del cube, old_cube
+
+    # Drop the old sidecar before swapping the cube so a crash forces a full rebuild instead of a mismatch
+    if old_meta:
+        os.remove(os.path.join(cube_dir, META_FILE))
+    os.replace(tmp_path, os.path.join(cube_dir, CUBE_FILE))
+
+    # Write the metadata sidecar last so it always describes the cube on disk
+    meta = {
+        "version": CUBE_VERSION,
+        "data_root": os.path.abspath(data_root),
+        "trials": trials,
+        "prototypes": prototypes,
+        "distances": distances,
+        "grid": grid,
+        "sources": sources,
+    }
+    tmp_meta = os.path.join(cube_dir, META_FILE + ".tmp")
+    with open(tmp_meta, "w") as handle:
+        json.dump(meta, handle, indent=2)
+    os.replace(tmp_meta, os.path.join(cube_dir, META_FILE))
+    print(f"Trial cube with {len(sources)} workbooks ({len(parsed)} re-parsed) saved to {cube_dir}")
+    return meta
+
+# Function to fetch one matrix from the cube, trimmed back to its original shape.
+def get_matrix(cube, meta, trial, prototype, distance):
+    """Return the matrix for a trial, prototype and distance sheet name."""
+    t = meta["trials"].index(trial)
+    p = meta["prototypes"].index(prototype)
+    d = meta["distances"].index(distance)
+    for info in meta["sources"].values():
+        if info["trial"] == trial and info["prototype"] == prototype and distance in info["sheets"]:
+            rows, cols = info["sheets"][distance]
+            return np.array(cube[t, p, d, :rows, :cols], dtype=float)
+    raise KeyError(f"No data for T{trial}P{prototype} at {distance}")
+
+# Function to read a workbook's sheets from the cube instead of parsing it with openpyxl.
+def read_workbook_sheets(cube_dir, excel_file):
+    """Return a list of (sheet name, matrix) for a workbook stored in the cube, in workbook order."""
+    cube, meta = load_cube(cube_dir)
+    key = os.path.relpath(os.path.abspath(excel_file), meta["data_root"])
+    info = meta["sources"].get(key)
+    if info is None:
+        raise KeyError(f"{excel_file} is not part of the trial cube in {cube_dir}")
+    if (os.path.exists(excel_file) and os.path.getmtime(excel_file) != info["mtime"]
+            and catalog.file_hash(excel_file) != info["sha256"]):
+        raise ValueError(f"{excel_file} changed since the trial cube was built. Rebuild it with trial_cube.py.")
+    return [(name, get_matrix(cube, meta, info["trial"], info["prototype"], name)) for name in info["sheets"]]
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Convert the TH-Data trial workbooks into a memory-mapped trial cube.')
+    parser.add_argument('data_root', type=str, help='Path to the TH-Data directory.')
+    parser.add_argument('cube_dir', type=str, help='Directory to store the cube and its metadata.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Build or refresh the cube
+    build_cube(args.data_root, args.cube_dir)
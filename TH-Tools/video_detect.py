@@ -0,0 +1,152 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import csv
+import queue
+import argparse
+import threading
+import numpy as np
+import cv2
+import openpyxl
+import candle_detection
+
+# Function to put an item on the frame queue without blocking past a stop request.
+def put_frame(frames, item, stop):
+    while not stop.is_set():
+        try:
+            frames.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+# Function to read frames on a background thread, cropped to the grid, into a bounded queue.
+def read_frames(capture, frames, roi, stop):
+    """Push cropped BGR frames onto frames until the video ends, then push None, or the exception if reading failed."""
+    y0, y1, x0, x1 = roi
+    end = None
+    try:
+        while not stop.is_set():
+            ok, frame = capture.read()
+            if not ok:
+                break
+            # Only the grid region is kept so the queue never holds full frames
+            put_frame(frames, frame[y0:y1, x0:x1].copy(), stop)
+    except Exception as error:
+        # Hand the error to the consumer, which re-raises it, instead of ending the stream as if the video were done
+        end = error
+    put_frame(frames, end, stop)
+
+# Function to stream a recording through the grid and track when each candle goes out.
+def process_video(video_file, grid_points, grid_rows=candle_detection.GRID_ROWS, grid_cols=candle_detection.GRID_COLS,
+                  min_fraction=0.0, queue_size=32):
+    """Return (extinguish_times, times, lit_counts) for a recording of one shot.
+
+    extinguish_times holds, per cell, the time in seconds of the first frame after which the candle stays
+    dark. Cells that were never lit, or are still lit at the end, are NaN.
+    """
+    capture = cv2.VideoCapture(video_file)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video {video_file}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_shape = (int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+    # The cell label map is built once for the whole recording
+    cells = (grid_rows - 1, grid_cols - 1)
+    labels, areas = candle_detection.cell_labels(grid_points, frame_shape, grid_rows, grid_cols)
+    roi = candle_detection.grid_roi(grid_points, frame_shape)
+    areas = np.maximum(areas, 1)
+
+    frames = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_frames, args=(capture, frames, roi, stop), daemon=True)
+    reader.start()
+
+    last_lit = np.full(cells, -1)
+    ever_lit = np.zeros(cells, dtype=bool)
+    lit_counts = []
+    try:
+        index = 0
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            if isinstance(frame, Exception):
+                raise frame
+            mask = candle_detection.flame_mask(frame, bgr=True)
+            flame_area = np.bincount(labels[mask > 0], minlength=areas.size + 1)[1:]
+            lit = (flame_area / areas > min_fraction).reshape(cells)
+            last_lit[lit] = index
+            ever_lit |= lit
+            lit_counts.append(int(lit.sum()))
+            index += 1
+    finally:
+        stop.set()
+        reader.join()
+        capture.release()
+
+    # A candle is out from the frame after the last one it was lit in
+    frame_count = len(lit_counts)
+    times = np.arange(frame_count) / fps
+    extinguished = ever_lit & (last_lit < frame_count - 1)
+    extinguish_times = np.full(cells, np.nan)
+    extinguish_times[extinguished] = (last_lit[extinguished] + 1) / fps
+    return extinguish_times, times, np.array(lit_counts)
+
+# Function to find when the knockdown starts from the lit-count time series.
+def knockdown_start(times, lit_counts):
+    """Return the first time the lit count falls below its starting value, or None if it never does."""
+    if len(lit_counts) == 0:
+        return None
+    dropped = np.nonzero(lit_counts < lit_counts[0])[0]
+    return float(times[dropped[0]]) if dropped.size else None
+
+# Function to save the video results next to the still-image matrices.
+def save_video_results(extinguish_times, times, lit_counts, output_dir, stem):
+    # Ensure output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Time-to-extinguish matrix, leaving cells without a value empty
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for r in range(extinguish_times.shape[0]):
+        for c in range(extinguish_times.shape[1]):
+            value = extinguish_times[r, c]
+            sheet.cell(row=r + 1, column=c + 1, value=None if np.isnan(value) else float(value))
+    extinguish_file = os.path.join(output_dir, f"{stem}-extinguish.xlsx")
+    workbook.save(extinguish_file)
+
+    # Lit-count time series, one row per frame
+    series_file = os.path.join(output_dir, f"{stem}-litcount.csv")
+    with open(series_file, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["time_s", "lit"])
+        writer.writerows(zip(np.round(times, 6), lit_counts))
+    return extinguish_file, series_file
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Measure per-candle time to extinguish from a recording of one shot.')
+    parser.add_argument('video_file', type=str, help='Path to the recording.')
+    parser.add_argument('layout_file', type=str, help='Grid layout (.npy) saved from the grid candle counter.')
+    parser.add_argument('output_dir', type=str, help='Directory to save the results, e.g. TH-Data/T1P1/Data/Video.')
+    parser.add_argument('--rows', type=int, default=candle_detection.GRID_ROWS, help='Number of grid point rows in the layout.')
+    parser.add_argument('--cols', type=int, default=candle_detection.GRID_COLS, help='Number of grid point columns in the layout.')
+    parser.add_argument('--min-fraction', type=float, default=0.0, help='Fraction of a cell that must be flame for it to count as lit.')
+    parser.add_argument('--queue-size', type=int, default=32, help='Maximum number of decoded frames held in memory.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Process the recording
+    grid_points = np.load(args.layout_file).tolist()
+    extinguish_times, times, lit_counts = process_video(args.video_file, grid_points, args.rows, args.cols,
+                                                        args.min_fraction, args.queue_size)
+    stem = os.path.splitext(os.path.basename(args.video_file))[0]
+    extinguish_file, series_file = save_video_results(extinguish_times, times, lit_counts, args.output_dir, stem)
+    start = knockdown_start(times, lit_counts)
+    print(f"Processed {len(lit_counts)} frames; knockdown starts at "
+          f"{'n/a' if start is None else f'{start:.3f}s'}")
+    print(f"Time-to-extinguish matrix saved to {extinguish_file} and lit counts to {series_file}")
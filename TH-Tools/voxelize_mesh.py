@@ -0,0 +1,190 @@
+# Copyright (c) 2024, John Simonis and The Ohio State University
+# This code was written by John Simonis for the ThunderHead research project at The Ohio State University.
+
+# Python modules required by the current program
+import os
+import json
+import math
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+import trimesh
+
+# Bump when the voxelization changes so stale cache entries are not reused
+CACHE_VERSION = 1
+
+# Small ray offsets so rays never pass exactly through mesh vertices or edges
+RAY_JITTER = (1.234e-4, 2.345e-4)
+
+# Function to parse rotations written as "x:180", matching the float3x3(axis, angle) products in Setup*.cpp.
+def rotation_matrix(rotations):
+    """Return the 3x3 product of the given axis:degrees rotations, applied right to left like the C++ setups."""
+    matrix = np.eye(3)
+    for rotation in rotations:
+        axis, degrees = rotation.split(":")
+        direction = {"x": [1, 0, 0], "y": [0, 1, 0], "z": [0, 0, 1]}[axis.lower()]
+        matrix = matrix @ trimesh.transformations.rotation_matrix(math.radians(float(degrees)), direction)[:3, :3]
+    return matrix
+
+# Function to place a mesh in the simulation box the way FluidX3D's read_stl does.
+def place_mesh(mesh, resolution, rotations=(), size=None, offset=(0.0, 0.0, 0.0)):
+    """Return a copy of mesh rotated, scaled so its longest side is size cells, and centred in the box."""
+    placed = mesh.copy()
+    transform = np.eye(4)
+    transform[:3, :3] = rotation_matrix(rotations)
+    placed.apply_transform(transform)
+    if size is None:
+        # Without a size the mesh is scaled to fit the box
+        scale = float(np.min(np.asarray(resolution) / placed.extents))
+    else:
+        scale = size / float(placed.extents.max())
+    placed.apply_scale(scale)
+    center = 0.5 * (placed.bounds[0] + placed.bounds[1])
+    placed.apply_translation(0.5 * np.asarray(resolution, dtype=float) - center + np.asarray(offset, dtype=float))
+    return placed
+
+# Function to voxelize the rows y0:y1 of the grid by casting rays along z and filling by parity.
+def voxelize_slab(job):
+    """Return a (Nz, y1 - y0, Nx) boolean array of the cells whose centres lie inside the triangles' mesh."""
+    triangles, resolution, y0, y1 = job
+    nx, ny, nz = resolution
+    toggles = np.zeros((y1 - y0, nx, nz + 1), dtype=np.uint8)
+
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    lo = np.minimum(np.minimum(a, b), c)
+    hi = np.maximum(np.maximum(a, b), c)
+    # Column index ranges whose ray (through the cell centre) can hit each triangle
+    ix0 = np.clip(np.ceil(lo[:, 0] - 0.5 - RAY_JITTER[0]), 0, nx).astype(int)
+    ix1 = np.clip(np.floor(hi[:, 0] - 0.5 - RAY_JITTER[0]) + 1, 0, nx).astype(int)
+    iy0 = np.clip(np.ceil(lo[:, 1] - 0.5 - RAY_JITTER[1]), y0, y1).astype(int)
+    iy1 = np.clip(np.floor(hi[:, 1] - 0.5 - RAY_JITTER[1]) + 1, y0, y1).astype(int)
+    width = np.maximum(ix1 - ix0, 0)
+    counts = width * np.maximum(iy1 - iy0, 0)
+
+    # Expand every triangle into the (x, y) rays inside its bounding box
+    tri = np.repeat(np.arange(len(triangles)), counts)
+    if tri.size == 0:
+        return np.zeros((nz, y1 - y0, nx), dtype=bool)
+    local = np.arange(tri.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = ix0[tri] + local % width[tri]
+    y = iy0[tri] + local // width[tri]
+    px = x + 0.5 + RAY_JITTER[0]
+    py = y + 0.5 + RAY_JITTER[1]
+
+    # Barycentric coordinates of the ray in the triangle's xy projection
+    ax, ay, az = a[tri, 0], a[tri, 1], a[tri, 2]
+    bx, by, bz = b[tri, 0], b[tri, 1], b[tri, 2]
+    cx, cy, cz = c[tri, 0], c[tri, 1], c[tri, 2]
+    det = (bx - ax) * (cy - ay) - (cx - ax) * (by - ay)
+    w1 = ((px - ax) * (cy - ay) - (cx - ax) * (py - ay)) / np.where(det == 0, 1, det)
+    w2 = ((bx - ax) * (py - ay) - (px - ax) * (by - ay)) / np.where(det == 0, 1, det)
+    w0 = 1 - w1 - w2
+    hit = (det != 0) & (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+    # Each crossing flips inside/outside for every cell centre above it
+    z = w0[hit] * az[hit] + w1[hit] * bz[hit] + w2[hit] * cz[hit]
+    kz = np.clip(np.ceil(z - 0.5), 0, nz).astype(int)
+    np.add.at(toggles, (y[hit] - y0, x[hit], kz), 1)
+    inside = (np.cumsum(toggles, axis=2) % 2).astype(bool)[..., :nz]
+    return np.ascontiguousarray(inside.transpose(2, 0, 1))
+
+# Function to voxelize a placed mesh, splitting the grid rows across processes.
+def voxelize(mesh, resolution, n_jobs=1):
+    """Return a (Nz, Ny, Nx) boolean solid mask for a mesh already placed in grid coordinates."""
+    triangles = np.asarray(mesh.triangles, dtype=np.float64)
+    ny = resolution[1]
+    slabs = max(1, min(ny, n_jobs * 4))
+    bounds = np.linspace(0, ny, slabs + 1).astype(int)
+    jobs = [(triangles, tuple(resolution), int(y0), int(y1)) for y0, y1 in zip(bounds[:-1], bounds[1:]) if y1 > y0]
+    if n_jobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(n_jobs) as pool:
+            parts = pool.map(voxelize_slab, jobs)
+    else:
+        parts = [voxelize_slab(job) for job in jobs]
+    return np.concatenate(parts, axis=1)
+
+# Function to measure the launcher opening from the voxel grid.
+def nozzle_aperture(solid, axis=1):
+    """Return the smallest enclosed open area (in cells) of any slice across the firing axis, or 0 if none."""
+    smallest = 0
+    for index in range(solid.shape[2 - axis]):
+        section = np.take(solid, index, axis=2 - axis).astype(np.uint8)
+        if not section.any():
+            continue
+        # Flood the outside from a padded border; open cells it cannot reach are enclosed by the launcher
+        padded = np.pad(section, 1)
+        flood_mask = np.zeros((padded.shape[0] + 2, padded.shape[1] + 2), dtype=np.uint8)
+        cv2.floodFill(padded, flood_mask, (0, 0), 2)
+        enclosed = int(np.count_nonzero(padded == 0))
+        if enclosed and (smallest == 0 or enclosed < smallest):
+            smallest = enclosed
+    return smallest
+
+# Function to summarise a voxelized launcher for parameter studies.
+def voxel_report(placed, solid, axis=1):
+    aperture = nozzle_aperture(solid, axis)
+    return {
+        "resolution": [int(solid.shape[2]), int(solid.shape[1]), int(solid.shape[0])],
+        "solid_cells": int(solid.sum()),
+        "mesh_volume_cells": float(placed.volume),
+        "aperture_cells": aperture,
+        "aperture_diameter_cells": 2 * math.sqrt(aperture / math.pi),
+        "bounds_cells": placed.bounds.tolist(),
+    }
+
+# Function to voxelize an STL through the content-addressed cache.
+def voxelize_stl(stl_file, resolution, rotations=(), size=None, offset=(0.0, 0.0, 0.0), cache_dir=".voxel-cache",
+                 n_jobs=1, axis=1):
+    """Return (solid, report), loading them from cache_dir when this mesh and these parameters were seen before."""
+    with open(stl_file, "rb") as handle:
+        mesh_hash = hashlib.sha256(handle.read()).hexdigest()
+    params = {"version": CACHE_VERSION, "mesh": mesh_hash, "resolution": list(resolution),
+              "rotations": list(rotations), "size": size, "offset": list(offset), "axis": axis}
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    grid_file = os.path.join(cache_dir, f"{key}.npz")
+    report_file = os.path.join(cache_dir, f"{key}.json")
+
+    if os.path.exists(grid_file) and os.path.exists(report_file):
+        with np.load(grid_file) as stored:
+            solid = np.unpackbits(stored["bits"], count=int(np.prod(stored["shape"]))).reshape(stored["shape"]).astype(bool)
+        with open(report_file) as handle:
+            report = json.load(handle)
+        report["cached"] = True
+        return solid, report
+
+    placed = place_mesh(trimesh.load(stl_file, force="mesh"), resolution, rotations, size, offset)
+    solid = voxelize(placed, resolution, n_jobs)
+    report = dict(voxel_report(placed, solid, axis), stl=os.path.basename(stl_file), params=params)
+
+    # Store the grid bit-packed, writing the report last so a partial entry is never reused
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez_compressed(grid_file, bits=np.packbits(solid), shape=np.array(solid.shape))
+    with open(report_file, "w") as handle:
+        json.dump(report, handle, indent=2)
+    report["cached"] = False
+    return solid, report
+
+if __name__ == "__main__":
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Voxelize a TH-3DF launcher mesh with caching and report its geometry.')
+    parser.add_argument('stl_file', type=str, help='Path to the STL mesh.')
+    parser.add_argument('--resolution', type=int, nargs=3, required=True, metavar=('NX', 'NY', 'NZ'), help='Simulation grid size.')
+    parser.add_argument('--rotate', type=str, action='append', default=[], help='Rotation such as x:180; repeat to compose in C++ order.')
+    parser.add_argument('--size', type=float, default=None, help='Longest side of the mesh in cells (lbm_length in the setups).')
+    parser.add_argument('--offset', type=float, nargs=3, default=[0.0, 0.0, 0.0], help='Translation in cells after centring.')
+    parser.add_argument('--axis', type=int, default=1, choices=[0, 1, 2], help='Firing axis used for the aperture (0 = x, 1 = y, 2 = z).')
+    parser.add_argument('--cache', type=str, default='.voxel-cache', help='Directory of the voxel cache.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes used for voxelization.')
+    parser.add_argument('--output', type=str, default=None, help='Also save the solid mask as a .npy file.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Voxelize the mesh
+    solid, report = voxelize_stl(args.stl_file, args.resolution, args.rotate, args.size, args.offset, args.cache,
+                                 args.jobs, args.axis)
+    if args.output:
+        np.save(args.output, solid)
+    print(json.dumps({k: v for k, v in report.items() if k != "params"}, indent=2))